@@ -12,12 +12,35 @@ from model.models import ModelDSNN, SetTransformer
 # Directory pointing to the NTuples to train/test on
 ntuple_dir = "../NTuples"
 
+# Directory to write the memory-mapped tensor cache to (see scripts/TensorCache.py)
+cache_dir = "../TensorCache"
+
+# How the tensor cache recognises the NTuple behind each of its shards: "mtime" uses the path, size and modification time
+# of the file and "content" a hash of its contents (slow the first time a file is seen but survives moves and touches)
+cache_fingerprint = "mtime"
+
+# Directory to persist the per-file NTuple metadata index to (see scripts/NTupleIndex.py)
+index_dir = "../NTupleIndex"
+
+# Maximum number of objects of each type to keep per tau - arrays are padded/clipped to this length
+max_items_dict = {"TauTracks": 3,
+				  "NeutralPFO": 6,
+				  "ShotPFO": 8,
+				  "ConvTrack": 4,
+				  }
+
+# Variable to sort the objects of each type by (largest first) before they are clipped to max_items, e.g.
+# {"TauTracks": "TauTracks.pt", "NeutralPFO": "NeutralPFO.pt", "ShotPFO": "ShotPFO.pt", "ConvTrack": "ConvTrack.pt"}
+# Types that are not listed keep the order of the NTuples. A network must be tested with the same setting it was
+# trained with. Run python3 tauclassifier.py multiplicity to choose max_items
+sort_items_dict = {}
+
 # Bowen's DSNN config dictionary
 config_dict = {"shapes":
-				   {"TauTrack": (len(variable_handler.get("TauTracks")),) + (3,),
-					"NeutralPFO": (len(variable_handler.get("NeutralPFO")),) + (6,),
-					"ShotPFO": (len(variable_handler.get("ShotPFO")),) + (8,),
-					"ConvTrack": (len(variable_handler.get("ConvTrack")),) + (4,),
+				   {"TauTrack": (len(variable_handler.get("TauTracks")),) + (max_items_dict["TauTracks"],),
+					"NeutralPFO": (len(variable_handler.get("NeutralPFO")),) + (max_items_dict["NeutralPFO"],),
+					"ShotPFO": (len(variable_handler.get("ShotPFO")),) + (max_items_dict["ShotPFO"],),
+					"ConvTrack": (len(variable_handler.get("ConvTrack")),) + (max_items_dict["ConvTrack"],),
 					"TauJets": (len(variable_handler.get("TauJets")),),
 					},
 			   "n_tdd":
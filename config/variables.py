@@ -4,10 +4,11 @@ _____________________________________________________________
 Imput Variables configuration
 """
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import List
 import math
 import numpy as np
+import numba as nb
 
 @dataclass
 class Variable:
@@ -19,6 +20,8 @@ class Variable:
         max_val (float, optional: default=None): Maximum value variable is allowed to take
         minx_val (float, optional: default=None): Minimum value variable is allowed to take
         lognorm (bool, optional: default=False): If True will take lognorm10 of variable
+        storage (str, optional: default="float32"): dtype the variable is stored in by the tensor cache when reduced
+        precision is turned on - one of float32, float16, bfloat16 or uint8 (see scripts/FeatureCodec.py)
     """
     
     type: str
@@ -27,6 +30,7 @@ class Variable:
     min_val: float = None
     lognorm: bool = False
     norm: bool = False
+    storage: str = "float32"
 
     def standardise(self, data_arr, dummy_val=-1):
         
@@ -52,6 +56,40 @@ class Variable:
     def __str__(self):
         return self.name
 
+@nb.njit()
+def standardise_tensor(arr, min_vals, max_vals, lognorm, norm, log_max, dummy_val=-1):
+    """
+    Applies Variable.standardise to every variable of a tensor in a single pass. Jitted so that the whole batch can be
+    transformed in place without the temporary arrays made by np.where and np.ma.log10
+    :param arr: A float32 array of shape (num events, number of variables, max_items) - modified in place
+    :param min_vals: Array of Variable.min_val for each variable (NaN if None)
+    :param max_vals: Array of Variable.max_val for each variable (NaN if None)
+    :param lognorm: Boolean array of Variable.lognorm for each variable
+    :param norm: Boolean array of Variable.norm for each variable
+    :param log_max: Array of log10(Variable.max_val) for each variable
+    :param dummy_val: Value given to entries falling outside of [min_val, max_val] or failing the log
+    :return: The standardised array
+    """
+    for j in range(0, arr.shape[1]):
+        for i in range(0, arr.shape[0]):
+            for k in range(0, arr.shape[2]):
+                value = arr[i, j, k]
+                if not np.isnan(min_vals[j]) and not value >= min_vals[j]:
+                    value = dummy_val
+                if not np.isnan(max_vals[j]) and not value <= max_vals[j]:
+                    value = dummy_val
+                if lognorm[j]:
+                    # np.ma.log10 masks non-positive values and non-finite results
+                    if value > 0 and value < np.inf:
+                        value = np.log10(value) / log_max[j]
+                    else:
+                        value = dummy_val
+                if norm[j]:
+                    value = value / log_max[j]
+                arr[i, j, k] = value
+    return arr
+
+
 @dataclass
 class VariableHandler:
     """
@@ -60,6 +98,7 @@ class VariableHandler:
         variables (List(Variable)): A list of Variable dataclass instances
     """
     variables: List[Variable]
+    _tables: dict = field(default_factory=dict, repr=False)
 
     def add_variable(self, variable):
         """
@@ -70,6 +109,7 @@ class VariableHandler:
             None
         """
         self.variables.append(variable)
+        self._tables = {}
 
     def get(self, var_type):
         """
@@ -85,6 +125,41 @@ class VariableHandler:
     def list(self):
         return [variable.name for variable in self.variables]
 
+    def compile(self, var_type):
+        """
+        Compiles the standardisation parameters of all variables of a type into arrays for standardise_tensor
+        The result is cached until a new variable is added
+        args:
+            var_type (str): Variable type e.g. TauJets, NeutralPFO etc..
+        returns:
+            (tuple): Arrays of min_val, max_val, lognorm, norm, log10(max_val) - one entry per variable
+        """
+        if var_type not in self._tables:
+            variables = self.get(var_type)
+            min_vals = np.array([np.nan if v.min_val is None else v.min_val for v in variables], dtype=np.float32)
+            max_vals = np.array([np.nan if v.max_val is None else v.max_val for v in variables], dtype=np.float32)
+            lognorm = np.array([v.lognorm for v in variables], dtype=np.bool_)
+            norm = np.array([v.norm for v in variables], dtype=np.bool_)
+            log_max = np.array([np.nan if v.max_val is None else math.log10(v.max_val) for v in variables],
+                               dtype=np.float32)
+            self._tables[var_type] = (min_vals, max_vals, lognorm, norm, log_max)
+        return self._tables[var_type]
+
+    def standardise(self, var_type, arr, dummy_val=-1):
+        """
+        Standardises every variable of a type in place - equivalent to calling Variable.standardise on each column
+        args:
+            var_type (str): Variable type e.g. TauJets, NeutralPFO etc..
+            arr (np.ndarray): A float32 array of shape (num events, number of variables) or
+            (num events, number of variables, max_items)
+            dummy_val (float, optional: default=-1): Value given to entries that fail the standardisation
+        returns:
+            (np.ndarray): The standardised array
+        """
+        tensor = arr if arr.ndim == 3 else arr[:, :, np.newaxis]
+        standardise_tensor(tensor, *self.compile(var_type), dummy_val)
+        return arr
+
     def __len__(self):
         return len(self.variables)
 
@@ -93,16 +168,16 @@ class VariableHandler:
 
 variable_handler = VariableHandler([])
 
-variable_handler.add_variable(Variable("TauTracks", "TauTracks.nInnermostPixelHits", min_val=0, max_val=3, norm=True))
-variable_handler.add_variable(Variable("TauTracks", "TauTracks.nPixelHits", min_val=0, max_val=11, norm=True))
-variable_handler.add_variable(Variable("TauTracks", "TauTracks.nSCTHits", min_val=0, max_val=21, norm=True))
-variable_handler.add_variable(Variable("TauTracks", "TauTracks.chargedScoreRNN", min_val=0, max_val=1))
-variable_handler.add_variable(Variable("TauTracks", "TauTracks.isolationScoreRNN", min_val=0, max_val=1))
-variable_handler.add_variable(Variable("TauTracks", "TauTracks.conversionScoreRNN", min_val=0, max_val=1))
+variable_handler.add_variable(Variable("TauTracks", "TauTracks.nInnermostPixelHits", min_val=0, max_val=3, norm=True, storage="uint8"))
+variable_handler.add_variable(Variable("TauTracks", "TauTracks.nPixelHits", min_val=0, max_val=11, norm=True, storage="uint8"))
+variable_handler.add_variable(Variable("TauTracks", "TauTracks.nSCTHits", min_val=0, max_val=21, norm=True, storage="uint8"))
+variable_handler.add_variable(Variable("TauTracks", "TauTracks.chargedScoreRNN", min_val=0, max_val=1, storage="float16"))
+variable_handler.add_variable(Variable("TauTracks", "TauTracks.isolationScoreRNN", min_val=0, max_val=1, storage="float16"))
+variable_handler.add_variable(Variable("TauTracks", "TauTracks.conversionScoreRNN", min_val=0, max_val=1, storage="float16"))
 variable_handler.add_variable(Variable("TauTracks", "TauTracks.pt", min_val=0, max_val=0.25e7, lognorm=True))
 variable_handler.add_variable(Variable("TauTracks", "TauTracks.dphiECal", min_val=0, max_val=1))
 variable_handler.add_variable(Variable("TauTracks", "TauTracks.detaECal", min_val=0, max_val=1))
-variable_handler.add_variable(Variable("TauTracks", "TauTracks.jetpt", min_val=0, max_val=3e7, lognorm=True))
+variable_handler.add_variable(Variable("TauTracks", "TauTracks.jetpt", min_val=0, max_val=3e7, lognorm=True, storage="bfloat16"))
 variable_handler.add_variable(Variable("TauTracks", "TauTracks.d0TJVA", min_val=0, max_val=100, lognorm=True))
 variable_handler.add_variable(Variable("TauTracks", "TauTracks.d0SigTJVA", min_val=0, max_val=250, lognorm=True))
 variable_handler.add_variable(Variable("TauTracks", "TauTracks.z0sinthetaTJVA", min_val=0, max_val=150, lognorm=True))
@@ -113,7 +188,7 @@ variable_handler.add_variable(Variable("ConvTrack", "ConvTrack.dphi", min_val=0,
 variable_handler.add_variable(Variable("ConvTrack", "ConvTrack.detaECal", min_val=0, max_val=1))
 variable_handler.add_variable(Variable("ConvTrack", "ConvTrack.deta", min_val=0, max_val=1,))
 variable_handler.add_variable(Variable("ConvTrack", "ConvTrack.pt", min_val=0, max_val=5e7, lognorm=True))
-variable_handler.add_variable(Variable("ConvTrack", "ConvTrack.jetpt", min_val=0, max_val=3e7, lognorm=True))
+variable_handler.add_variable(Variable("ConvTrack", "ConvTrack.jetpt", min_val=0, max_val=3e7, lognorm=True, storage="bfloat16"))
 variable_handler.add_variable(Variable("ConvTrack", "ConvTrack.d0TJVA", min_val=0, max_val=100, lognorm=True))
 variable_handler.add_variable(Variable("ConvTrack", "ConvTrack.d0SigTJVA", min_val=0, max_val=250, lognorm=True))
 variable_handler.add_variable(Variable("ConvTrack", "ConvTrack.z0sinthetaTJVA", min_val=0, max_val=100, lognorm=True))
@@ -124,35 +199,35 @@ variable_handler.add_variable(Variable("ShotPFO", "ShotPFO.dphi", min_val=0, max
 variable_handler.add_variable(Variable("ShotPFO", "ShotPFO.detaECal", min_val=0, max_val=1))
 variable_handler.add_variable(Variable("ShotPFO", "ShotPFO.deta", min_val=0, max_val=1))
 variable_handler.add_variable(Variable("ShotPFO", "ShotPFO.pt", min_val=0,  max_val=50000, lognorm=True))
-variable_handler.add_variable(Variable("ShotPFO", "ShotPFO.jetpt", min_val=0, max_val=3e7, lognorm=True))
+variable_handler.add_variable(Variable("ShotPFO", "ShotPFO.jetpt", min_val=0, max_val=3e7, lognorm=True, storage="bfloat16"))
 
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.dphiECal", min_val=0, max_val=1))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.dphi", min_val=0, max_val=1))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.detaECal", min_val=0, max_val=1))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.deta", min_val=0, max_val=1))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.pt", min_val=0, max_val=0.5e7, lognorm=True))
-variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.jetpt", min_val=0, max_val=3e7, lognorm=True))
+variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.jetpt", min_val=0, max_val=3e7, lognorm=True, storage="bfloat16"))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.FIRST_ETA", min_val=0, max_val=4, norm=True))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.SECOND_R", min_val=0, max_val=50000, lognorm=True))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.DELTA_THETA", min_val=0, max_val=1))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.CENTER_LAMBDA", min_val=0, max_val=1300, lognorm=True))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.LONGITUDINAL", min_val=0, max_val=1))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.SECOND_ENG_DENS", min_val=0, max_val=10, lognorm=True))
-variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.ENG_FRAC_CORE", min_val=0, max_val=1))
+variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.ENG_FRAC_CORE", min_val=0, max_val=1, storage="float16"))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.NPosECells_EM1", min_val=0, max_val=300, lognorm=True))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.NPosECells_EM2", min_val=0, max_val=300, lognorm=True))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.energy_EM1", min_val=0, max_val=0.2e7, lognorm=True))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.energy_EM2", min_val=0, max_val=0.2e7, lognorm=True))
-variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.EM1CoreFrac", min_val=0, max_val=1))
+variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.EM1CoreFrac", min_val=0, max_val=1, storage="float16"))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.firstEtaWRTClusterPosition_EM1", min_val=0, max_val=0.25,  lognorm=True))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.firstEtaWRTClusterPosition_EM2", min_val=0, max_val=0.25,  lognorm=True))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.secondEtaWRTClusterPosition_EM1", min_val=0, max_val=0.01, lognorm=True))
 variable_handler.add_variable(Variable("NeutralPFO", "NeutralPFO.secondEtaWRTClusterPosition_EM2", min_val=0, max_val=0.01, lognorm=True))
 
-variable_handler.add_variable(Variable("TauJets", "TauJets.centFrac", min_val=0, max_val=1.5, norm=True))
+variable_handler.add_variable(Variable("TauJets", "TauJets.centFrac", min_val=0, max_val=1.5, norm=True, storage="float16"))
 variable_handler.add_variable(Variable("TauJets", "TauJets.etOverPtLeadTrk", min_val=0, max_val=30, lognorm=True))
 variable_handler.add_variable(Variable("TauJets", "TauJets.dRmax", min_val=0, max_val=1))
-variable_handler.add_variable(Variable("TauJets", "TauJets.SumPtTrkFrac", min_val=0, max_val=1))
+variable_handler.add_variable(Variable("TauJets", "TauJets.SumPtTrkFrac", min_val=0, max_val=1, storage="float16"))
 variable_handler.add_variable(Variable("TauJets", "TauJets.ptRatioEflowApprox", min_val=0, max_val=5, norm=True))
 variable_handler.add_variable(Variable("TauJets", "TauJets.mEflowApprox", min_val=0, max_val=0.3e7, lognorm=True))
 variable_handler.add_variable(Variable("TauJets", "TauJets.ptJetSeed", min_val=0, max_val=3.5e7, lognorm=True))
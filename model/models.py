@@ -51,15 +51,30 @@ class Sum(Layer):
 # Functional models
 # =================
 
-def ModelDSNN(para, mask_value=-1, normalizers=None, bn=False):
+def input_shape(para, branch, dynamic=False):
+    """
+    Shape of the input of a nested branch
+    :param para: Model config dictionary
+    :param branch: Key of para["shapes"] e.g. "TauTrack"
+    :param dynamic (optional, default=False): If True the input is objects first with any number of objects - (None,
+    number of variables) - for batches padded to their largest multiplicity (see scripts/BucketSampler.py)
+    :return: A shape tuple
+    """
+    if dynamic:
+        return None, para["shapes"][branch][0]
+    return para["shapes"][branch]
+
+
+def ModelDSNN(para, mask_value=-1, normalizers=None, bn=False, dynamic=False):
     """
     TODO: docstring
+    Set dynamic=True to take dynamically padded inputs (see input_shape())
     """
     initializer = tf.keras.initializers.HeNormal()
     activation_func = 'swish'
 
     # Branch 1
-    x_1 = Input(shape=para["shapes"]["TauTrack"])
+    x_1 = Input(shape=input_shape(para, "TauTrack", dynamic))
     b_1 = Masking(mask_value=mask_value)(x_1)
     if normalizers is not None:
         b_1 = normalizers["TauTrack"](b_1)
@@ -74,7 +89,7 @@ def ModelDSNN(para, mask_value=-1, normalizers=None, bn=False):
         b_1 = BatchNormalization()(b_1)
 
     # Branch 2
-    x_2 = Input(shape=para["shapes"]["NeutralPFO"])
+    x_2 = Input(shape=input_shape(para, "NeutralPFO", dynamic))
     b_2 = Masking(mask_value=mask_value)(x_2)
     if normalizers is not None:
         b_2 = normalizers["NeutralPFO"](b_2)
@@ -89,7 +104,7 @@ def ModelDSNN(para, mask_value=-1, normalizers=None, bn=False):
        b_2 = BatchNormalization()(b_2)
 
     # Branch 3
-    x_3 = Input(shape=para["shapes"]["ShotPFO"])
+    x_3 = Input(shape=input_shape(para, "ShotPFO", dynamic))
     b_3 = Masking(mask_value=mask_value)(x_3)
     if normalizers is not None:
         b_3 = normalizers["ShotPFO"](b_3)
@@ -104,7 +119,7 @@ def ModelDSNN(para, mask_value=-1, normalizers=None, bn=False):
         b_3 = BatchNormalization()(b_3)
 
     # Branch 4
-    x_4 = Input(shape=para["shapes"]["ConvTrack"])
+    x_4 = Input(shape=input_shape(para, "ConvTrack", dynamic))
     b_4 = Masking(mask_value=mask_value)(x_4)
     if normalizers is not None:
         b_4 = normalizers["ConvTrack"](b_4)
@@ -142,38 +157,39 @@ def ModelDSNN(para, mask_value=-1, normalizers=None, bn=False):
 
     return Model(inputs=[x_1, x_2, x_3, x_4, x_5], outputs=y)
 
-def SetTransformer(para, mask_value=-4.0,):
+def SetTransformer(para, mask_value=-4.0, dynamic=False):
     """
     SetTransformer implementation in TensorFlow by https://github.com/arrigonialberto86/set_transformer
     Based on this paper https://arxiv.org/abs/1810.00825
     Only had limited time to play with this
     Couldn't really get this to work and I've not had the time and resources to properly understand it
     If you're reading this perhaps give it a go?
+    Set dynamic=True to take dynamically padded inputs (see input_shape())
     """
     initializer = tf.keras.initializers.HeNormal()
     activation_func = 'elu'
     out_dim = 25
 
     # Branch 1
-    x_1 = Input(shape=para["shapes"]["TauTrack"], ragged=True)
+    x_1 = Input(shape=input_shape(para, "TauTrack", dynamic), ragged=True)
     b_1 = Masking(mask_value=mask_value)(x_1)
     b_1 = BasicSetTransformer(out_dim=out_dim)(b_1)
     # b_1 = BatchNormalization()(b_1)
 
     # Branch 2
-    x_2 = Input(shape=para["shapes"]["NeutralPFO"], ragged=True)
+    x_2 = Input(shape=input_shape(para, "NeutralPFO", dynamic), ragged=True)
     b_2 = Masking(mask_value=mask_value)(x_2)
     b_2 = BasicSetTransformer(out_dim=out_dim)(b_2)
     # b_2 = BatchNormalization()(b_2)
 
     # Branch 3
-    x_3 = Input(shape=para["shapes"]["ShotPFO"], ragged=True)
+    x_3 = Input(shape=input_shape(para, "ShotPFO", dynamic), ragged=True)
     b_3 = Masking(mask_value=mask_value)(x_3)
     b_3 = BasicSetTransformer(out_dim=out_dim)(b_3)
     # b_3 = BatchNormalization()(b_3)
 
     # Branch 4
-    x_4 = Input(shape=para["shapes"]["ConvTrack"], ragged=True)
+    x_4 = Input(shape=input_shape(para, "ConvTrack", dynamic), ragged=True)
     b_4 = Masking(mask_value=mask_value)(x_4)
     b_4 = BasicSetTransformer(out_dim=out_dim)(b_4)
     # b_4 = BatchNormalization()(b_4)
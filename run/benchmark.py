@@ -0,0 +1,244 @@
+"""
+Benchmarks
+_____________________________________________________________
+Benchmarks of the data loading pipeline
+Example usage:
+python3 tauclassifier.py benchmark -benchmark=padding
+python3 tauclassifier.py benchmark -benchmark=backends
+python3 tauclassifier.py benchmark -benchmark=clusters
+python3 tauclassifier.py benchmark -benchmark=precision -weights=<path to DSNN weights>
+python3 tauclassifier.py benchmark -benchmark=bucketing -model=DSNN
+"""
+
+import os
+import math
+import time
+import tempfile
+import uproot
+import numpy as np
+import awkward as ak
+from config.files import training_files, ntuple_dir
+from config.config import get_cuts, max_items_dict, config_dict, models_dict
+from config.variables import variable_handler
+from scripts.DataLoader import DataLoader, pad_nested_arrays
+from scripts.BatchLayout import BatchLayout
+from scripts.FeatureCodec import compressions
+from scripts.DataGenerator import DataGenerator
+from scripts.NTupleIndex import NTupleIndex
+from scripts.NTupleReader import NTupleReader
+from scripts.LoaderBackends import backends_dict
+from scripts.preprocessing import Reweighter
+from scripts.utils import logger
+
+
+def reference_pad_and_reshape(batch, variables, max_items, dummy_val=-1):
+    """
+    The original pure awkward/numpy implementation of DataLoader.pad_and_reshape_nested_arrays kept as a reference
+    to benchmark and validate pad_nested_arrays against
+    """
+    np_arrays = np.zeros((ak.num(batch[variables[0].name], axis=0), len(variables), max_items))
+    for i, variable in enumerate(variables):
+        ak_arr = batch[variable.name]
+        ak_arr = ak.pad_none(ak_arr, max_items, clip=True, axis=1)
+        arr = ak.to_numpy(abs(ak_arr)).filled(dummy_val)
+        np_arrays[:, i] = arr
+    np_arrays = np.nan_to_num(np_arrays, posinf=0, neginf=0, copy=False).astype("float32")
+    return np_arrays
+
+
+def time_function(func, *args, repeats=5, **kwargs):
+    """
+    Time a function
+    :param func: Function to time
+    :param repeats: Number of times to run the function - the fastest time is returned
+    :return: Fastest time in seconds, the function's return value
+    """
+    times = []
+    result = None
+    for _ in range(0, repeats):
+        start_time = time.perf_counter()
+        result = func(*args, **kwargs)
+        times.append(time.perf_counter() - start_time)
+    return min(times), result
+
+
+def benchmark_padding(nevents=100000, repeats=5):
+    """
+    Benchmark the numba ragged-to-padded kernel against the original awkward implementation on a batch of Gammatautau
+    :param nevents (optional, default=100000): Number of events in the batch
+    :param repeats (optional, default=5): Number of times to repeat each measurement
+    """
+    files = training_files[0].file_list
+    batch = uproot.concatenate(files[0], filter_name=variable_handler.list(), cut=get_cuts()["Gammatautau"],
+                               entry_stop=nevents)
+    logger.log(f"Benchmarking padding on a batch of {len(batch)} events")
+
+    # Run kernels once so that compile time is not included
+    for var_type, max_items in max_items_dict.items():
+        pad_nested_arrays(batch, variable_handler.get(var_type), max_items)
+
+    for var_type, max_items in max_items_dict.items():
+        variables = variable_handler.get(var_type)
+        ref_time, ref_arr = time_function(reference_pad_and_reshape, batch, variables, max_items, repeats=repeats)
+        new_time, new_arr = time_function(pad_nested_arrays, batch, variables, max_items, repeats=repeats)
+        assert np.array_equal(ref_arr, new_arr), f"numba kernel and reference disagree for {var_type}"
+        logger.log(f"{var_type:<12} reference = {ref_time * 1e3:.2f} ms   numba = {new_time * 1e3:.2f} ms   "
+                   f"speed up = {ref_time / new_time:.1f}x")
+
+
+def benchmark_backends(nbatches=100, nsuperbatches=20):
+    """
+    Benchmark the DataLoader backends. For each backend a DataGenerator is made for the training files and the time
+    taken to start the DataLoaders and to load super-batches (one batch from every DataLoader) is measured
+    :param nbatches (optional, default=100): Number of batches to split the data into
+    :param nsuperbatches (optional, default=20): Number of super-batches to time - the first one is not included
+    """
+    reweighter = Reweighter(ntuple_dir)
+    for backend in backends_dict:
+        start_time = time.perf_counter()
+        generator = DataGenerator(training_files, variable_handler, batch_size=1024, nbatches=nbatches,
+                                  cuts=get_cuts(), reweighter=reweighter, label=f"{backend} benchmark", backend=backend)
+        generator._next_superbatch()
+        startup_time = time.perf_counter() - start_time
+
+        nevents = 0
+        start_time = time.perf_counter()
+        for _ in range(0, nsuperbatches):
+            features, _, _ = generator._assemble(generator._next_superbatch())
+            nevents += len(features[0])
+        load_time = time.perf_counter() - start_time
+        generator.shutdown()
+
+        logger.log(f"{backend:<8} start up = {startup_time:.2f} s   {nsuperbatches} super-batches = {load_time:.2f} s   "
+                   f"rate = {nevents / load_time:.0f} events/s")
+
+
+def benchmark_clusters(nbatches=500):
+    """
+    Compare the number of bytes decompressed per event when the DataLoader steps are aligned to the cluster boundaries
+    of the NTuples against when they are not, along with the spread of the step sizes
+    :param nbatches (optional, default=500): Number of batches to split the data into - sets the step size in the same
+    way as DataLoader
+    """
+    index = NTupleIndex()
+    cuts = get_cuts()
+    for file_handler in training_files:
+        step_size = math.ceil(index.num_events(file_handler.file_list, cuts=cuts.get(file_handler.label)) / nbatches)
+        for align in (False, True):
+            reader = NTupleReader(file_handler.file_list, variable_handler.list(), step_size=step_size, index=index,
+                                  align=align)
+            nbytes, nentries = reader.decompressed_bytes()
+            step_sizes = [entry_stop - entry_start for _, entry_start, entry_stop in reader.steps()]
+            logger.log(f"{file_handler.label:<12} aligned = {str(align):<5}  steps = {len(step_sizes):<5} "
+                       f"step size = {np.mean(step_sizes):.0f} +/- {np.std(step_sizes):.0f}   "
+                       f"decompressed = {nbytes / max(nentries, 1):.0f} bytes/event")
+
+
+def benchmark_precision(weights=None, nbatches=20):
+    """
+    Benchmark the storage options of the tensor cache. The first file of the first training FileHandler is cached with
+    every combination of precision and compression, then the size of the cache on disk, the rate at which batches are
+    read back and the effect on the DSNN compared to the full precision, uncompressed cache are reported. Compressions
+    whose packages are not installed are skipped
+    :param weights (optional, default=None): DSNN weights to evaluate. If None (or the file does not exist) a freshly
+    initialised DSNN is used - the change in its outputs is still measured but the accuracy is meaningless
+    :param nbatches (optional, default=20): Number of batches to split the file into
+    """
+    file_handler = training_files[0]
+    reweighter = Reweighter(ntuple_dir)
+    layout = BatchLayout(variable_handler, max_items_dict)
+    model = models_dict["DSNN"](config_dict)
+    if weights is not None and os.path.isfile(weights):
+        model.load_weights(weights)
+    else:
+        logger.log("No DSNN weights given - using an untrained model", 'WARNING')
+
+    reference = None
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for compression in (None,) + compressions:
+            for precision in ("full", "reduced"):
+                try:
+                    loader = DataLoader(file_handler.label, file_handler.file_list[:1], file_handler.class_label,
+                                        nbatches, variable_handler, cuts=get_cuts().get(file_handler.label),
+                                        reweighter=reweighter, cache_dir=cache_dir, cache_precision=precision,
+                                        cache_compression=compression)
+                except ImportError as error:
+                    logger.log(f"Skipping {compression} compression: {error}", 'WARNING')
+                    break
+
+                load_time, buffers = time_function(lambda: [loader.get_batch()
+                                                            for _ in range(0, loader.number_of_batches())],
+                                                   repeats=1)
+                features, _, labels = layout.unpack(layout.concatenate(buffers))
+                for name, arr in zip(layout.feature_names, features):
+                    variable_handler.standardise(name, arr)
+                predictions = model.predict(features, batch_size=10000)
+                accuracy = np.mean(np.argmax(predictions, axis=1) == labels)
+                if reference is None:
+                    reference = features, predictions
+                input_error = max(np.max(np.abs(arr - ref_arr), initial=0)
+                                  for arr, ref_arr in zip(features, reference[0]))
+                output_error = np.mean(np.abs(predictions - reference[1]))
+
+                logger.log(f"precision = {precision:<8} compression = {str(compression):<5} "
+                           f"size = {loader._cache.nbytes() / 1e6:.1f} MB   "
+                           f"rate = {len(labels) / load_time:.0f} events/s   max input change = {input_error:.2e}   "
+                           f"mean output change = {output_error:.2e}   accuracy = {accuracy:.4f}")
+
+
+def benchmark_bucketing(model="DSNN", nbatches=100, nsteps=50, warmup=5):
+    """
+    Benchmark the training throughput with the nested features padded to max_items, padded to the largest multiplicity
+    of each batch and padded to the largest multiplicity of each batch after bucketing the events by multiplicity. The
+    batches are loaded before the clock is started so only the training steps are timed. The first few steps of each
+    are not timed since the model is traced again for the first few shapes it sees
+    :param model (optional, default="DSNN"): Key of config.config.models_dict of the model to train
+    :param nbatches (optional, default=100): Number of batches to split the data into
+    :param nsteps (optional, default=50): Number of training steps to time
+    :param warmup (optional, default=5): Number of training steps to run before starting the clock
+    """
+    reweighter = Reweighter(ntuple_dir)
+    for dynamic_padding, bucketing in ((False, False), (True, False), (True, True)):
+        generator = DataGenerator(training_files, variable_handler, batch_size=1024, nbatches=nbatches,
+                                  cuts=get_cuts(), reweighter=reweighter, label="bucketing benchmark",
+                                  dynamic_padding=dynamic_padding, bucketing=bucketing)
+        batches = [generator[i] for i in range(0, min(warmup + nsteps, len(generator)))]
+        generator.shutdown()
+
+        network = models_dict[model](config_dict, dynamic=dynamic_padding)
+        network.compile(optimizer="adam", loss="categorical_crossentropy")
+        for features, labels, weights in batches[:warmup]:
+            network.train_on_batch(features, labels, sample_weight=weights)
+        nevents = 0
+        start_time = time.perf_counter()
+        for features, labels, weights in batches[warmup:]:
+            network.train_on_batch(features, labels, sample_weight=weights)
+            nevents += len(labels)
+        train_time = time.perf_counter() - start_time
+
+        # Objects axis is the last axis when padded to max_items and the middle one when padded dynamically
+        axis = 1 if dynamic_padding else 2
+        slots = np.mean([sum(arr.shape[axis] for arr in features if arr.ndim == 3) for features, _, _ in batches])
+        logger.log(f"dynamic padding = {str(dynamic_padding):<5} bucketing = {str(bucketing):<5} "
+                   f"object slots per event = {slots:.1f}   {len(batches) - warmup} steps = {train_time:.2f} s   "
+                   f"rate = {nevents / max(train_time, 1e-9):.0f} events/s")
+
+
+benchmarks_dict = {"padding": benchmark_padding,
+                   "backends": benchmark_backends,
+                   "clusters": benchmark_clusters,
+                   "precision": benchmark_precision,
+                   "bucketing": benchmark_bucketing}
+
+
+def benchmark(args):
+    """
+    Run a benchmark
+    :param args: Args parsed by tauclassifier.py. Uses args.benchmark to select the benchmark to run
+    """
+    if args.benchmark == "precision":
+        benchmark_precision(weights=args.weights)
+    elif args.benchmark == "bucketing":
+        benchmark_bucketing(model=args.model)
+    else:
+        benchmarks_dict[args.benchmark]()
@@ -0,0 +1,27 @@
+"""
+Build Tensor Cache
+_____________________________________________________
+Build the missing shards of the tensor cache for every sample ahead of training, several files at once
+Example usage:
+python3 tauclassifier.py cache -cache_workers=8
+python3 tauclassifier.py cache -prong=1 -cache_precision=reduced -cache_prune=True
+"""
+
+from config.variables import variable_handler
+from config.files import all_files, ntuple_dir
+from config.config import get_cuts, cache_dir
+from scripts.CacheBuilder import CacheBuilder
+from scripts.preprocessing import Reweighter
+
+
+def build_cache(args):
+    """
+    Build the tensor cache
+    :param args: Args parsed by tauclassifier.py
+    """
+    builder = CacheBuilder(cache_dir, variable_handler, cuts=get_cuts(args.prong), prong=args.prong,
+                           reweighter=Reweighter(ntuple_dir, prong=args.prong), precision=args.cache_precision,
+                           compression=args.cache_compression, workers=args.cache_workers)
+    builder.build(all_files)
+    if args.cache_prune:
+        builder.prune(all_files)
@@ -0,0 +1,24 @@
+"""
+Multiplicity Profile
+_____________________________________________________
+Profile the number of tracks and PFOs per event in the training samples and recommend max_items (see config/config.py)
+for a coverage target
+Example usage:
+python3 tauclassifier.py multiplicity -coverage=0.99
+python3 tauclassifier.py multiplicity -prong=3 -coverage=0.995
+"""
+
+from config.variables import variable_handler
+from config.files import training_files
+from config.config import get_cuts, max_items_dict
+from scripts.MultiplicityProfiler import MultiplicityProfiler
+
+
+def profile_multiplicity(args):
+    """
+    Profile the multiplicities and log the recommended max_items
+    :param args: Args parsed by tauclassifier.py
+    """
+    profiler = MultiplicityProfiler(variable_handler, max_items_dict.keys())
+    profiler.profile(training_files, cuts=get_cuts(args.prong))
+    profiler.report(max_items_dict, coverage=args.coverage)
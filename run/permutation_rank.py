@@ -11,7 +11,7 @@ import pandas as pd
 from config.files import testing_files, ntuple_dir
 from scripts.DataGenerator import DataGenerator
 from scripts.utils import logger
-from config.config import config_dict, get_cuts, models_dict
+from config.config import config_dict, get_cuts, models_dict, cache_dir
 from scripts.preprocessing import Reweighter
 from config.variables import variable_handler
 
@@ -24,7 +24,14 @@ class Ranker:
         cuts = get_cuts(args.prong)
         self.var_handler = var_handler
         self.batch_generator = DataGenerator(testing_files, self.var_handler, nbatches=50, cuts=cuts,
-                                             reweighter=reweighter, prong=args.prong, label="Ranking Generator")
+                                             reweighter=reweighter, prong=args.prong, label="Ranking Generator",
+                                             cache_dir=cache_dir if args.cache else None, pipeline=args.pipeline,
+                                             backend=args.loader_backend,
+                                             decompression_workers=args.decompression_workers,
+                                             interpretation_workers=args.interpretation_workers,
+                                             cache_precision=args.cache_precision,
+                                             cache_compression=args.cache_compression,
+                                             dynamic_padding=args.dynamic_padding, bitmap_index=args.bitmap_index)
 
         self.batch_generator.load_model(args.model, config_dict, args.weights)
         _, _, _, self.baseline_loss, self.baseline_acc = self.batch_generator.predict(make_confusion_matrix=True)
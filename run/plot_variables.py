@@ -5,7 +5,6 @@ Script to plot variables
 TODO: Options for plotting tau-jets, tau decay mode ect... Can't just comment the bits out
 """
 
-import uproot
 import glob
 import os
 import numpy as np
@@ -15,21 +14,26 @@ import matplotlib.pyplot as plt
 from config.config import get_cuts
 from config.config import ntuple_dir
 from scripts.utils import logger
+from scripts.NTupleReader import NTupleReader
+from scripts.BitmapIndex import BitmapIndex
 from config.variables import variable_handler
 
 
 class Plotter:
 
-    def __init__(self, file_list, name, colour='blue', reweighter=None, cuts=""):
-        self.file_list = file_list
+    def __init__(self, file_list, name, colour='blue', reweighter=None, cuts="", bitmaps=None):
+        self.file_list = [file_list] if isinstance(file_list, str) else file_list
         self.cuts = cuts
+        # The entries passing the cuts are looked up in the bitmap index so that only the plotted branch is read
+        self.bitmaps = bitmaps if bitmaps is not None else BitmapIndex()
         self.reweighter = reweighter
         self.label = name
         self.colour = colour
 
     def plot(self, quantity, ax, bins=50):
-        data = uproot.concatenate(self.file_list, filter_name=quantity.name, cut=self.cuts, library='ak')
-        data = data[quantity.name]
+        reader = NTupleReader(self.file_list, [quantity.name], cuts=self.cuts, bitmaps=self.bitmaps)
+        data = ak.concatenate([batch[quantity.name] for batch in reader])
+        reader.close()
         if "TauJets" not in quantity.name:
             data = ak.pad_none(data, 10, clip=True, axis=1)
         
@@ -66,17 +70,18 @@ def plot_variables():
     """
 
     cuts = get_cuts()
+    bitmaps = BitmapIndex()
     jet_files = glob.glob(os.path.join(f"{ntuple_dir}", "*JZ*/*.root"))
     tau_files = glob.glob(os.path.join(f"{ntuple_dir}", "*Gammatautau*/*.root"))
 
-    jet_plotter = Plotter(jet_files[0], "Jets", cuts=cuts["JZ1"], colour='blue')
-    tau_plotter = Plotter(tau_files[0], "Taus", cuts=cuts["Gammatautau"], colour='orange')
+    jet_plotter = Plotter(jet_files[0], "Jets", cuts=cuts["JZ1"], colour='blue', bitmaps=bitmaps)
+    tau_plotter = Plotter(tau_files[0], "Taus", cuts=cuts["Gammatautau"], colour='orange', bitmaps=bitmaps)
 
-    plotter_1p0n = Plotter(tau_files[0], "1p0n", cuts=get_cuts(decay_mode=0)["Gammatautau"], colour='red')
-    plotter_1p1n = Plotter(tau_files[0], "1p1n", cuts=get_cuts(decay_mode=1)["Gammatautau"], colour='orange')
-    plotter_1pXn = Plotter(tau_files[0], "1pXn", cuts=get_cuts(decay_mode=2)["Gammatautau"], colour='green')
-    plotter_3p0n = Plotter(tau_files[0], "3p0n", cuts=get_cuts(decay_mode=3)["Gammatautau"], colour='cyan')
-    plotter_3pXn = Plotter(tau_files[0], "3pXn", cuts=get_cuts(decay_mode=4)["Gammatautau"], colour='magenta')
+    plotter_1p0n = Plotter(tau_files[0], "1p0n", cuts=get_cuts(decay_mode=0)["Gammatautau"], colour='red', bitmaps=bitmaps)
+    plotter_1p1n = Plotter(tau_files[0], "1p1n", cuts=get_cuts(decay_mode=1)["Gammatautau"], colour='orange', bitmaps=bitmaps)
+    plotter_1pXn = Plotter(tau_files[0], "1pXn", cuts=get_cuts(decay_mode=2)["Gammatautau"], colour='green', bitmaps=bitmaps)
+    plotter_3p0n = Plotter(tau_files[0], "3p0n", cuts=get_cuts(decay_mode=3)["Gammatautau"], colour='cyan', bitmaps=bitmaps)
+    plotter_3pXn = Plotter(tau_files[0], "3pXn", cuts=get_cuts(decay_mode=4)["Gammatautau"], colour='magenta', bitmaps=bitmaps)
 
     all_plotters = (jet_plotter, plotter_1p0n, plotter_1p1n, plotter_1pXn, plotter_3p0n, plotter_3pXn)
 
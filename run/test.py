@@ -7,7 +7,7 @@ Plot confusion matrix and ROC curve using testing dataset
 from scripts.utils import logger
 from config.files import testing_files, ntuple_dir
 from config.variables import variable_handler
-from config.config import config_dict, get_cuts
+from config.config import config_dict, get_cuts, cache_dir
 from scripts.DataGenerator import DataGenerator
 from scripts.preprocessing import Reweighter
 
@@ -22,7 +22,12 @@ def test(args):
 	cuts = get_cuts(args.prong)
 
 	testing_batch_generator = DataGenerator(testing_files, variable_handler, nbatches=50, batch_size=10000, cuts=cuts,
-												reweighter=reweighter, prong=args.prong, label="Testing Generator")
+												reweighter=reweighter, prong=args.prong, label="Testing Generator",
+												cache_dir=cache_dir if args.cache else None, pipeline=args.pipeline,
+												backend=args.loader_backend, decompression_workers=args.decompression_workers,
+												interpretation_workers=args.interpretation_workers, cache_precision=args.cache_precision,
+												cache_compression=args.cache_compression, dynamic_padding=args.dynamic_padding,
+												bitmap_index=args.bitmap_index)
 
 	testing_batch_generator.load_model(args.model, config_dict, args.weights)
 	_, _, _, baseline_loss, baseline_acc = testing_batch_generator.predict(make_confusion_matrix=True, make_roc=True)
@@ -13,10 +13,11 @@ import numpy as np
 import time
 from config.variables import variable_handler
 from scripts.DataGenerator import DataGenerator
+from scripts.CacheBuilder import CacheBuilder
 from config.files import training_files, validation_files, ntuple_dir
 from model.callbacks import ParallelModelCheckpoint
 from scripts.utils import logger, get_number_of_events
-from config.config import config_dict, get_cuts, models_dict
+from config.config import config_dict, get_cuts, models_dict, cache_dir
 from scripts.preprocessing import Reweighter
 import shutil
 
@@ -70,12 +71,49 @@ def train(args):
     reweighter = Reweighter(ntuple_dir, prong=args.prong)
 
     cuts = get_cuts(args.prong)
+    tensor_cache_dir = cache_dir if args.cache else None
+    prefetch_bytes = args.prefetch_mb * 1024 ** 2 if args.prefetch_mb is not None else None
+    replay_bytes = args.replay_mb * 1024 ** 2 if args.replay_mb is not None else None
+
+    # Validation runs after every epoch so, if asked to, keep the standardised validation set once it has been read
+    pin_bytes = None
+    if args.pin_validation != "off":
+        pin_bytes = args.pin_validation_mb * 1024 ** 2 if args.pin_validation_mb is not None else "auto"
+    pin_dir = os.path.join(cache_dir, "pinned") if args.pin_validation == "memmap" else None
+
+    # Build any shards missing from the tensor cache several at a time rather than one by one in each DataLoader
+    if args.cache:
+        CacheBuilder(cache_dir, variable_handler, cuts=cuts, prong=args.prong, reweighter=reweighter,
+                     precision=args.cache_precision, compression=args.cache_compression,
+                     workers=args.cache_workers).build(training_files + validation_files)
     
     training_batch_generator = DataGenerator(training_files, variable_handler, batch_size=1024, nbatches=100, cuts=cuts,
-                                             reweighter=reweighter, prong=args.prong, label="Training Generator")
+                                             reweighter=reweighter, prong=args.prong, label="Training Generator",
+                                             cache_dir=tensor_cache_dir, pipeline=args.pipeline,
+                                             prefetch_depth=args.prefetch_depth, prefetch_bytes=prefetch_bytes,
+                                             shards=args.shards, autoscale=args.autoscale, backend=args.loader_backend,
+                                             decompression_workers=args.decompression_workers,
+                                             interpretation_workers=args.interpretation_workers,
+                                             replay_bytes=replay_bytes, deterministic=args.deterministic,
+                                             shuffle_blocks=args.shuffle_blocks, shuffle_buffer=args.shuffle_buffer,
+                                             seed=args.seed, cache_precision=args.cache_precision,
+                                             cache_compression=args.cache_compression,
+                                             dynamic_padding=args.dynamic_padding,
+                                             importance_sampling=args.importance_sampling,
+                                             sampling_floor=args.sampling_floor, sampling_cap=args.sampling_cap,
+                                             bitmap_index=args.bitmap_index)
 
     validation_batch_generator = DataGenerator(validation_files, variable_handler, batch_size=10000,cuts=cuts,
-                                               reweighter=reweighter, prong=args.prong, label="Validation Generator")
+                                               reweighter=reweighter, prong=args.prong, label="Validation Generator",
+                                               cache_dir=tensor_cache_dir, pipeline=args.pipeline,
+                                               prefetch_depth=args.prefetch_depth, prefetch_bytes=prefetch_bytes,
+                                               shards=args.shards, backend=args.loader_backend,
+                                               decompression_workers=args.decompression_workers,
+                                               interpretation_workers=args.interpretation_workers,
+                                               replay_bytes=pin_bytes, replay_shuffle=False, replay_dir=pin_dir,
+                                               deterministic=args.deterministic, cache_precision=args.cache_precision,
+                                               cache_compression=args.cache_compression,
+                                               dynamic_padding=args.dynamic_padding, bitmap_index=args.bitmap_index)
 
     """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
     Initialize Model
@@ -83,7 +121,7 @@ def train(args):
 
     # Configure model
     model_config = config_dict
-    model = models_dict[args.model](model_config)
+    model = models_dict[args.model](model_config, dynamic=args.dynamic_padding)
 
     # Configure callbacks
     early_stopping = tf.keras.callbacks.EarlyStopping(
@@ -147,9 +185,20 @@ def train(args):
     """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
      Train Model
     """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
-    history = model.fit(training_batch_generator, epochs=200, callbacks=callbacks, class_weight=class_weight,
-                        validation_data=validation_batch_generator, validation_freq=1, verbose=1, shuffle=True,
-                        steps_per_epoch=len(training_batch_generator), workers=2, use_multiprocessing=True)
+    if args.pipeline == "tfdata":
+        # tf.data pipeline - datasets are repeated so that keras can keep drawing batches across epochs
+        training_data = training_batch_generator.to_dataset(cache=args.tfdata_cache).repeat()
+        validation_data = validation_batch_generator.to_dataset(cache=args.tfdata_cache).repeat()
+        history = model.fit(training_data, epochs=200, callbacks=callbacks, class_weight=class_weight,
+                            validation_data=validation_data, validation_freq=1, verbose=1,
+                            steps_per_epoch=len(training_batch_generator), validation_steps=len(validation_batch_generator))
+    else:
+        # Deterministic generators build batches by index so several worker threads can share them safely. They shuffle
+        # the order of their super-batches themselves - Keras shuffling the indices would load each one several times
+        history = model.fit(training_batch_generator, epochs=200, callbacks=callbacks, class_weight=class_weight,
+                            validation_data=validation_batch_generator, validation_freq=1, verbose=1,
+                            shuffle=not args.deterministic, steps_per_epoch=len(training_batch_generator),
+                            workers=args.keras_workers, use_multiprocessing=not args.deterministic)
 
     """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
     Make Plots 
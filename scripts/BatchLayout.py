@@ -0,0 +1,151 @@
+"""
+BatchLayout Class Definition
+________________________________________________________________________________________________________________________
+Describes how a batch is packed into a single contiguous buffer. Batches are passed between the DataLoaders and the
+DataGenerator as one uint8 buffer holding a small header followed by the feature tensors, the weights and sparse class
+labels. Ray stores a single numpy buffer in its shared-memory object store and ray.get() hands the DataGenerator a
+zero-copy read-only view of it - typed views onto the arrays are then made with BatchLayout.unpack()
+"""
+
+import numpy as np
+
+
+def one_hot(labels, nclasses, dtype="int32"):
+    """
+    Convert sparse class labels into one-hot labels
+    :param labels: An array of integer class labels
+    :param nclasses: Number of classes
+    :param dtype (optional, default="int32"): dtype of the one-hot array
+    :return: An array of shape (len(labels), nclasses)
+    """
+    one_hot_labels = np.zeros((len(labels), nclasses), dtype=dtype)
+    one_hot_labels[np.arange(len(labels)), labels] = 1
+    return one_hot_labels
+
+
+class BatchLayout:
+
+    # Arrays making up the features of a batch - in the order they are passed to the model
+    feature_names = ("TauTracks", "NeutralPFO", "ShotPFO", "ConvTrack", "TauJets")
+
+    # Size of the header holding the number of events in the buffer
+    header_bytes = 8
+
+    # Start of each array is aligned to this many bytes
+    alignment = 8
+
+    def __init__(self, variable_handler, max_items):
+        """
+        Constructor for BatchLayout
+        :param variable_handler: A VariableHandler object holding the input variables
+        :param max_items: A dictionary of the maximum number of objects per variable type e.g. {"TauTracks": 3, ...}
+        """
+        # (name, per event shape, dtype) for each array in the buffer
+        self.arrays = []
+        for name in self.feature_names:
+            nvars = len(variable_handler.get(name))
+            shape = (nvars, max_items[name]) if name in max_items else (nvars,)
+            self.arrays.append((name, shape, np.dtype("float32")))
+        self.arrays.append(("weights", (), np.dtype("float32")))
+        self.arrays.append(("labels", (), np.dtype("int8")))
+
+    def _offsets(self, nevents):
+        """
+        Work out where each array starts in a buffer holding nevents
+        :param nevents: Number of events in the buffer
+        :return: A list of byte offsets (one per array) and the total size of the buffer in bytes
+        """
+        offsets = []
+        position = self.header_bytes
+        for _, shape, dtype in self.arrays:
+            offsets.append(position)
+            position += nevents * int(np.prod(shape)) * dtype.itemsize
+            position += -position % self.alignment
+        return offsets, position
+
+    def nbytes(self, nevents):
+        """
+        :param nevents: Number of events
+        :return: Size in bytes of a buffer holding nevents
+        """
+        return self._offsets(nevents)[1]
+
+    def allocate(self, nevents):
+        """
+        Allocate an (uninitialised) buffer for nevents
+        :param nevents: Number of events
+        :return: A uint8 buffer with the header set
+        """
+        buffer = np.empty(self.nbytes(nevents), dtype=np.uint8)
+        buffer[:self.header_bytes].view(np.int64)[0] = nevents
+        return buffer
+
+    @staticmethod
+    def num_events(buffer):
+        """
+        :param buffer: A packed batch
+        :return: Number of events in the buffer
+        """
+        return int(buffer[:BatchLayout.header_bytes].view(np.int64)[0])
+
+    def unpack(self, buffer):
+        """
+        Make typed views onto the arrays held in a buffer - no data is copied
+        :param buffer: A packed batch
+        :return: features (tuple of arrays in the order of feature_names), weights, labels
+        """
+        nevents = self.num_events(buffer)
+        offsets, _ = self._offsets(nevents)
+        views = []
+        for (_, shape, dtype), offset in zip(self.arrays, offsets):
+            size = nevents * int(np.prod(shape)) * dtype.itemsize
+            views.append(buffer[offset: offset + size].view(dtype).reshape((nevents,) + shape))
+        return tuple(views[:len(self.feature_names)]), views[-2], views[-1]
+
+    def pack(self, features, weights, labels):
+        """
+        Copy a set of arrays into a new buffer
+        :param features: A tuple of feature arrays in the order of feature_names
+        :param weights: Array of weights
+        :param labels: Array of sparse class labels
+        :return: A packed batch
+        """
+        buffer = self.allocate(len(labels))
+        buffer_features, buffer_weights, buffer_labels = self.unpack(buffer)
+        for buffer_arr, arr in zip(buffer_features, features):
+            buffer_arr[:] = arr
+        buffer_weights[:] = weights
+        buffer_labels[:] = labels
+        return buffer
+
+    def concatenate(self, buffers):
+        """
+        Concatenate several packed batches into a new packed batch. Each array is copied exactly once, straight from
+        the (possibly shared-memory) input buffers into the output
+        :param buffers: A list of packed batches
+        :return: A packed batch
+        """
+        unpacked = [self.unpack(buffer) for buffer in buffers]
+        buffer = self.allocate(sum(len(labels) for _, _, labels in unpacked))
+        out_features, out_weights, out_labels = self.unpack(buffer)
+        for i, out_arr in enumerate(out_features):
+            np.concatenate([features[i] for features, _, _ in unpacked], out=out_arr)
+        np.concatenate([weights for _, weights, _ in unpacked], out=out_weights)
+        np.concatenate([labels for _, _, labels in unpacked], out=out_labels)
+        return buffer
+
+    def take(self, buffer, indices):
+        """
+        Gather a subset of the events in a packed batch into a new packed batch
+        :param buffer: A packed batch
+        :param indices: An array of the indices of the events to take - in the order they should appear in the output
+        :return: A packed batch
+        """
+        features, weights, labels = self.unpack(buffer)
+        out = self.allocate(len(indices))
+        out_features, out_weights, out_labels = self.unpack(out)
+        for arr, out_arr in zip(features, out_features):
+            np.take(arr, indices, axis=0, out=out_arr)
+        np.take(weights, indices, out=out_weights)
+        np.take(labels, indices, out=out_labels)
+        return out
@@ -0,0 +1,314 @@
+"""
+BitmapIndex Class Definition
+________________________________________________________________________________________________________________________
+A persistent set of bitmap indexes for each NTuple, so that a selection can be resolved to a list of entries without
+reading any data. Each indexed branch is split into a set of disjoint bitmaps, one bit per entry:
+    - categorical branches (truth decay mode and prong) have a bitmap for every value in the file
+    - binned branches (pT and eta) have a bitmap for the entries lying exactly on each bin edge, one for the entries
+      strictly inside each bin and one for NaN. The bin edges include the thresholds of the standard cuts, so those
+      cuts are resolved exactly
+A cut string is evaluated on the bitmaps with the same expression as the cut itself (see Predicate). Every comparison
+gives the entries which surely pass and those which might pass - they only differ if a threshold lies inside a bin.
+If they differ, or the cut uses a branch which is not indexed, the bitmaps cannot resolve the cut and the caller reads
+the cut branches as usual. The sample label of an entry is that of its file, so selecting samples just selects files
+(see BitmapIndex.select())
+The bitmaps are packed eight entries to a byte and written with np.savez_compressed, so runs of zeros - most of every
+bitmap - take next to no space. Files are keyed on their path and modification time like the NTupleIndex records
+"""
+
+import os
+import json
+import hashlib
+import operator
+import threading
+import numpy as np
+import uproot
+from scripts.utils import logger
+from scripts.NTupleIndex import NTupleIndex
+from scripts.NTupleReader import Predicate, PartialMask
+from config.config import index_dir
+
+
+class _Column:
+    """
+    The bitmaps of one branch over a range of entries. Comparing it with a number gives a PartialMask
+    """
+
+    def __init__(self, bitmaps, branch, entry_start, entry_stop):
+        self._bitmaps = bitmaps
+        self._branch = branch
+        self._entry_start = entry_start
+        self._entry_stop = entry_stop
+
+    def _union(self, names):
+        bits = np.zeros(self._entry_stop - self._entry_start, dtype=bool)
+        for name in names:
+            bits |= self._bitmaps.bits(self._branch, name, self._entry_start, self._entry_stop)
+        return bits
+
+    def _compare(self, op, value):
+        # Returning NotImplemented would make == and != fall back to an identity check giving a plain bool
+        if isinstance(value, (_Column, PartialMask)):
+            raise TypeError("Bitmaps can only compare a branch with a number")
+        value = float(value)
+        kind, values = self._bitmaps.column(self._branch)
+        if kind == "categorical":
+            bits = self._union(str(v) for v in values if op(v, value))
+            return PartialMask(bits, bits)
+
+        # Entries lying on an edge are compared exactly, entries inside a bin may or may not pass if the bin straddles
+        # the threshold and NaN only passes !=
+        sure = [f"edge{i}" for i, edge in enumerate(values) if op(edge, value)]
+        maybe = []
+        for i, (low, high) in enumerate(zip(values[:-1], values[1:])):
+            if low < value < high:
+                maybe.append(f"bin{i}")
+            elif op(np.nextafter(value, np.inf if value <= low else -np.inf), value):
+                # Every entry inside the bin compares to the threshold as any other number on the same side of it
+                sure.append(f"bin{i}")
+        if op is operator.ne:
+            sure.append("nan")
+        sure = self._union(sure)
+        return PartialMask(sure, sure | self._union(maybe))
+
+    def __lt__(self, value):
+        return self._compare(operator.lt, value)
+
+    def __le__(self, value):
+        return self._compare(operator.le, value)
+
+    def __gt__(self, value):
+        return self._compare(operator.gt, value)
+
+    def __ge__(self, value):
+        return self._compare(operator.ge, value)
+
+    def __eq__(self, value):
+        return self._compare(operator.eq, value)
+
+    def __ne__(self, value):
+        return self._compare(operator.ne, value)
+
+    __hash__ = None
+
+
+class FileBitmaps:
+    """
+    The bitmaps of a single file, kept packed in memory
+    """
+
+    def __init__(self, num_entries, columns, packed):
+        """
+        :param num_entries: Number of entries in the file
+        :param columns: A dict mapping branches to (kind, values) - kind is either "categorical", with the values found
+        in the file, or "binned", with the bin edges
+        :param packed: A dict mapping "<branch>/<bitmap name>" to a bitmap packed with np.packbits
+        """
+        self.num_entries = num_entries
+        self.columns = columns
+        self._packed = packed
+
+    def column(self, branch):
+        return self.columns[branch]
+
+    def bits(self, branch, name, entry_start, entry_stop):
+        """
+        Unpack part of a bitmap. Only the bytes covering the entries are unpacked
+        :return: A boolean array of length entry_stop - entry_start
+        """
+        packed = self._packed.get(f"{branch}/{name}")
+        if packed is None:
+            return np.zeros(entry_stop - entry_start, dtype=bool)
+        offset = entry_start % 8
+        bits = np.unpackbits(packed[entry_start // 8: (entry_stop + 7) // 8])
+        return bits[offset: offset + entry_stop - entry_start].astype(bool)
+
+
+class BitmapIndex:
+
+    # Branches with a bitmap for each value
+    categorical_branches = ("TauJets.truthDecayMode", "TauJets.truthProng")
+
+    # Branches with a bitmap for each bin - the edges include the thresholds of the cuts in config.config.get_cuts()
+    binned_branches = {"TauJets.ptJetSeed": (-np.inf, 0, 15000.0, 20000.0, 25000.0, 30000.0, 40000.0, 50000.0, 60000.0,
+                                             80000.0, 100000.0, 150000.0, 200000.0, 300000.0, 500000.0, 1000000.0,
+                                             10000000.0, np.inf),
+                       "TauJets.etaJetSeed": (-np.inf, -2.5, -2.47, -1.52, -1.37, -1.0, -0.5, 0, 0.5, 1.0, 1.37, 1.52,
+                                              2.47, 2.5, np.inf)}
+
+    # Branch of the truth decay mode - counted for NTupleIndex selections
+    decay_mode_branch = "TauJets.truthDecayMode"
+
+    def __init__(self, directory=None, index=None):
+        """
+        Constructor for the BitmapIndex
+        :param directory (optional, default=None): Directory to persist the bitmaps to - a bitmaps directory inside
+        config.config.index_dir if None
+        :param index (optional, default=None): An NTupleIndex to get the number of entries of each file from
+        """
+        self.directory = directory if directory is not None else os.path.join(index_dir, "bitmaps")
+        self._index = index if index is not None else NTupleIndex()
+        self._files = {}
+        self._predicates = {}
+        spec = {"categorical": list(self.categorical_branches),
+                "binned": {branch: [str(edge) for edge in edges] for branch, edges in self.binned_branches.items()}}
+        self._spec_digest = hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+    def _bitmap_file(self, file):
+        key = hashlib.sha1(os.path.abspath(file).encode()).hexdigest()
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def _build(self, file, record):
+        """
+        Read the indexed branches of a file and make its bitmaps
+        :return: A FileBitmaps
+        """
+        logger.log(f"Building bitmap index of {file}", 'DEBUG')
+        with uproot.open(file) as ntuple:
+            tree = ntuple[record["tree"]]
+            branches = [branch for branch in self.categorical_branches + tuple(self.binned_branches)
+                        if branch in tree.keys()]
+            arrays = tree.arrays(filter_name=branches, library='np')
+
+        columns = {}
+        packed = {}
+        for branch in branches:
+            data = arrays[branch]
+            if branch in self.categorical_branches:
+                values = np.unique(data)
+                columns[branch] = ("categorical", [v.item() for v in values])
+                for value in values:
+                    packed[f"{branch}/{value.item()}"] = np.packbits(data == value)
+            else:
+                edges = np.array(self.binned_branches[branch], dtype=np.float64)
+                data = data.astype(np.float64)
+                columns[branch] = ("binned", edges.tolist())
+                position = np.searchsorted(edges, data, side='left')
+                on_edge = (position < len(edges)) & (edges[np.minimum(position, len(edges) - 1)] == data)
+                for i in range(0, len(edges)):
+                    packed[f"{branch}/edge{i}"] = np.packbits(on_edge & (position == i))
+                for i in range(0, len(edges) - 1):
+                    packed[f"{branch}/bin{i}"] = np.packbits(~on_edge & (position == i + 1))
+                packed[f"{branch}/nan"] = np.packbits(np.isnan(data))
+        return FileBitmaps(record["num_entries"], columns, packed)
+
+    def _save(self, file, record, bitmaps):
+        os.makedirs(self.directory, exist_ok=True)
+        meta = {"path": record["path"], "mtime": record["mtime"], "spec": self._spec_digest,
+                "num_entries": bitmaps.num_entries, "columns": bitmaps.columns}
+        bitmap_file = self._bitmap_file(file)
+        tmp_file = f"{bitmap_file}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez_compressed(tmp_file, meta=np.array(json.dumps(meta)), **bitmaps._packed)
+        os.replace(tmp_file, bitmap_file)
+
+    def bitmaps(self, file):
+        """
+        Get the bitmaps of a file. They are built (reading only the indexed branches) if there are none on disk or the
+        file has been modified since they were made
+        :param file: File path to an NTuple
+        :return: A FileBitmaps
+        """
+        record = self._index.record(file)
+        bitmaps = self._files.get(file)
+        if bitmaps is not None and bitmaps.mtime == record["mtime"]:
+            return bitmaps
+        bitmaps = None
+        if os.path.isfile(self._bitmap_file(file)):
+            with np.load(self._bitmap_file(file)) as stored:
+                meta = json.loads(str(stored["meta"]))
+                if meta["path"] == record["path"] and meta["mtime"] == record["mtime"] \
+                        and meta["spec"] == self._spec_digest:
+                    columns = {branch: tuple(column) for branch, column in meta["columns"].items()}
+                    bitmaps = FileBitmaps(meta["num_entries"], columns,
+                                          {name: stored[name] for name in stored.files if name != "meta"})
+        if bitmaps is None:
+            bitmaps = self._build(file, record)
+            self._save(file, record, bitmaps)
+        bitmaps.mtime = record["mtime"]
+        self._files[file] = bitmaps
+        return bitmaps
+
+    def _predicate(self, cuts):
+        if isinstance(cuts, Predicate):
+            return cuts
+        if cuts not in self._predicates:
+            self._predicates[cuts] = Predicate(cuts)
+        return self._predicates[cuts]
+
+    def mask(self, file, cuts, entry_start=0, entry_stop=None):
+        """
+        Resolve a cut to the entries passing it from the bitmaps alone
+        :param file: File path to an NTuple
+        :param cuts: A cut string (or a Predicate) - None for no cuts
+        :param entry_start (optional, default=0): First entry
+        :param entry_stop (optional, default=None): One past the last entry - the end of the file if None
+        :return: A boolean array, True for the entries in [entry_start, entry_stop) passing the cut, or None if the
+        bitmaps cannot resolve the cut
+        """
+        bitmaps = self.bitmaps(file)
+        entry_stop = bitmaps.num_entries if entry_stop is None else entry_stop
+        if not cuts:
+            return np.ones(entry_stop - entry_start, dtype=bool)
+        predicate = self._predicate(cuts)
+        if any(branch not in bitmaps.columns for branch in predicate.branches):
+            return None
+        columns = {branch: _Column(bitmaps, branch, entry_start, entry_stop) for branch in predicate.branches}
+        try:
+            result = predicate.evaluate(columns)
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(result, PartialMask) or not result.exact():
+            return None
+        return result.sure
+
+    def entries(self, file, cuts=None):
+        """
+        Get the entries of a file passing a cut. If the bitmaps cannot resolve the cut the cut branches are read
+        :param file: File path to an NTuple
+        :param cuts (optional, default=None): A cut string
+        :return: An int64 array of entry numbers
+        """
+        mask = self.mask(file, cuts)
+        if mask is None:
+            predicate = self._predicate(cuts)
+            with uproot.open(file) as ntuple:
+                arrays = ntuple[self._index.record(file)["tree"]].arrays(filter_name=predicate.branches, library='np')
+            mask = predicate(arrays)
+        return np.flatnonzero(mask).astype(np.int64)
+
+    def selection(self, file, cuts=None):
+        """
+        Count the entries passing a cut, and the passing entries in each decay mode, from the bitmaps - in the format of
+        NTupleIndex.selection()
+        :param file: File path to an NTuple
+        :param cuts (optional, default=None): A cut string
+        :return: A dict of the form {"num_passing": int, "decay_mode_counts": {"0": int, "1": int ...}} or None if the
+        bitmaps cannot resolve the cut or the file has no decay mode branch
+        """
+        mask = self.mask(file, cuts)
+        bitmaps = self.bitmaps(file)
+        if mask is None or self.decay_mode_branch not in bitmaps.columns:
+            return None
+        counts = {}
+        for value in bitmaps.column(self.decay_mode_branch)[1]:
+            count = int(np.count_nonzero(mask & bitmaps.bits(self.decay_mode_branch, str(value), 0, len(mask))))
+            if count > 0:
+                counts[str(int(value))] = count
+        return {"num_passing": int(np.count_nonzero(mask)), "decay_mode_counts": counts}
+
+    def select(self, file_handlers, cuts=None, labels=None):
+        """
+        Resolve a selection over several samples to lists of entries
+        :param file_handlers: A list of FileHandler objects
+        :param cuts (optional, default=None): Either a cut string applied to every sample or a dict mapping sample
+        labels to cut strings e.g. config.config.get_cuts()
+        :param labels (optional, default=None): Sample labels to select - every sample if None
+        :return: A dict mapping each selected sample label to a dict mapping its files to their passing entries
+        """
+        selected = {}
+        for file_handler in file_handlers:
+            if labels is not None and file_handler.label not in labels:
+                continue
+            fh_cuts = cuts.get(file_handler.label) if isinstance(cuts, dict) else cuts
+            selected[file_handler.label] = {file: self.entries(file, fh_cuts) for file in file_handler.file_list}
+        return selected
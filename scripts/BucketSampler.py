@@ -0,0 +1,89 @@
+"""
+BucketSampler Class Definition
+________________________________________________________________________________________________________________________
+Dynamic padding of the nested features. The DataLoaders pad every event to max_items objects of each type, but most
+events have far fewer objects (see scripts/MultiplicityProfiler.py) so most of the work done on a padded batch is done
+on padding. The BucketSampler groups the events of a super-batch into buckets of similar multiplicity and then serves
+each batch padded only to the largest multiplicity in it.
+Dynamically padded features are served objects first - (events, objects, variables) rather than the (events, variables,
+max_items) of the packed batches - so that the objects axis can change from batch to batch. Models must be built with
+dynamic=True to take them (see model/models.py)
+"""
+
+import numpy as np
+
+
+class BucketSampler:
+
+    def __init__(self, layout, variable_handler, seed=None, dummy_val=-1):
+        """
+        Constructor for the BucketSampler
+        :param layout: The BatchLayout of the batches being sampled
+        :param variable_handler: The VariableHandler used to standardise the batches - needed to recognise the padding
+        :param seed (optional, default=None): Seed for the order of the buckets
+        :param dummy_val (optional, default=-1): Value the padding has before standardisation, and is given again once
+        the objects axis has been trimmed so that the models can mask it
+        """
+        self._rng = np.random.RandomState(seed)
+        self.dummy_val = dummy_val
+        # Index of each nested array in the features and its standardised padding value for each variable
+        self._nested = []
+        for i, (name, shape, dtype) in enumerate(layout.arrays[:len(layout.feature_names)]):
+            if len(shape) == 2:
+                padding = np.full((1, shape[0], 1), dummy_val, dtype=dtype)
+                variable_handler.standardise(name, padding)
+                self._nested.append((i, padding[0, :, 0]))
+
+    def present(self, features):
+        """
+        :param features: Standardised features of a batch in the packed layout - (events, variables, max_items) for the
+        nested types
+        :return: A list of boolean arrays of shape (events, max_items) marking the objects that are not padding - one
+        for each nested type
+        """
+        return [np.any(features[i] != padding[None, :, None], axis=1) for i, padding in self._nested]
+
+    def multiplicities(self, features):
+        """
+        :param features: Standardised features of a batch in the packed layout
+        :return: Array of shape (events, number of nested types) of the number of objects of each type in every event
+        """
+        return np.stack([present.sum(axis=1) for present in self.present(features)], axis=1)
+
+    def buckets(self, features, sizes, rng=None):
+        """
+        Sort the events of a batch by their multiplicities and cut them into buckets. Events are ordered by the number
+        of objects weighted by the number of variables of each type - roughly the work done on them - with ties broken
+        at random. Which bucket of sorted events goes in which slot is random, so the buckets come in a new order of
+        multiplicity every time
+        :param features: Standardised features of a batch in the packed layout
+        :param sizes: Number of events in each bucket - must sum to the number of events in the batch
+        :param rng (optional, default=None): A numpy RandomState - the sampler's own if None
+        :return: A list of arrays of event indices, one per bucket
+        """
+        rng = rng if rng is not None else self._rng
+        sizes = np.asarray(sizes, dtype=np.int64)
+        work = np.array([features[i].shape[1] for i, _ in self._nested])
+        key = self.multiplicities(features) @ work
+        order = np.lexsort((rng.random_sample(len(key)), key))
+
+        slots = rng.permutation(len(sizes))
+        buckets = [None] * len(sizes)
+        for slot, bucket in zip(slots, np.split(order, np.cumsum(sizes[slots])[:-1])):
+            buckets[slot] = bucket
+        return buckets
+
+    def pad(self, features):
+        """
+        Trim the nested features of a batch to the largest multiplicity in the batch. The nested arrays are transposed
+        to (events, objects, variables) and every padded object is set to dummy_val. At least one object is always kept
+        :param features: Standardised features of a batch in the packed layout
+        :return: The features with the nested arrays replaced by their dynamically padded copies
+        """
+        features = list(features)
+        for (i, _), present in zip(self._nested, self.present(features)):
+            nobjects = max(int(np.max(np.nonzero(present.any(axis=0))[0], initial=-1)) + 1, 1)
+            arr = np.ascontiguousarray(features[i][:, :, :nobjects].transpose(0, 2, 1))
+            arr[~present[:, :nobjects]] = self.dummy_val
+            features[i] = arr
+        return tuple(features)
@@ -0,0 +1,134 @@
+"""
+CacheBuilder Class Definition
+________________________________________________________________________________________________________________________
+Builds the shards of the tensor cache (see scripts/TensorCache.py) ahead of time, several files at once. Only shards
+that are missing - because a file is new or has been replaced, or because the cuts or storage options have changed - are
+built, so adding a file to a production only materializes that file. If variables have been added or changed only their
+columns are added to the existing shards. A shard is written to a temporary directory and only moved into place once
+it is complete, so an interrupted build is resumed by running it again
+Each shard is built by a single-file DataLoader in a worker process, so the shards are exactly those a DataLoader would
+have materialized itself
+"""
+
+import os
+import glob
+import time
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scripts.utils import logger
+from scripts.TensorCache import TensorCache
+from config.config import max_items_dict, sort_items_dict
+
+
+def _build_shard(data_type, file, class_label, variable_handler, loader_kwargs):
+    """
+    Materialize the shard of a single file by making a DataLoader for it. Runs in a worker process
+    :return: Number of events in the shard
+    """
+    from scripts.DataLoader import DataLoader
+    loader = DataLoader(data_type, [file], class_label, 1, variable_handler, label="CacheBuilder", **loader_kwargs)
+    return loader.num_events()
+
+
+class CacheBuilder:
+
+    def __init__(self, cache_dir, variable_handler, cuts=None, prong=None, reweighter=None, precision="full",
+                 compression=None, workers=1, batch_size=100000):
+        """
+        Constructor for the CacheBuilder
+        :param cache_dir: Directory of the tensor cache
+        :param variable_handler: A VariableHandler object holding the input variables
+        :param cuts (optional, default=None): A dict mapping data types to cut strings e.g. config.config.get_cuts()
+        :param prong (optional, default=None): Number of prongs - changes the labels
+        :param reweighter (optional, default=None): An instance of a reweighting class - used for the jet weights
+        :param precision (optional, default="full"): Either "full" or "reduced" - see TensorCache
+        :param compression (optional, default=None): Either None, "lz4" or "zstd" - see TensorCache
+        :param workers (optional, default=1): Number of shards to build at once, each in its own process
+        :param batch_size (optional, default=100000): Number of entries read from the NTuples at a time
+        """
+        self.cache_dir = cache_dir
+        self._variable_handler = variable_handler
+        self._cuts = cuts if cuts is not None else {}
+        self._prong = prong
+        self._reweighter = reweighter
+        self._precision = precision
+        self._compression = compression
+        self.workers = max(1, workers)
+        self._batch_size = batch_size
+
+    def shards(self, file_handlers):
+        """
+        Work out the shards of the cache needed for a set of samples
+        :param file_handlers: A list of FileHandler objects
+        :return: A list of (FileHandler, TensorCache) tuples - one per file
+        """
+        return [(file_handler, TensorCache(self.cache_dir, file_handler.label, file, self._variable_handler,
+                                           max_items_dict, cuts=self._cuts.get(file_handler.label), prong=self._prong,
+                                           precision=self._precision, compression=self._compression,
+                                           sort_items=sort_items_dict,
+                                           reweighter=self._reweighter if file_handler.class_label == 0 else None))
+                for file_handler in file_handlers for file in file_handler.file_list]
+
+    def missing(self, file_handlers):
+        """
+        :param file_handlers: A list of FileHandler objects
+        :return: A list of the (FileHandler, TensorCache) tuples whose shards have not been built or are missing columns
+        """
+        return [(file_handler, cache) for file_handler, cache in self.shards(file_handlers) if not cache.is_complete()]
+
+    def build(self, file_handlers):
+        """
+        Build every missing shard for a set of samples, logging the progress as each shard is finished
+        :param file_handlers: A list of FileHandler objects
+        :return: Number of shards built
+        """
+        shards = self.shards(file_handlers)
+        missing = [(file_handler, cache) for file_handler, cache in shards if not cache.is_complete()]
+        logger.log(f"Tensor cache has {len(shards) - len(missing)}/{len(shards)} shards - building {len(missing)} with "
+                   f"{self.workers} worker(s)", 'INFO')
+        if not missing:
+            return 0
+
+        loader_kwargs = {"cuts": None, "prong": self._prong, "reweighter": self._reweighter,
+                         "batch_size": self._batch_size, "cache_dir": self.cache_dir,
+                         "cache_precision": self._precision, "cache_compression": self._compression}
+        start_time = time.perf_counter()
+        nevents = 0
+        # Spawned rather than forked - see ProcessBackend in scripts/LoaderBackends.py
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = {}
+            for file_handler, cache in missing:
+                kwargs = dict(loader_kwargs, cuts=self._cuts.get(file_handler.label))
+                future = pool.submit(_build_shard, file_handler.label, cache.file, file_handler.class_label,
+                                     self._variable_handler, kwargs)
+                futures[future] = cache
+            for i, future in enumerate(as_completed(futures)):
+                nevents += future.result()
+                elapsed = time.perf_counter() - start_time
+                remaining = elapsed / (i + 1) * (len(missing) - i - 1)
+                logger.log(f"Built shard {i + 1}/{len(missing)} for {futures[future].file} - {nevents} events in "
+                           f"{elapsed:.0f} s, about {remaining:.0f} s left", 'INFO')
+        return len(missing)
+
+    def prune(self, file_handlers):
+        """
+        Delete the shards which are not needed by a set of samples, along with any partially written shards left behind
+        by an interrupted build, and the columns of variables which are no longer used from the shards that are kept.
+        Only the shards made with the same settings (cuts, prong and storage options) are looked at. Do not run this
+        while the cache is being built
+        :param file_handlers: A list of FileHandler objects - every sample that uses these settings
+        :return: Number of shards deleted
+        """
+        shards = self.shards(file_handlers)
+        needed = {cache.path for _, cache in shards}
+        pruned = 0
+        for directory in dict.fromkeys(cache.directory for _, cache in shards):
+            for path in glob.glob(os.path.join(directory, "*")):
+                if os.path.isdir(path) and path not in needed:
+                    logger.log(f"Deleting unused tensor cache shard {path}", 'DEBUG')
+                    shutil.rmtree(path)
+                    pruned += 1
+        pruned_columns = sum(cache.prune() for _, cache in shards if cache.exists())
+        logger.log(f"Deleted {pruned} unused tensor cache shard(s) and {pruned_columns} unused column file(s)", 'INFO')
+        return pruned
@@ -8,28 +8,51 @@ TODO: Make this generalisable to different problems
 
 import os
 import gc
-import ray  
 import math
+import time
+import threading
 import numpy as np
 import tensorflow as tf
-from scripts.DataLoader import DataLoader
+from scripts.LoaderBackends import backends_dict
+from scripts.NTupleIndex import NTupleIndex
+from scripts.BitmapIndex import BitmapIndex
+from scripts.BatchLayout import BatchLayout, one_hot
+from scripts.ReplayBuffer import ReplayBuffer
+from scripts.BucketSampler import BucketSampler
 from plotting.plotting_functions import plot_confusion_matrix, plot_ROC
 from scripts.utils import logger, profile_memory
-from config.config import models_dict
+from config.config import models_dict, max_items_dict
 from tqdm import tqdm
+from collections import deque, OrderedDict
+from concurrent.futures import Future
 
 
 class DataGenerator(tf.keras.utils.Sequence):
 
+    # Autoscaling - add a DataLoader if the trainer spends more than this fraction of an epoch waiting for batches...
+    scale_up_wait_fraction = 0.1
+
+    # ...and retire one if it spends less than this fraction waiting
+    scale_down_wait_fraction = 0.01
+
+    # Rough memory footprint of a DataLoader as a multiple of the size of the packed batches it returns
+    loader_memory_factor = 4
+
     def __init__(self, file_handler_list, variable_handler, batch_size=32, nbatches=500, cuts=None, label="DataGenerator", reweighter=None,
-                prong=None, no_gpu=False, _benchmark=False):
+                prong=None, no_gpu=False, cache_dir=None, pipeline="sequence", prefetch_depth=1, prefetch_bytes=None,
+                shards=1, autoscale=False, max_loaders=None, backend="ray", decompression_workers=1,
+                interpretation_workers=1, replay_bytes=None, replay_shuffle=True, replay_dir=None, deterministic=False,
+                shuffle_blocks=False, shuffle_buffer=0, seed=None, cache_precision="full", cache_compression=None,
+                dynamic_padding=False, bucketing=True, importance_sampling=False, sampling_floor=0.05, sampling_cap=1.0,
+                bitmap_index=False, _benchmark=False):
         """
         Class constructor for DataGenerator. Inherits from keras.utils.Sequence. When passed to model.fit(...) loads a
         batch of data from file for the network to train on. This avoids having to load large amounts of data into
         memory. To speed up I/O data can be read using multiple threads - this is achieved using the ray library (see:
         https://docs.ray.io/en/master/index.html). Each file stream is read in parallel by a DataLoader object which is
         instantiated on a new thread as a ray actor. The batches loaded by the DataLoaders are then gathered and
-        merged together by this class.
+        merged together by this class. The DataLoaders can instead be run in threads or processes without ray by
+        choosing a different backend (see scripts/LoaderBackends.py)
 
         :param file_handler_list: A list of FileHandler Objects (a utility class defined in utils.py), each FileHandler
         in the list will create a new ray actor to handle their files
@@ -43,6 +66,62 @@ class DataGenerator(tf.keras.utils.Sequence):
         :param reweighter: An instance of a reweighting class 
         :param prong: Number of prongs - either 1-prong with 4 classes, 3-prong with 3 classes or 1+3-prong for 6 classes
         :param no_gpu: If True will make TensorFlow use CPU rather than GPU - useful when creating multiple models  
+        :param cache_dir: If not None each DataLoader will materialize its padded tensors to a memory-mapped cache in
+        this directory (once) and then serve batches from the cache rather than re-reading the NTuples every epoch
+        :param pipeline: Input pipeline used by predict() - either "sequence" to call load_batch() directly or "tfdata"
+        to iterate over the tf.data.Dataset made by to_dataset()
+        :param prefetch_depth: Maximum number of super-batches (one batch from every DataLoader) to request ahead of
+        time. A deeper queue lets the fast DataLoaders keep working while a slow one catches up
+        :param prefetch_bytes: If not None, also limits the prefetch queue so that the super-batches held in ray's object
+        store take up no more than this many bytes. At least one super-batch is always requested
+        :param shards: Number of DataLoaders to split each FileHandler's files between, so that more cores can read and
+        decode a large sample. Either an int or "auto" to share the CPUs available to the backend between the
+        FileHandlers in proportion to their number of entries. Each sample contributes the same number of events per
+        batch however many shards it is split into, so the class mixing ratio does not change
+        :param autoscale: If True the number of shards of each sample is adjusted at the end of every epoch. If the
+        trainer spent too long waiting for batches a shard is added to the sample whose DataLoaders were most often late;
+        if it hardly waited at all a shard is retired. Not used with cache_dir - reading from the cache is cheap
+        :param max_loaders: Upper limit on the total number of DataLoaders when autoscaling. Defaults to the number of CPUs
+        available to the backend. New DataLoaders are also only added if there is enough free memory for them
+        :param backend: How to run the DataLoaders - a key of scripts.LoaderBackends.backends_dict. Either "ray" (ray
+        actors), "thread" (a thread per DataLoader) or "process" (a process per DataLoader)
+        :param decompression_workers: Number of threads each DataLoader uses to decompress the NTuple baskets
+        :param interpretation_workers: Number of threads each DataLoader uses to interpret decompressed baskets as arrays
+        :param replay_bytes: Memory budget in bytes for replaying the data from memory. If not None and the padded
+        dataset (estimated from the NTuple index) fits in the budget, the first epoch is recorded and later epochs are
+        replayed from memory (ray's object store with the ray backend), shuffling the events every epoch. Falls back to
+        streaming from the NTuples if the data turns out to be larger than the budget. "auto" uses half of the free memory
+        :param replay_shuffle: If False the replayed events are served in the order they were first read - e.g. to pin a
+        validation set in memory so that each validation pass is a pure forward pass
+        :param replay_dir: If not None the replayed data is written to a memory-mapped file in this directory rather than
+        held in memory
+        :param deterministic: If True batches are served from a batch plan worked out up front (see batch_plan()) so
+        that __getitem__(idx) always returns the same batch and can be called from several Keras worker threads at
+        once. Each batch holds a slice of every DataLoader's batch so the samples are mixed within every batch. Not
+        used with autoscale. With replay_bytes the DataLoaders' batches are kept in memory rather than replayed and
+        shuffled
+        :param shuffle_blocks: If True each DataLoader reads its steps (large contiguous blocks of entries) in a new
+        random order every epoch, so the reads stay sequential
+        :param shuffle_buffer: Number of events each DataLoader holds in a shuffle buffer to mix the events of different
+        steps. 0 turns the buffer off
+        :param seed: Seed for the block order and shuffle buffers. If None each run is shuffled differently
+        :param cache_precision: Either "full" to cache the features as float32 or "reduced" to cache each variable in
+        its storage dtype (see Variable.storage). Only used with cache_dir
+        :param cache_compression: Either None, "lz4" or "zstd" to block compress the cache. Only used with cache_dir
+        :param dynamic_padding: If True the nested features are served objects first, (events, objects, variables), and
+        padded only to the largest multiplicity in each batch rather than to max_items (see scripts/BucketSampler.py).
+        The model must be built with dynamic=True
+        :param bucketing: If True (and dynamic_padding is) the events of each super-batch are sorted into buckets of
+        similar multiplicity, one per batch, so that little padding is left. The batches are then no longer a fixed mix
+        of the samples, although every event is still served once an epoch. The tf.data pipeline is not bucketed
+        :param importance_sampling: If True the jets are importance sampled - each is kept with a probability
+        proportional to its pT re-weighting weight and its weight divided by that probability (see
+        scripts/ImportanceSampler.py) - so an epoch is made of far fewer jets. The jets kept change every epoch, except
+        with deterministic=True or when the epoch is replayed from memory
+        :param sampling_floor: Smallest probability of keeping a jet when importance sampling
+        :param sampling_cap: Largest probability of keeping a jet when importance sampling
+        :param bitmap_index: If True the cuts are resolved from the bitmap indexes of the NTuples (see
+        scripts/BitmapIndex.py) where they can be, rather than by reading the cut branches
         :param _benchmark: If set to True will return additional information when load_batch() is called. This will
         cause model.fit() to break and is only used for testing purposes
         """
@@ -62,55 +141,239 @@ class DataGenerator(tf.keras.utils.Sequence):
         self.__benchmark = _benchmark
         self.model = None
         self.prong = prong
+        self.pipeline = pipeline
         self._weights = ""
         self.batch_size = batch_size
         self.batch_position = 0
         self.batch = (([], [], [], [], []), [], [])
-        self.next_batch = (([], [], [], [], []), [], [])
-        self.first_batch = True
+        self._prefetch_depth = max(1, prefetch_depth)
+        self._prefetch_bytes = prefetch_bytes
+        self._prefetch_queue = deque()
+        self._reset_prefetch_stats()
 
         # Organise a list of all variables
         self._variable_handler = variable_handler
         self._variables_list = []
-
-        # Initialize ray actors from FileHandlers, variables_dict and cuts
+        self._layout = BatchLayout(variable_handler, max_items_dict)
+
+        # Work out how many DataLoaders to split each FileHandler between
+        self._backend = backends_dict[backend]()
+        index = NTupleIndex(bitmaps=BitmapIndex() if bitmap_index else None)
+        self._shards = self._shards_per_sample(shards, index)
+        self._deterministic = deterministic
+        self._sampler = BucketSampler(self._layout, variable_handler, seed=seed) if dynamic_padding else None
+        self._bucketing = dynamic_padding and bucketing
+        self._autoscale = autoscale and cache_dir is None and not deterministic
+        self._max_loaders = max_loaders
+        if self._autoscale and max_loaders is None:
+            self._max_loaders = self._backend.num_cpus()
+
+        # Initialize DataLoaders from FileHandlers, variables_dict and cuts
+        self._loader_kwargs = {"nbatches": nbatches, "variable_handler": variable_handler, "prong": prong,
+                               "reweighter": reweighter, "cache_dir": cache_dir,
+                               "decompression_workers": decompression_workers,
+                               "interpretation_workers": interpretation_workers, "shuffle_blocks": shuffle_blocks,
+                               "shuffle_buffer": shuffle_buffer, "seed": seed, "cache_precision": cache_precision,
+                               "cache_compression": cache_compression, "importance_sampling": importance_sampling,
+                               "sampling_floor": sampling_floor, "sampling_cap": sampling_cap,
+                               "bitmap_index": bitmap_index}
+        self._sample_loaders = {}
         for file_handler in self._file_handlers:
-            dl_label = f"{file_handler.label}_{self.label}"
-            file_list = file_handler.file_list
-            class_label = file_handler.class_label
             if cuts is not None and file_handler.label in cuts:
                 logger.log(f"Cuts applied to {file_handler.label}: {self.cuts[file_handler.label]}")
-
-                dl = DataLoader.remote(file_handler.label, file_list, class_label, nbatches, variable_handler, cuts=self.cuts[file_handler.label],
-                                                    label=label, prong=prong, reweighter=reweighter)
-                # dl = DataLoader(file_handler.label, file_list, class_label, nbatches, variable_handler, cuts=self.cuts[file_handler.label],
-                #                                     label=label, prong=prong, reweighter=reweighter)
-                self.data_loaders.append(dl)
-
-            else:
-                dl = DataLoader.remote(file_handler.label, file_list, class_label, nbatches, variable_handler, prong=prong, label=dl_label, reweighter=reweighter)
-                # dl = DataLoader(file_handler.label, file_list, class_label, nbatches, variable_handler, prong=prong, label=dl_label, reweighter=reweighter)
-                self.data_loaders.append(dl)
-
-        # Get number of events in each dataset
+            self._sample_loaders[file_handler.label] = self._make_loaders(file_handler, self._shards[file_handler.label])
+        self._collect_loaders()
+
+        # Get number of events in each dataset - answered from the NTuple index rather than by asking each DataLoader.
+        # If the jets are importance sampled only the fraction of them expected to be kept is counted
+        sampled_fractions = {}
+        if importance_sampling:
+            for loader_label, fraction in zip(self._loader_labels, self._call_loaders("sampled_fraction")):
+                sampled_fractions.setdefault(loader_label, []).append(fraction)
         self._total_num_events = 0
-        num_batches_list = []
-        for data_loader in self.data_loaders:
-            self._total_num_events = self._total_num_events + ray.get(data_loader.num_events.remote())
-            num_batches_list.append(ray.get(data_loader.number_of_batches.remote()))
-            # self._total_num_events = self._total_num_events + data_loader.num_events()
-            # num_batches_list.append(data_loader.number_of_batches())
+        for file_handler in self._file_handlers:
+            fh_cuts = self.cuts[file_handler.label] if cuts is not None and file_handler.label in cuts else None
+            num_events = index.num_events(file_handler.file_list, cuts=fh_cuts)
+            self._total_num_events += round(num_events * np.mean(sampled_fractions.get(file_handler.label, [1.0])))
+        self._loader_num_batches = self._call_loaders("number_of_batches")
         logger.log(f"{self.label} - Found {self._total_num_events} events total", "INFO")
 
         # Work out how many batches to split the data into
-        self._num_batches = min(num_batches_list)
+        self._num_batches = min(self._loader_num_batches)
+
+        # Estimate the size of a super-batch for the prefetch queue - updated with the true size once batches arrive
+        self._superbatch_nbytes = self._layout.nbytes(math.ceil(self._total_num_events / nbatches))
+
+        # Keep the first epoch in memory if the whole padded dataset fits in the replay budget
+        self._replay = None
+        if replay_bytes == "auto":
+            free_memory = self._free_memory()
+            replay_bytes = free_memory // 2 if free_memory is not None else None
+        if replay_bytes is not None:
+            dataset_nbytes = self._layout.nbytes(self._total_num_events)
+            if dataset_nbytes <= replay_bytes:
+                self._replay = ReplayBuffer(self._layout, replay_bytes, label=self.label, shuffle=replay_shuffle,
+                                            directory=replay_dir)
+                plan = "keeping every batch" if deterministic else "recording the first epoch to replay from"
+                logger.log(f"{self.label} - Dataset is roughly {dataset_nbytes / 1e6:.0f} MB - {plan} memory", 'INFO')
+            else:
+                logger.log(f"{self.label} - Dataset is roughly {dataset_nbytes / 1e6:.0f} MB which does not fit in the "
+                           f"replay budget of {replay_bytes / 1e6:.0f} MB - streaming every epoch", 'INFO')
+
+        # Work out the batch plan - each super-batch (one batch from every DataLoader) is split into _plan_parts batches
+        self._plan_parts = max(1, round(self._total_num_events / (self._num_batches * batch_size)))
+        self._plan_order = np.arange(self._num_batches)
+        self._plan_lock = threading.Lock()
+        self._plan_cache = OrderedDict()
+        self._plan_cache_size = self._prefetch_depth + 2
+        # With a replay budget every DataLoader batch the plan loads is kept (standardised) so it is only loaded once
+        self._plan_batches = {} if self._replay is not None else None
 
         # Work out number of classes
         self._nclasses = 6
         if prong == 1:
             self._nclasses = 4
         if prong == 3:
-            self.nclasses = 3
+            self._nclasses = 3
+
+    def _shards_per_sample(self, shards, index):
+        """
+        Work out how many DataLoaders each FileHandler is split between
+        :param shards: Either an int (the same for every FileHandler) or "auto" to share out the CPUs available to the backend
+        in proportion to the number of entries in each FileHandler's files
+        :param index: An NTupleIndex
+        :return: A dict mapping FileHandler labels to number of shards
+        """
+        if shards != "auto":
+            return {file_handler.label: max(1, int(shards)) for file_handler in self._file_handlers}
+        ncpus = self._backend.num_cpus()
+        num_entries = {file_handler.label: index.num_entries(file_handler.file_list) for file_handler in self._file_handlers}
+        total_entries = max(sum(num_entries.values()), 1)
+        shards_dict = {label: max(1, round(ncpus * n / total_entries)) for label, n in num_entries.items()}
+        logger.log(f"{self.label} - Sharding {ncpus} CPUs between samples: {shards_dict}", 'INFO')
+        return shards_dict
+
+    def _make_loaders(self, file_handler, nshards):
+        """
+        Start the DataLoader actors serving a FileHandler
+        :param file_handler: A FileHandler
+        :param nshards: Number of DataLoaders to split the FileHandler's files between
+        :return: A list of DataLoader actors
+        """
+        fh_cuts = None
+        if self.cuts is not None and file_handler.label in self.cuts:
+            fh_cuts = self.cuts[file_handler.label]
+        data_loaders = []
+        for shard_index in range(0, nshards):
+            dl_label = f"{file_handler.label}_{self.label}"
+            shard = None
+            if nshards > 1:
+                dl_label = f"{dl_label}_shard{shard_index}"
+                shard = (shard_index, nshards)
+            kwargs = self._loader_kwargs
+            seed = None if kwargs["seed"] is None else kwargs["seed"] + shard_index
+            dl = self._backend.start(file_handler.label, file_handler.file_list, file_handler.class_label,
+                                     kwargs["nbatches"], kwargs["variable_handler"], cuts=fh_cuts, prong=kwargs["prong"],
+                                     label=dl_label, reweighter=kwargs["reweighter"], cache_dir=kwargs["cache_dir"],
+                                     shard=shard, decompression_workers=kwargs["decompression_workers"],
+                                     interpretation_workers=kwargs["interpretation_workers"],
+                                     shuffle_blocks=kwargs["shuffle_blocks"], shuffle_buffer=kwargs["shuffle_buffer"],
+                                     seed=seed, cache_precision=kwargs["cache_precision"],
+                                     cache_compression=kwargs["cache_compression"],
+                                     importance_sampling=kwargs["importance_sampling"],
+                                     sampling_floor=kwargs["sampling_floor"], sampling_cap=kwargs["sampling_cap"],
+                                     bitmap_index=kwargs["bitmap_index"])
+            data_loaders.append(dl)
+        return data_loaders
+
+    def _collect_loaders(self):
+        """
+        Rebuild the flat list of DataLoaders (and the sample each one belongs to) in FileHandler order
+        """
+        self.data_loaders = []
+        self._loader_labels = []
+        for file_handler in self._file_handlers:
+            self.data_loaders.extend(self._sample_loaders[file_handler.label])
+            self._loader_labels.extend([file_handler.label] * len(self._sample_loaders[file_handler.label]))
+
+    def _call_loaders(self, method, *args, **kwargs):
+        """
+        Call a method of every DataLoader and wait for the results
+        :param method: Name of the DataLoader method to call
+        :return: A list of the results, one per DataLoader
+        """
+        return self._backend.get([self._backend.submit(dl, method, *args, **kwargs) for dl in self.data_loaders])
+
+    def _reshard(self, file_handler, nshards):
+        """
+        Replace the DataLoaders serving a FileHandler with a new set of nshards DataLoaders. Any prefetched batches are
+        thrown away since they may belong to the retired DataLoaders
+        :param file_handler: A FileHandler
+        :param nshards: New number of shards
+        """
+        while self._prefetch_queue:
+            self._backend.release(self._prefetch_queue.popleft())
+        for data_loader in self._sample_loaders[file_handler.label]:
+            self._backend.stop(data_loader)
+        self._shards[file_handler.label] = nshards
+        self._sample_loaders[file_handler.label] = self._make_loaders(file_handler, nshards)
+        self._collect_loaders()
+        self._loader_num_batches = self._call_loaders("number_of_batches")
+        self._num_batches = min(self._loader_num_batches)
+
+    @staticmethod
+    def _free_memory():
+        """
+        :return: Free physical memory on this node in bytes or None if it can't be found
+        """
+        try:
+            return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (ValueError, OSError, AttributeError):
+            return None
+
+    def autoscale(self):
+        """
+        Adjust the number of DataLoaders serving each sample using the prefetch statistics of the last epoch. The
+        fraction of the epoch spent waiting for batches decides whether to add or retire a DataLoader and how often each
+        sample's DataLoaders were late decides which sample. At most one DataLoader is added or retired per epoch
+        """
+        stats = self._prefetch_stats
+        if not self._autoscale or stats["requests"] == 0 or (self._replay is not None and self._replay.is_ready()):
+            return
+        epoch_time = time.perf_counter() - stats["start_time"]
+        wait_fraction = stats["wait_time"] / epoch_time
+        lateness = {fh.label: stats["not_ready"].get(fh.label, 0) / (stats["requests"] * self._shards[fh.label])
+                    for fh in self._file_handlers}
+
+        if wait_fraction > self.scale_up_wait_fraction:
+            file_handler = max(self._file_handlers, key=lambda fh: lateness[fh.label])
+            nshards = self._shards[file_handler.label]
+            loader_nbytes = self._superbatch_nbytes / len(self.data_loaders) * self.loader_memory_factor
+            free_memory = self._free_memory()
+            if lateness[file_handler.label] == 0:
+                decision = "no sample was late - not scaling"
+            elif len(self.data_loaders) >= self._max_loaders:
+                decision = f"already at the limit of {self._max_loaders} DataLoaders - not scaling"
+            elif free_memory is not None and free_memory < (nshards + 1) * loader_nbytes:
+                decision = f"only {free_memory / 1e6:.0f} MB of memory free - not scaling"
+            else:
+                self._reshard(file_handler, nshards + 1)
+                decision = f"{file_handler.label} scaled up from {nshards} to {nshards + 1} DataLoaders"
+        elif wait_fraction < self.scale_down_wait_fraction:
+            candidates = [fh for fh in self._file_handlers if self._shards[fh.label] > 1]
+            if not candidates:
+                decision = "every sample has one DataLoader - not scaling"
+            else:
+                file_handler = min(candidates, key=lambda fh: (lateness[fh.label], -self._shards[fh.label]))
+                nshards = self._shards[file_handler.label]
+                self._reshard(file_handler, nshards - 1)
+                decision = f"{file_handler.label} scaled down from {nshards} to {nshards - 1} DataLoaders"
+        else:
+            decision = "keeping current DataLoaders"
+
+        lateness_str = ", ".join(f"{label}: {100 * late:.0f}%" for label, late in lateness.items())
+        logger.log(f"{self.label} - Autoscaling: waited {100 * wait_fraction:.1f}% of the epoch, "
+                   f"DataLoaders late - {lateness_str} - {decision}", 'INFO')
 
     def load_batch(self, shuffle_var=None):
         """
@@ -130,67 +393,321 @@ class DataGenerator(tf.keras.utils.Sequence):
         if self.batch_position == 0 or self.batch_position > len(self.batch[1]):
             self.batch_position = 0
             # logger.log(f"{self.batch_position} == 0 or {self.batch_position} > {len(self.batch[1])}")
-            if self.first_batch:
-                self.first_batch = False
-                batch = ray.get([dl.get_batch.remote() for dl in self.data_loaders])
-                self.next_batch = [dl.get_batch.remote() for dl in self.data_loaders]
-            else:
-                batch = ray.get(self.next_batch)
-                self.next_batch = [dl.get_batch.remote() for dl in self.data_loaders]
-            # self.next_batch = [dl.get_batch.remote() for dl in self.data_loaders]
+            buffer = self._next_buffer(record=shuffle_var is None)
+            if self._bucketing:
+                # Reorder the super-batch so that each slice of batch_size events is a bucket
+                nfull, remainder = divmod(self._layout.num_events(buffer), self.batch_size)
+                sizes = [self.batch_size] * nfull + [remainder]
+                buckets = self._sampler.buckets(self._layout.unpack(buffer)[0], sizes)
+                buffer = self._layout.take(buffer, np.concatenate(buckets))
             # logger.log("Loaded new batch")
             # batch = [dl.get_batch() for dl in self.data_loaders]
 
-            track_array = np.concatenate([result[0][0] for result in batch]).astype("float32")
-            neutral_pfo_array = np.concatenate([result[0][1] for result in batch]).astype("float32")
-            shot_pfo_array = np.concatenate([result[0][2] for result in batch]).astype("float32")
-            conv_track_array = np.concatenate([result[0][3] for result in batch]).astype("float32")
-            jet_array = np.concatenate([result[0][4] for result in batch]).astype("float32")
-            label_array = np.concatenate([result[1] for result in batch]).astype("int32")
-            weight_array = np.concatenate([result[2] for result in batch]).astype("float32")
-
-            for i, variable in enumerate(self._variable_handler.get("TauTracks")):
-                track_array[:, i] = variable.standardise(track_array[:, i])
-            for i, variable in enumerate(self._variable_handler.get("ConvTrack")):
-                conv_track_array[:, i] = variable.standardise(conv_track_array[:, i])
-            for i, variable in enumerate(self._variable_handler.get("NeutralPFO")):
-                neutral_pfo_array[:, i] = variable.standardise(neutral_pfo_array[:, i])
-            for i, variable in enumerate(self._variable_handler.get("ShotPFO")):
-                shot_pfo_array[:, i] = variable.standardise(shot_pfo_array[:, i])
-            for i, variable in enumerate(self._variable_handler.get("TauJets")):
-                jet_array[:, i] = variable.standardise(jet_array[:, i])
-
-            if shuffle_var is not None:
-                if shuffle_var[0] == "TauJets":
-                    np.random.shuffle(jet_array[:, shuffle_var[1]])
-                if shuffle_var[0] == "TauTracks":
-                    np.random.shuffle(track_array[:, shuffle_var[1]])
-                if shuffle_var[0] == "ConvTrack":
-                    np.random.shuffle(conv_track_array[:, shuffle_var[1]])
-                if shuffle_var[0] == "ShotPFO":
-                    np.random.shuffle(shot_pfo_array[:, shuffle_var[1]])
-                if shuffle_var[0] == "NeutralPFO":
-                    np.random.shuffle(neutral_pfo_array[:, shuffle_var[1]])
-
-            load_time = logger.log_time(f"{self.label}: Processed batch {self._current_index}/{self.__len__()} - {len(label_array)} events", "DEBUG")
-            self.batch = (track_array, neutral_pfo_array, shot_pfo_array, conv_track_array, jet_array), label_array, weight_array
+            self.batch = self._unpack(buffer, shuffle_var=shuffle_var)
+            load_time = logger.log_time(f"{self.label}: Processed batch {self._current_index}/{self.__len__()} - {len(self.batch[1])} events", "DEBUG")
             
             # return (track_array, neutral_pfo_array, shot_pfo_array, conv_track_array, jet_array), label_array, weight_array
 
 
         try:
-            return ((self.batch[0][0][self.batch_position: self.batch_position + self.batch_size],
+            return self._pad(((self.batch[0][0][self.batch_position: self.batch_position + self.batch_size],
                     self.batch[0][1][self.batch_position: self.batch_position + self.batch_size],
                     self.batch[0][2][self.batch_position: self.batch_position + self.batch_size],
                     self.batch[0][3][self.batch_position: self.batch_position + self.batch_size],
                     self.batch[0][4][self.batch_position: self.batch_position + self.batch_size]),
                     self.batch[1][self.batch_position: self.batch_position + self.batch_size],
-                    self.batch[2][self.batch_position: self.batch_position + self.batch_size])
+                    self.batch[2][self.batch_position: self.batch_position + self.batch_size]))
         finally:
             self.batch_position += self.batch_size  
             # logger.log(f"self.batch_position = {self.batch_position:}")
 
 
+    def _fill_prefetch_queue(self):
+        """
+        Requests super-batches (one batch from every DataLoader) until the prefetch queue is full. The queue is bounded
+        by both the number of super-batches (prefetch_depth) and, if set, the number of bytes they will take up in ray's
+        object store (prefetch_bytes). There is always at least one super-batch in flight
+        """
+        while len(self._prefetch_queue) < self._prefetch_depth:
+            if self._prefetch_queue and self._prefetch_bytes is not None \
+                    and (len(self._prefetch_queue) + 1) * self._superbatch_nbytes > self._prefetch_bytes:
+                break
+            self._prefetch_queue.append([self._backend.submit(dl, "get_batch") for dl in self.data_loaders])
+
+    def _next_superbatch(self):
+        """
+        Takes the oldest super-batch off the prefetch queue, waits for it and tops the queue back up. Records how full
+        the queue was, whether the super-batch was already waiting for us and which DataLoaders were not
+        :return: A list of packed batches, one per DataLoader
+        """
+        self._fill_prefetch_queue()
+        stats = self._prefetch_stats
+        stats["requests"] += 1
+        stats["occupancy"] += len(self._prefetch_queue)
+        refs = self._prefetch_queue.popleft()
+
+        ready = self._backend.ready(refs)
+        if len(ready) == len(refs):
+            stats["ready"] += 1
+        else:
+            ready = set(ready)
+            for loader_label, ref in zip(self._loader_labels, refs):
+                if ref not in ready:
+                    stats["not_ready"][loader_label] = stats["not_ready"].get(loader_label, 0) + 1
+
+        start_time = time.perf_counter()
+        buffers = self._backend.get(refs)
+        stats["wait_time"] += time.perf_counter() - start_time
+
+        self._superbatch_nbytes = max(self._superbatch_nbytes, sum(buffer.nbytes for buffer in buffers))
+        self._fill_prefetch_queue()
+        return buffers
+
+    def _next_buffer(self, record=True):
+        """
+        Get the next standardised super-batch, either replayed from memory or streamed from the DataLoaders. While the
+        first epoch is being recorded for replay streamed super-batches are kept by the replay buffer
+        :param record (optional, default=True): If False the super-batch is not recorded - e.g. when a variable will be
+        shuffled in place for permutation ranking
+        :return: A packed batch
+        """
+        if self._replay is not None and self._replay.is_ready():
+            return self._replay.next()
+        buffer = self._standardise(self._layout.concatenate(self._next_superbatch()))
+        if record and self._replay is not None:
+            self._replay.record(buffer)
+        return buffer
+
+    def batch_plan(self, idx):
+        """
+        Look up where a batch comes from when deterministic=True. Batch idx is part j (of _plan_parts) of super-batch k,
+        where super-batch k is made of one batch from every DataLoader (see _superbatch_steps). From each DataLoader's
+        batch of n events it takes the events in [j * n // _plan_parts, (j + 1) * n // _plan_parts). The order of the
+        super-batches is shuffled every epoch with the epoch number as the seed, so the plan is the same on every run
+        :param idx: Index of the batch
+        :return: The super-batch index k and the part j
+        """
+        if not 0 <= idx < len(self):
+            raise IndexError(f"{self.label} - batch {idx} is out of range for {len(self)} batches")
+        position, j = divmod(idx, self._plan_parts)
+        return int(self._plan_order[position]), j
+
+    def _superbatch_steps(self, k):
+        """
+        Work out which batch of each DataLoader makes up super-batch k in this epoch. DataLoaders can have different
+        numbers of batches (their steps are aligned to clusters and sharded) while an epoch has as many super-batches as
+        the DataLoader with the fewest. Like the streamed batches, each DataLoader carries on from where it left off in
+        the last epoch and wraps around, so every batch is served in turn
+        :param k: Index of the super-batch
+        :return: A tuple of the index of the batch to load from each DataLoader
+        """
+        position = self._epochs * self._num_batches + k
+        return tuple(position % num_batches for num_batches in self._loader_num_batches)
+
+    def _planned_loader_batches(self, steps):
+        """
+        Load the standardised batches of a super-batch from the DataLoaders, using the kept batches if there are any
+        :param steps: The index of the batch to load from each DataLoader - see _superbatch_steps()
+        :return: A list of standardised packed batches, one per DataLoader
+        """
+        kept = {} if self._plan_batches is None else self._plan_batches
+        missing = [i for i, step in enumerate(steps) if (i, step) not in kept]
+        loaded = self._backend.get([self._backend.submit(self.data_loaders[i], "get_batch_at", steps[i])
+                                    for i in missing])
+        # The batches returned by the backend may be read-only (e.g. in ray's object store) so they are copied first
+        buffers = {(i, steps[i]): self._standardise(self._layout.concatenate([buffer]))
+                   for i, buffer in zip(missing, loaded)}
+        if self._plan_batches is not None:
+            with self._plan_lock:
+                self._plan_batches.update(buffers)
+        return [buffers[(i, step)] if (i, step) in buffers else kept[(i, step)] for i, step in enumerate(steps)]
+
+    def _planned_superbatch(self, k):
+        """
+        Load (or look up) super-batch k of the batch plan. Several threads may ask for the same super-batch at once - only
+        the first loads it and the others wait for it. Recently used super-batches are kept so that the batches making up
+        a super-batch only load it once
+        :param k: Index of the super-batch
+        :return: A standardised packed batch, the number of events each DataLoader contributed to it and, if bucketing,
+        the indices of the events in each part
+        """
+        steps = self._superbatch_steps(k)
+        with self._plan_lock:
+            future = self._plan_cache.get(steps)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._plan_cache[steps] = future
+                while len(self._plan_cache) > self._plan_cache_size:
+                    self._plan_cache.popitem(last=False)
+            else:
+                self._plan_cache.move_to_end(steps)
+        if owner:
+            try:
+                buffers = self._planned_loader_batches(steps)
+                counts = [self._layout.num_events(buffer) for buffer in buffers]
+                buffer = self._layout.concatenate(buffers)
+                buckets = None
+                if self._bucketing:
+                    # One bucket per part, assigned with the batches loaded as the seed so the plan is reproducible
+                    nevents = sum(counts)
+                    sizes = np.diff([j * nevents // self._plan_parts for j in range(0, self._plan_parts + 1)])
+                    buckets = self._sampler.buckets(self._layout.unpack(buffer)[0], sizes,
+                                                    rng=np.random.RandomState(list(steps)))
+                future.set_result((buffer, counts, buckets))
+            except BaseException as error:
+                with self._plan_lock:
+                    if self._plan_cache.get(steps) is future:
+                        del self._plan_cache[steps]
+                future.set_exception(error)
+        return future.result()
+
+    def _planned_batch(self, idx, shuffle_var=None):
+        """
+        Build batch idx of the batch plan. Does not change the state of the DataGenerator so may be called from several
+        threads at once
+        :param idx: Index of the batch
+        :param shuffle_var: A tuple of the form (<variable type (str)>, <idx (int)>) of a variable to shuffle - see
+        load_batch()
+        :return: features (tuple of arrays), one-hot labels, weights
+        """
+        k, j = self.batch_plan(idx)
+        buffer, counts, buckets = self._planned_superbatch(k)
+        if buckets is not None:
+            return self._pad(self._unpack(self._layout.take(buffer, buckets[j]), shuffle_var=shuffle_var))
+        indices = []
+        offset = 0
+        for count in counts:
+            indices.append(np.arange(offset + j * count // self._plan_parts, offset + (j + 1) * count // self._plan_parts))
+            offset += count
+        return self._pad(self._unpack(self._layout.take(buffer, np.concatenate(indices)), shuffle_var=shuffle_var))
+
+    def _reset_prefetch_stats(self):
+        self._prefetch_stats = {"requests": 0, "ready": 0, "occupancy": 0, "wait_time": 0, "not_ready": {},
+                                "start_time": time.perf_counter()}
+
+    def log_prefetch_stats(self):
+        """
+        Logs the prefetch queue statistics gathered since the last call then resets them. A low ready fraction and a
+        long wait time mean the trainer is waiting on the DataLoaders - increase prefetch_depth (or prefetch_bytes) if
+        there is memory to spare
+        """
+        stats = self._prefetch_stats
+        if stats["requests"] == 0:
+            return
+        logger.log(f"{self.label} - Prefetch queue: depth = {self._prefetch_depth}, "
+                   f"mean occupancy = {stats['occupancy'] / stats['requests']:.2f}, "
+                   f"ready on request = {stats['ready']}/{stats['requests']}, "
+                   f"time waiting = {stats['wait_time']:.2f}s, "
+                   f"super-batch size = {self._superbatch_nbytes / 1e6:.1f} MB", 'INFO')
+        if stats["not_ready"]:
+            logger.log(f"{self.label} - DataLoaders not ready on request: {stats['not_ready']}", 'INFO')
+        self._reset_prefetch_stats()
+
+    def _assemble(self, buffers, shuffle_var=None):
+        """
+        Merges the packed batches returned by the DataLoaders into arrays ready for training
+        Each DataLoader returns a single packed buffer (with ray, a zero-copy view into the object store). These are
+        copied once into a single packed buffer which is then standardised in place
+        :param buffers: A list of packed batches
+        :param shuffle_var: A tuple of the form (<variable type (str)>, <idx (int)>) of a variable to shuffle - see
+        load_batch()
+        :return: features (tuple of arrays), one-hot labels, weights
+        """
+        return self._unpack(self._standardise(self._layout.concatenate(buffers)), shuffle_var=shuffle_var)
+
+    def _standardise(self, buffer):
+        """
+        Standardise the features of a packed batch in place
+        :param buffer: A packed batch
+        :return: The same packed batch
+        """
+        features, _, _ = self._layout.unpack(buffer)
+        for name, arr in zip(self._layout.feature_names, features):
+            self._variable_handler.standardise(name, arr)
+        return buffer
+
+    def _unpack(self, buffer, shuffle_var=None):
+        """
+        Unpack a standardised packed batch into arrays ready for training
+        :param buffer: A packed batch
+        :param shuffle_var: A tuple of the form (<variable type (str)>, <idx (int)>) of a variable to shuffle - see
+        load_batch()
+        :return: features (tuple of arrays), one-hot labels, weights
+        """
+        (track_array, neutral_pfo_array, shot_pfo_array, conv_track_array, jet_array), weight_array, label_array = \
+            self._layout.unpack(buffer)
+        label_array = one_hot(label_array, self._nclasses)
+
+        if shuffle_var is not None:
+            if shuffle_var[0] == "TauJets":
+                np.random.shuffle(jet_array[:, shuffle_var[1]])
+            if shuffle_var[0] == "TauTracks":
+                np.random.shuffle(track_array[:, shuffle_var[1]])
+            if shuffle_var[0] == "ConvTrack":
+                np.random.shuffle(conv_track_array[:, shuffle_var[1]])
+            if shuffle_var[0] == "ShotPFO":
+                np.random.shuffle(shot_pfo_array[:, shuffle_var[1]])
+            if shuffle_var[0] == "NeutralPFO":
+                np.random.shuffle(neutral_pfo_array[:, shuffle_var[1]])
+
+        return (track_array, neutral_pfo_array, shot_pfo_array, conv_track_array, jet_array), label_array, weight_array
+
+    def _pad(self, batch):
+        """
+        Pad the nested features of a batch to the largest multiplicity in the batch if dynamic_padding is set
+        :param batch: features (tuple of arrays), one-hot labels, weights
+        :return: The batch, with the nested features dynamically padded
+        """
+        if self._sampler is None:
+            return batch
+        features, label_array, weight_array = batch
+        return self._sampler.pad(features), label_array, weight_array
+
+    def to_dataset(self, cache=False, shuffle_var=None):
+        """
+        Builds a tf.data.Dataset from the DataLoaders. An alternative to using this class as a keras Sequence which
+        lets TensorFlow overlap data loading with the training step. Each DataLoader is wrapped in its own generator
+        and these are read in parallel by interleaving across the FileHandlers. The merged stream of events is then
+        re-batched to batch_size and prefetched
+        Each element is ((tracks, neutral PFOs, shot PFOs, conv tracks, jets), one-hot labels, weights)
+        One iteration of the dataset is a single pass through every DataLoader. Use .repeat() when training
+        With dynamic_padding each batch is padded to its largest multiplicity by padded_batch() - it is not bucketed
+        :param cache (optional, default=False): If True the standardised batches are cached in memory after the first
+        pass. A string is taken as a file path to cache to instead
+        :param shuffle_var (optional, default=None): A variable to shuffle for permutation ranking - see load_batch()
+        :return: A tf.data.Dataset
+        """
+        num_batches = self._call_loaders("number_of_batches")
+        feature_shapes = [shape for _, shape, _ in self._layout.arrays[:len(self._layout.feature_names)]]
+        if self._sampler is not None:
+            feature_shapes = [(None, shape[0]) if len(shape) == 2 else shape for shape in feature_shapes]
+        feature_specs = tuple(tf.TensorSpec(shape=(None,) + shape, dtype=tf.float32) for shape in feature_shapes)
+        output_signature = (feature_specs, tf.TensorSpec(shape=(None, self._nclasses), dtype=tf.int32),
+                            tf.TensorSpec(shape=(None,), dtype=tf.float32))
+
+        def loader_batches(loader_idx):
+            data_loader = self.data_loaders[loader_idx]
+            for _ in range(0, num_batches[loader_idx]):
+                buffers = self._backend.get([self._backend.submit(data_loader, "get_batch")])
+                yield self._pad(self._assemble(buffers, shuffle_var=shuffle_var))
+
+        def loader_dataset(loader_idx):
+            return tf.data.Dataset.from_generator(loader_batches, output_signature=output_signature, args=(loader_idx,))
+
+        dataset = tf.data.Dataset.range(len(self.data_loaders))
+        dataset = dataset.interleave(loader_dataset, cycle_length=len(self.data_loaders), block_length=1,
+                                     num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+        if cache:
+            dataset = dataset.cache(cache if isinstance(cache, str) else "")
+        if self._sampler is not None:
+            padding_values = (tuple(tf.constant(self._sampler.dummy_val, tf.float32) for _ in feature_specs),
+                              tf.constant(0, tf.int32), tf.constant(0, tf.float32))
+            dataset = dataset.unbatch().padded_batch(self.batch_size, padding_values=padding_values)
+        else:
+            dataset = dataset.unbatch().batch(self.batch_size)
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
     def load_model(self, model, model_config, model_weights):
         """
         Function to set the model to be used by the DataGenerator for predictions
@@ -198,7 +715,7 @@ class DataGenerator(tf.keras.utils.Sequence):
         everytime predict() is called
         Note: You should set no_gpu=True if you load models on multiple DataGenerator instances (TensorFlow is likely to complain)
         """
-        self.model = models_dict[model](model_config)
+        self.model = models_dict[model](model_config, dynamic=self._sampler is not None)
         self.model.load_weights(model_weights)
         self._weights = model_weights
 
@@ -236,9 +753,14 @@ class DataGenerator(tf.keras.utils.Sequence):
         nevents = 0
 
         # Iterate through the DataGenerator
+        if self.pipeline == "tfdata":
+            batches = self.to_dataset(shuffle_var=shuffle_var).take(self.__len__()).as_numpy_iterator()
+        elif self._deterministic:
+            batches = (self._planned_batch(idx, shuffle_var=shuffle_var) for idx in range(self.__len__()))
+        else:
+            batches = (self.load_batch(shuffle_var=shuffle_var) for _ in range(self.__len__()))
         position = 0
-        for _ in tqdm(range(self.__len__())):
-            batch, truth_labels, batch_weights = self.load_batch(shuffle_var=shuffle_var)
+        for batch, truth_labels, batch_weights in tqdm(batches, total=self.__len__()):
 
             nevents += len(truth_labels)
 
@@ -319,6 +841,8 @@ class DataGenerator(tf.keras.utils.Sequence):
         run into memory access violations when Keras oversteps bounds of array)
         :return: The number of batches in an epoch
         """
+        if self._deterministic:
+            return self._num_batches * self._plan_parts
 
         return math.floor(self._total_num_events / self.batch_size)
         # return self._num_batches
@@ -328,9 +852,12 @@ class DataGenerator(tf.keras.utils.Sequence):
         Overloads [] operator - allows generator to be indexable. This must be provided so that Keras can use generator
         Kinda hacky - ideally since this is generator we would be using the __next__ function - but Keras wants
         indexable data - so __getitem__ it is.
-        :param idx: An index - doesn't actually get used for anything - you can ignore it
+        :param idx: An index - doesn't actually get used for anything unless deterministic=True, in which case batch idx
+        of the batch plan is returned
         :return: The next batch of data
         """
+        if self._deterministic:
+            return self._planned_batch(idx)
         self._current_index += 1
         try:
             return self.load_batch()
@@ -365,8 +892,25 @@ class DataGenerator(tf.keras.utils.Sequence):
         :return:
         """
         self._current_index = 0
+        if self._deterministic:
+            # Batches are loaded by index so there are no iterators to reset - just shuffle the super-batches
+            self._epochs += 1
+            self._plan_order = np.random.RandomState(self._epochs).permutation(self._num_batches)
+            return
+        if self._replay is not None:
+            if self._replay.recording and self._replay.finalise(store=self._backend.store):
+                # Everything from here on is replayed - throw away the super-batches already requested
+                while self._prefetch_queue:
+                    self._backend.release(self._prefetch_queue.popleft())
+            if self._replay.is_ready():
+                # Start the replayed epoch from a fresh super-batch so that every epoch serves the same events
+                self._replay.shuffle()
+                self.batch_position = 0
+                return
+        # DataLoaders run their calls in order so any super-batches still in the prefetch queue are served from before
+        # the reset, the same as a single in-flight batch always was
         for data_loader in self.data_loaders:
-            data_loader.reset_dataloader.remote()
+            self._backend.submit(data_loader, "reset_dataloader")
 
     def on_epoch_end(self):
         """
@@ -374,8 +918,20 @@ class DataGenerator(tf.keras.utils.Sequence):
         :return:
         """
         self.reset_generator()
+        self.autoscale()
+        self.log_prefetch_stats()
         self.profile_dataloader_memory()
 
+    def shutdown(self):
+        """
+        Stop all of the DataLoaders
+        """
+        while self._prefetch_queue:
+            self._backend.release(self._prefetch_queue.popleft())
+        for data_loader in self.data_loaders:
+            self._backend.stop(data_loader)
+        self.data_loaders = []
+
     def number_events(self):
         return self._total_num_events
 
@@ -391,7 +947,7 @@ class DataGenerator(tf.keras.utils.Sequence):
             raise ValueError
     
     def profile_dataloader_memory(self):
-        mem_profiles = ray.get([dl.get_memory_profile.remote() for dl in self.data_loaders])
+        mem_profiles = self._call_loaders("get_memory_profile")
         logger.log("DataLoader memory profiles", 'DEBUG')
         for mem_dict in mem_profiles:
             for key, value in mem_dict.items():
@@ -1,23 +1,28 @@
 """
 DataLoader Class definition
 ________________________________________________________________________________________________________________________
-A helper class and ray actor to generate batches of data from a set of root files. This object applies all the required
-transformations to the data and computes the class labels.
+A helper class to generate batches of data from a set of root files. This object applies all the required
+transformations to the data and computes the class labels. DataGenerator runs each DataLoader as a ray actor, in a
+thread or in a process depending on its backend (see scripts/LoaderBackends.py)
 """
 
 import math
 import os.path
 import awkward as ak
 import numpy as np
-import uproot
-import ray
-import gc
 import numba as nb
 from scripts.utils import logger, profile_memory
-from config.config import models_dict
+from scripts.TensorCache import TensorCache, CachedSample
+from scripts.NTupleIndex import NTupleIndex
+from scripts.NTupleReader import NTupleReader, FilePool
+from scripts.BitmapIndex import BitmapIndex
+from scripts.BatchLayout import BatchLayout, one_hot
+from scripts.ShuffleBuffer import ShuffleBuffer
+from scripts.ImportanceSampler import ImportanceSampler
+from config.config import models_dict, max_items_dict, sort_items_dict
 
 
-@nb.njit()
+@nb.njit(nogil=True)
 def labeler(truth_decay_mode_np_array, labels_np_array, prong=None):
     """
     Function to compute decay mode labels for Gammatautau. Due to large for loop, the function is jitted for speed.
@@ -28,35 +33,122 @@ def labeler(truth_decay_mode_np_array, labels_np_array, prong=None):
         - 1pXn == 2
         - 3p0n == 3
         - 3pXn == 4
-    :param labels_np_array: The array of labels - already initialized ready to be modified
+    :param labels_np_array: The array of sparse (integer) labels - already allocated ready to be modified
     Convention:
-    [1, 0, 0, 0, 0, 0] == Background Jets
-    [0, 1, 0, 0, 0, 0] == 1p0n
-    [0, 0, 1, 0, 0, 0] == 1p1n
-    [0, 0, 0, 1, 0, 0] == 1pXn
-    [0, 0, 0, 0, 1, 0] == 3p0n
-    [0, 0, 0, 0, 0, 1] == 3pXn
+    0 == Background Jets
+    1 == 1p0n
+    2 == 1p1n
+    3 == 1pXn
+    4 == 3p0n
+    5 == 3pXn
     :return: An array of labels
     """
     for i in range(0, len(truth_decay_mode_np_array, )):
         elem = truth_decay_mode_np_array[i]
-        if prong is None:
-            labels_np_array[i][elem + 1] = 1
+        if prong is None or prong == 1:
+            labels_np_array[i] = elem + 1
         elif prong == 3:
-            labels_np_array[i][elem - 4 + 1] = 1
+            labels_np_array[i] = elem - 4 + 1
     return labels_np_array
 
 
-@ray.remote
+@nb.njit(nogil=True)
+def pad_ragged_array(counts, content, out, var_idx, dummy_val=-1):
+    """
+    Fused kernel to convert a ragged (jagged) array into a padded rectilinear array. Walks the flattened content buffer
+    once and writes the clipped, absolute, NaN/inf sanitised values straight into a preallocated output tensor. Jitted
+    since doing this with awkward/numpy takes several full copies of the array (pad_none, abs, to_numpy, nan_to_num etc.)
+    :param counts: Number of objects (tracks, PFOs etc...) belonging to each event
+    :param content: The flattened values of the variable for all objects in the batch
+    :param out: The output tensor of shape (num events, number of variables, max_items) - modified in place
+    :param var_idx: Index of the variable along axis 1 of the output tensor
+    :param dummy_val: Value to pad events with fewer than max_items objects with
+    Convention (same as the old ak.pad_none -> abs -> filled -> nan_to_num chain):
+        - Objects beyond max_items are clipped
+        - Missing objects are set to dummy_val
+        - NaN and +/-inf are set to 0
+    :return: The output tensor
+    """
+    max_items = out.shape[2]
+    start = 0
+    for i in range(0, len(counts)):
+        nitems = min(counts[i], max_items)
+        for j in range(0, nitems):
+            value = abs(content[start + j])
+            if np.isnan(value) or np.isinf(value):
+                value = 0
+            out[i, var_idx, j] = value
+        for j in range(nitems, max_items):
+            out[i, var_idx, j] = dummy_val
+        start += counts[i]
+    return out
+
+
+@nb.njit(nogil=True)
+def leading_items(counts, key, max_items):
+    """
+    Find the objects to keep in each event when only the max_items objects with the largest key (e.g. pT) are kept.
+    Jitted since it sorts the objects of every event separately
+    :param counts: Number of objects belonging to each event
+    :param key: The flattened values of the variable to sort by for all objects in the batch
+    :param max_items: Maximum number of objects to keep per event
+    :return: indices, kept_counts - the indices into the flattened content of the objects kept, event by event in
+    decreasing order of key (ties and NaNs keep the order of the NTuple), and the number of objects kept per event
+    """
+    kept_counts = np.minimum(counts, max_items)
+    indices = np.empty(kept_counts.sum(), dtype=np.int64)
+    start = 0
+    position = 0
+    for i in range(0, len(counts)):
+        order = np.argsort(-key[start: start + counts[i]], kind='mergesort')
+        for j in range(0, kept_counts[i]):
+            indices[position + j] = start + order[j]
+        position += kept_counts[i]
+        start += counts[i]
+    return indices, kept_counts
+
+
+def pad_nested_arrays(batch, variables, max_items, dummy_val=-1, out=None, sort_by=None):
+    """
+    Pads the nested variables belonging to a single object type into one float32 tensor using pad_ragged_array
+    :param batch: A dict of awkward arrays from uproot
+    :param variables: A list of Variables all belonging to the same object type
+    :param max_items: Maximum number of objects to keep per event
+    :param dummy_val: Value to pad missing objects with
+    :param out (optional, default=None): A preallocated float32 array of shape (num events, len(variables), max_items)
+    :param sort_by (optional, default=None): Name of a branch of the same object type. If given the objects are sorted
+    by it (largest first) before they are clipped to max_items, otherwise they keep the order of the NTuple
+    :return: A float32 array of shape (num events, len(variables), max_items)
+    """
+    # All variables of the same object type share the same multiplicity so the counts only need computing once
+    counts = ak.to_numpy(ak.num(batch[variables[0].name], axis=1)).astype(np.int64)
+    if out is None:
+        out = np.empty((len(counts), len(variables), max_items), dtype=np.float32)
+    indices = None
+    if sort_by is not None:
+        key = ak.to_numpy(ak.flatten(batch[sort_by], axis=1)).astype(np.float64)
+        indices, counts = leading_items(counts, key, max_items)
+    for i, variable in enumerate(variables):
+        content = ak.to_numpy(ak.flatten(batch[variable.name], axis=1))
+        if indices is not None:
+            content = content[indices]
+        pad_ragged_array(counts, content, out, i, dummy_val)
+    return out
+
+
 class DataLoader:
 
-    def __init__(self, data_type, files, class_label, nbatches, variable_handler, dummy_var="truthProng", cuts=None,
-                 batch_size=None, prong=None, reweighter=None, label="Dataloader", no_gpu=False):
+    def __init__(self, data_type, files, class_label, nbatches, variable_handler, cuts=None, batch_size=None, prong=None, reweighter=None, label="Dataloader", no_gpu=False, cache_dir=None, shard=None,
+                 decompression_workers=1, interpretation_workers=1, max_open_files=16, shuffle_blocks=False,
+                 shuffle_buffer=0, seed=None, cache_precision="full", cache_compression=None, importance_sampling=False,
+                 sampling_floor=0.05, sampling_cap=1.0, bitmap_index=False):
         """
-        Class constructor for the DataLoader object. Object is decorated with @ray.remote for easy multiprocessing
-        To initialize the class (which is a ray actor) do: dl = Dataloader.remote(*args, **kwargs)
+        Class constructor for the DataLoader object. To run the DataLoader as a ray actor do:
+        dl = ray.remote(DataLoader).remote(*args, **kwargs)
         To call a class method do: dl.<method>.remote(*args, **kwargs) - this returns a ray futures object
         To gather results of a class method do: ray.get(dl.<method>.remote(*args, **kwargs))
+        DataGenerator does this through a backend in scripts/LoaderBackends.py which can also run it in a thread or
+        process
         :param data_type: A string labelling the data type e.g. Gammatautau, JZ1 etc..
         :param files: A list of file paths to NTuples to read from
         :param class_label: Either 0 for jets or 1 for taus
@@ -64,8 +156,6 @@ class DataLoader:
         way that uproot works - it cannot make batches split across two files
         :param variables_dict: A dictionary whose keys correspond to variable types e.g. TauTracks, NeutralPFO etc...
         and whose values are a list of branches belonging to that key type
-        :param dummy_var: A branch that can be easily loaded for computing the number of events in a sample - don't use
-        a nested variable (e.g. TauTracks.pt) as this will be slow and may cause an OOM error
         :param cuts: A string detailing the cuts to be applied to the data, passable by uproot
         e.g.(TauJets.ptJetSeed > 15000.0) & (TauJets.ptJetSeed < 10000000.0)
         :param batch_size: The number of events to load per batch (overrides nbatches opt.)
@@ -73,6 +163,36 @@ class DataLoader:
         :param reweighter: An instance of a reweighting class 
         :param label:
         :param no_gpu:
+        :param cache_dir (optional, default=None): Directory of the memory-mapped tensor cache. If given the NTuples are
+        materialized to the cache once and batches are then served from the cache instead of from uproot. The cache has
+        one shard per file (see TensorCache) and only the shards that are missing are materialized - see also
+        scripts/CacheBuilder.py to build them ahead of time
+        :param shard (optional, default=None): A tuple of the form (<shard index>, <number of shards>). If given this
+        DataLoader only serves a shard of the files, so that a large sample can be read by several DataLoaders at once.
+        Each shard reads every <number of shards>th step with a step size <number of shards> times smaller, so all of
+        the shards together return as many events per batch as a single DataLoader would
+        :param decompression_workers (optional, default=1): Number of threads this DataLoader uses to decompress baskets
+        :param interpretation_workers (optional, default=1): Number of threads this DataLoader uses to interpret the
+        decompressed baskets as arrays
+        :param max_open_files (optional, default=16): Number of NTuples that this DataLoader keeps open between reads
+        and epochs, so that a file's headers and streamers are not re-read every time the iterator is reset
+        :param shuffle_blocks (optional, default=False): If True the steps (large contiguous blocks of entries) are read
+        in a new random order every epoch. Not used with cache_dir
+        :param shuffle_buffer (optional, default=0): If greater than zero the events of each step are mixed with those of
+        earlier steps in a ShuffleBuffer holding this many events, and batches are drawn from it at random. Not used with
+        cache_dir
+        :param seed (optional, default=None): Seed for the block order and the shuffle buffer
+        :param cache_precision (optional, default="full"): Either "full" to cache the features as float32 or "reduced"
+        to cache each variable in its storage dtype (see TensorCache)
+        :param cache_compression (optional, default=None): Either None, "lz4" or "zstd" to block compress the cache
+        :param importance_sampling (optional, default=False): If True (and this is a jet sample with a reweighter) each
+        jet is kept with a probability proportional to its weight and the weights of the jets kept are divided by it
+        (see ImportanceSampler). Jets which are not kept are not read from the NTuples. With cache_dir the whole sample
+        is cached and the jets are sampled as the batches are sliced out of the cache
+        :param sampling_floor (optional, default=0.05): Smallest probability of keeping a jet
+        :param sampling_cap (optional, default=1.0): Largest probability of keeping a jet
+        :param bitmap_index (optional, default=False): If True the cuts are resolved from the bitmap indexes of the
+        NTuples (see BitmapIndex) wherever they can be, so the cut branches are not read to count or select the events
         """
         # Disables GPU - useful if you want to instantiate multiple tensorflow model instances
         if no_gpu:
@@ -81,13 +201,23 @@ class DataLoader:
         self._data_type = data_type
         self.label = label
         self.files = files
-        self.dummy_var = dummy_var
         self.cut = cuts
         self._nbatches = nbatches
         self.class_label = class_label
         self._variable_handler = variable_handler
+        # The branches objects are sorted by are read even if they are not input variables
+        self._branches = variable_handler.list() + list(sort_items_dict.values())
         self._current_index = 0
         self._reweighter = reweighter
+        self._cache = None
+        self._layout = BatchLayout(variable_handler, max_items_dict)
+        self._shard = shard
+        nshards = 1 if shard is None else shard[1]
+        self._sampler = None
+        if importance_sampling and class_label == 0 and reweighter is not None:
+            self._sampler = ImportanceSampler(reweighter, floor=sampling_floor, cap=sampling_cap, seed=seed)
+        # Jets are sampled as they are read unless the batches come from the cache
+        self._sample_reads = self._sampler is not None and cache_dir is None
 
         # Number of classes
         self._prong = prong
@@ -97,47 +227,88 @@ class DataLoader:
         elif prong == 3:
             self._nclasses = 3  # [3p0n, 3pxn, jets]
 
-        # Work out how many events there in the sample by loading up a small array
-        test_arr = uproot.concatenate(self.files, filter_name="TauJets." + self.dummy_var, cut=self.cut, library='np')
-        self._num_events = len(test_arr["TauJets." + self.dummy_var])
+        # Work out how many events there in the sample from the NTuple index (only scans files that aren't indexed)
+        self._bitmaps = BitmapIndex() if bitmap_index else None
+        self._index = NTupleIndex(bitmaps=self._bitmaps)
+        self._num_events = self._index.num_events(self.files, cuts=self.cut)
 
         # Set the DataLoader's batch size
         if batch_size is None:
-            self.specific_batch_size = math.ceil(self._num_events / nbatches)
+            self.specific_batch_size = math.ceil(self._num_events / (nbatches * nshards))
         else:
             self.specific_batch_size = batch_size
 
-        # Setup the iterator
-        self._batches_generator = uproot.iterate(self.files, filter_name=self._variable_handler.list(), cut=self.cut,
-                                                 step_size=self.specific_batch_size)
+        # Setup the iterator - the cut branches are read first and the rest only for the entries passing the cuts
+        self._pool = FilePool(max_open=max_open_files, decompression_workers=decompression_workers,
+                              interpretation_workers=interpretation_workers, index=self._index)
+        shuffle_blocks = shuffle_blocks and cache_dir is None
+        self._reader = NTupleReader(self.files, self._branches, cuts=self.cut,
+                                    step_size=self.specific_batch_size, index=self._index, shard=shard, pool=self._pool,
+                                    shuffle=shuffle_blocks, seed=seed,
+                                    sampler=self._sampler if self._sample_reads else None, bitmaps=self._bitmaps)
+        self._shuffle_buffer = None
+        if shuffle_buffer > 0 and cache_dir is None:
+            self._shuffle_buffer = ShuffleBuffer(self._layout, shuffle_buffer, seed=seed)
+        self._batches_generator = iter(self._reader)
 
         # Work out the number of batches there are in the generator
-        self._num_real_batches = 0
-        for _ in uproot.iterate(self.files, filter_name="TauJets." + self.dummy_var, cut=self.cut,
-                                step_size=self.specific_batch_size):
-            self._num_real_batches += 1
+        self._steps = self._reader.steps()
+        self._num_real_batches = len(self._steps)
+
+        # Work out what fraction of the events will be kept by the importance sampling
+        self._sampled_fraction = 1.0
+        if self._sampler is not None:
+            self._sampled_fraction = self._expected_fraction()
+            logger.log(f"Importance sampling {data_type} - keeping {self._sampled_fraction:.1%} of the jets", 'INFO')
+
+        # Materialize the padded tensors of any files missing from the cache, then serve batches from it
+        if cache_dir is not None:
+            self._cache = CachedSample([TensorCache(cache_dir, data_type, file, variable_handler, max_items_dict,
+                                                    cuts=cuts, prong=prong, precision=cache_precision,
+                                                    compression=cache_compression, sort_items=sort_items_dict,
+                                                    reweighter=reweighter if class_label == 0 else None)
+                                        for file in dict.fromkeys(file for file, _, _ in self._steps)], self._steps)
+            self.materialize()
+            self._num_events = self._cache.open()
+            self._num_real_batches = math.ceil(self._num_events / self.specific_batch_size)
+            # The NTuples are not read again
+            self._pool.close()
 
         logger.log(f"Found {len(files)} file(s) with {self._num_events} events for {data_type}", 'INFO')
         logger.log(f"Found these files: {files}", 'DEBUG')
         logger.log(f"Number of batches in {self.label} {self.data_type()} = {self._num_real_batches}", 'DEBUG')
         logger.log(f"DataLoader for {data_type} initialized", "DEBUG")
 
+    def _expected_fraction(self):
+        """
+        Work out the expected fraction of the events kept by the importance sampling from the fraction kept in each file,
+        which the NTuple index works out once per file (see NTupleIndex.sampled_fraction). A shard reads steps spread
+        over all of the files so it is given the fraction of the whole sample
+        :return: The mean probability of keeping an event
+        """
+        counts = [self._index.selection(file, self.cut)["num_passing"] for file in self.files]
+        if sum(counts) == 0:
+            return 1.0
+        fractions = [self._index.sampled_fraction(file, self._sampler, cuts=self.cut) if count > 0 else 1.0
+                     for file, count in zip(self.files, counts)]
+        return float(np.average(fractions, weights=counts))
+
     def next_batch(self):
         """
         Gets the next batch of data from iterator. If end of the iterator is reached
         then restart it
-        :return: batch - a dict of arrays yielded by uproot.iterate()
+        :return: batch - an awkward array yielded by NTupleReader
         """
         try:
             batch = next(self._batches_generator)
         except StopIteration:
-            self._batches_generator = uproot.iterate(self.files, filter_name=self._variable_handler.list(), cut=self.cut,
-                                                     step_size=self.specific_batch_size)
+            self._batches_generator = iter(self._reader)
             return self.next_batch()
         self._current_index += 1
         return batch    
 
-    def pad_and_reshape_nested_arrays(self, batch, variable_type, max_items=10, shuffle_var=None):
+    def pad_and_reshape_nested_arrays(self, batch, variable_type, max_items=10, shuffle_var=None, out=None,
+                                      variables=None):
         """
         Function that acts on nested data to read relevant variables, pad, reshape and convert data from uproot into
         rectilinear numpy arrays
@@ -145,43 +316,42 @@ class DataLoader:
         :param variable_type (str): Variable type to be selected e.g. Tracks, Neutral PFO, Jets etc...
         :param max_items (int): Maximum number of tracks/PFOs etc... to be associated to event
         :param shuffle_var (str): When permutation ranking Variable to shuffle 
+        :param out (np.ndarray): Optional preallocated float32 array to write into
+        :param variables (list): Optional subset of the variables of the type to use - all of them if None
         :return np_arrays: a rectilinear numpy array of shape:
                 (num events in batch, number of variables belonging to variable type, max_items)
         """
-        variables = self._variable_handler.get(variable_type)
-        np_arrays = np.zeros((ak.num(batch[variables[0].name], axis=0), len(variables), max_items))
-        dummy_val = -1
+        if variables is None:
+            variables = self._variable_handler.get(variable_type)
+        np_arrays = pad_nested_arrays(batch, variables, max_items, dummy_val=-1, out=out,
+                                      sort_by=sort_items_dict.get(variable_type))
         for i, variable in enumerate(variables):
-            ak_arr = batch[variable.name]
-            ak_arr = ak.pad_none(ak_arr, max_items, clip=True, axis=1)
-            arr = ak.to_numpy(abs(ak_arr)).filled(dummy_val)
-            # arr = variable.standardise(arr, dummy_val=dummy_val)
             if variable.name == shuffle_var:
-                np.random.shuffle(arr)            
-            np_arrays[:, i] = arr
-        np_arrays = np.nan_to_num(np_arrays, posinf=0, neginf=0, copy=False).astype("float32")
+                np.random.shuffle(np_arrays[:, i])
         return np_arrays
 
-    def reshape_arrays(self, batch, variable_type, shuffle_var=None):
+    def reshape_arrays(self, batch, variable_type, shuffle_var=None, out=None, variables=None):
         """
         Function that acts on flat data to read relevant variables, reshape and convert data from uproot into
         rectilinear numpy arrays
         :param batch: A dict of awkward arrays from uproot
         :param variable_type: Variable type to be selected e.g. Tracks, Neutral PFO, Jets etc...
+        :param out: Optional preallocated float32 array to write into
+        :param variables: Optional subset of the variables of the type to use - all of them if None
         :return: a rectilinear numpy array of shape:
                 (num events in batch, number of variables belonging to variable type)
         """
-        variables = self._variable_handler.get(variable_type)
-        np_arrays = np.zeros((ak.num(batch[variables[0].name], axis=0), len(variables)))
+        if variables is None:
+            variables = self._variable_handler.get(variable_type)
+        np_arrays = out
+        if np_arrays is None:
+            np_arrays = np.empty((ak.num(batch[variables[0].name], axis=0), len(variables)), dtype="float32")
 
         for i, variable in enumerate(variables):
-            ak_arr = batch[variable.name]
-            arr = ak.to_numpy(abs(ak_arr))
-            # arr = variable.standardise(arr)
+            np.abs(ak.to_numpy(batch[variable.name]), out=np_arrays[:, i])
             if variable.name == shuffle_var:
-                np.random.shuffle(arr)
-            np_arrays[:, i] = arr
-        np_arrays = np.nan_to_num(np_arrays, posinf=0, neginf=0, copy=False).astype("float32")
+                np.random.shuffle(np_arrays[:, i])
+        np.nan_to_num(np_arrays, posinf=0, neginf=0, copy=False)
         return np_arrays
 
     def get_batch(self, shuffle_var=None):
@@ -190,45 +360,208 @@ class DataLoader:
         Pads ragged track and PFO arrays to make them rectilinear
         and reshapes arrays into correct shape for training. The clip option in ak.pad_none will truncate/extend each
         array so that they are all of a specific length
+        If a tensor cache is in use the batch is instead sliced straight out of the memory-mapped cache
+        The batch is returned packed into a single contiguous buffer (see scripts/BatchLayout.py) so that ray can
+        hand it to the DataGenerator through the shared-memory object store without copying
         :param shuffle_var (optional, default=None): A variable to shuffle (for permutation ranking)
+        :return: A packed batch - use BatchLayout.unpack() to get views of features, weights and sparse labels
         """
-        batch = self.next_batch()
+        if self._cache is not None:
+            return self._get_cached_batch(shuffle_var=shuffle_var)
+        if self._shuffle_buffer is not None:
+            return self._draw_batch(shuffle_var=shuffle_var)
+        return self._read_batch(shuffle_var=shuffle_var)
 
-        track_np_arrays = self.pad_and_reshape_nested_arrays(batch, "TauTracks", max_items=3, shuffle_var=shuffle_var)
-        neutral_pfo_np_arrays = self.pad_and_reshape_nested_arrays(batch, "NeutralPFO", max_items=6, shuffle_var=shuffle_var)
-        shot_pfo_np_arrays = self.pad_and_reshape_nested_arrays(batch, "ShotPFO", max_items=8, shuffle_var=shuffle_var)
-        conv_track_np_arrays = self.pad_and_reshape_nested_arrays(batch, "ConvTrack", max_items=4, shuffle_var=shuffle_var)
-        jet_np_arrays = self.reshape_arrays(batch, "TauJets", shuffle_var=shuffle_var)
+    def _draw_batch(self, shuffle_var=None):
+        """
+        Reads the next step into the shuffle buffer and draws a batch of the same size from it at random. The first call
+        fills the buffer up to its capacity (but reads at most one epoch's worth of steps). The buffer is not emptied
+        when the DataLoader is reset, so events carry over from one epoch to the next
+        :param shuffle_var (optional, default=None): A variable to shuffle (for permutation ranking)
+        :return: A packed batch in the same format as get_batch()
+        """
+        buffer = self._read_batch(shuffle_var=shuffle_var)
+        nevents = self._layout.num_events(buffer)
+        self._shuffle_buffer.add(buffer)
+        reads = 1
+        while len(self._shuffle_buffer) < self._shuffle_buffer.capacity + nevents and reads < self._num_real_batches:
+            self._shuffle_buffer.add(self._read_batch(shuffle_var=shuffle_var))
+            reads += 1
+        return self._shuffle_buffer.draw(nevents)
+
+    def get_batch_at(self, index, shuffle_var=None):
+        """
+        Random access version of get_batch(). Loads the index-th batch - the entries of the index-th step of the
+        NTupleReader passing the cuts - without touching the iterator, so that the same index always gives the same batch
+        :param index: Index of the batch - between 0 and number_of_batches() - 1
+        :param shuffle_var (optional, default=None): A variable to shuffle (for permutation ranking)
+        :return: A packed batch in the same format as get_batch()
+        """
+        if self._cache is not None:
+            return self._slice_cache(index, shuffle_var=shuffle_var)
+        return self._pack_batch(self._reader.read(*self._steps[index]), shuffle_var=shuffle_var,
+                                sampled=self._sample_reads)
 
-        # Compute labels
-        labels_np_array = np.zeros((len(batch), self._nclasses))
+    def steps(self):
+        """
+        :return: A list of the (file, entry_start, entry_stop) steps read by this DataLoader, one per batch
+        """
+        return self._steps
+
+    def _read_batch(self, shuffle_var=None):
+        """
+        Reads the next batch from the NTuples with uproot, pads the nested arrays and computes labels and weights
+        :param shuffle_var (optional, default=None): A variable to shuffle (for permutation ranking)
+        :return: A packed batch in the same format as get_batch()
+        """
+        return self._pack_batch(self.next_batch(), shuffle_var=shuffle_var, sampled=self._sample_reads)
+
+    def _pack_batch(self, batch, shuffle_var=None, sampled=False):
+        """
+        Pads the nested arrays of a batch read from the NTuples and computes labels and weights
+        :param batch: An awkward array yielded by NTupleReader
+        :param shuffle_var (optional, default=None): A variable to shuffle (for permutation ranking)
+        :param sampled (optional, default=False): If True the jets of the batch were importance sampled and their
+        weights are divided by their probability of being kept
+        :return: A packed batch in the same format as get_batch()
+        """
+        # Allocate the packed buffer up front and write every array straight into its views
+        buffer = self._layout.allocate(len(batch))
+        (track_np_arrays, neutral_pfo_np_arrays, shot_pfo_np_arrays, conv_track_np_arrays, jet_np_arrays), \
+            weight_np_array, labels_np_array = self._layout.unpack(buffer)
+
+        self.pad_and_reshape_nested_arrays(batch, "TauTracks", max_items=max_items_dict["TauTracks"], shuffle_var=shuffle_var, out=track_np_arrays)
+        self.pad_and_reshape_nested_arrays(batch, "NeutralPFO", max_items=max_items_dict["NeutralPFO"], shuffle_var=shuffle_var, out=neutral_pfo_np_arrays)
+        self.pad_and_reshape_nested_arrays(batch, "ShotPFO", max_items=max_items_dict["ShotPFO"], shuffle_var=shuffle_var, out=shot_pfo_np_arrays)
+        self.pad_and_reshape_nested_arrays(batch, "ConvTrack", max_items=max_items_dict["ConvTrack"], shuffle_var=shuffle_var, out=conv_track_np_arrays)
+        self.reshape_arrays(batch, "TauJets", shuffle_var=shuffle_var, out=jet_np_arrays)
+
+        # Compute sparse labels
         if self.class_label == 0:
-            labels_np_array[:, 0] = 1
+            labels_np_array[:] = 0
         else:
             truth_decay_mode_np_array = ak.to_numpy(batch["TauJets.truthDecayMode"]).astype(np.int64)
-            labels_np_array = labeler(truth_decay_mode_np_array, labels_np_array, prong=self._prong)
+            labeler(truth_decay_mode_np_array, labels_np_array, prong=self._prong)
 
         # Apply pT re-weighting
-        weight_np_array = np.ones(len(labels_np_array))
+        weight_np_array[:] = 1
         if self.class_label == 0:
-            weight_np_array = self._reweighter.reweight(ak.to_numpy(batch["TauJets.ptJetSeed"]).astype("float32"))
+            weight_np_array[:] = self._reweighter.reweight(ak.to_numpy(batch["TauJets.ptJetSeed"]).astype("float32"))
+            if sampled:
+                self._sampler.compensate(weight_np_array)
 
-        result = ((track_np_arrays, neutral_pfo_np_arrays, shot_pfo_np_arrays, conv_track_np_arrays, jet_np_arrays),
-                  labels_np_array, weight_np_array)
-        try:
-            return result
-        finally:
-            del result
+        return buffer
+
+    def _get_cached_batch(self, shuffle_var=None):
+        """
+        Slices the next batch out of the tensor cache. Wraps around to the start of the cache once the end is reached
+        :param shuffle_var (optional, default=None): A variable to shuffle (for permutation ranking)
+        :return: A packed batch in the same format as get_batch()
+        """
+        if self._current_index >= self._num_real_batches:
+            self._current_index = 0
+        self._current_index += 1
+        return self._slice_cache(self._current_index - 1, shuffle_var=shuffle_var)
+
+    def _slice_cache(self, index, shuffle_var=None):
+        """
+        Slices the index-th batch out of the tensor cache
+        :param index: Index of the batch
+        :param shuffle_var (optional, default=None): A variable to shuffle (for permutation ranking)
+        :return: A packed batch in the same format as get_batch()
+        """
+        start = index * self.specific_batch_size
+        stop = min(start + self.specific_batch_size, self._num_events)
+        buffer = self._layout.allocate(max(stop - start, 0))
+        features, weights, labels = self._layout.unpack(buffer)
+        self._cache.get(start, stop, out=(features, labels, weights))
+        if self._sampler is not None:
+            buffer = self._layout.take(buffer, np.flatnonzero(self._sampler.keep(weights, self._data_type, index)))
+            features, weights, labels = self._layout.unpack(buffer)
+            self._sampler.compensate(weights)
+
+        if shuffle_var is not None:
+            for i, var_type in enumerate(self._layout.feature_names):
+                names = [variable.name for variable in self._variable_handler.get(var_type)]
+                if shuffle_var in names:
+                    np.random.shuffle(features[i][:, names.index(shuffle_var)])
+
+        return buffer
+
+    def materialize(self):
+        """
+        Reads the files whose shards are missing from the tensor cache and writes their padded tensors, labels and
+        weights to it. Every event of a file passing the cuts is written, whichever steps this DataLoader reads, so
+        that the shard can be shared with other DataLoaders. This only needs to be done once per file - afterwards the
+        DataLoader reads from the cache. If a shard exists but some variables are missing from it (e.g. a variable has
+        been added) only those variables are read and added to the shard
+        """
+        for cache in self._cache.missing():
+            if cache.exists():
+                self._materialize_variables(cache)
+                continue
+            num_events = self._index.num_events([cache.file], cuts=self.cut)
+            logger.log(f"Materializing {num_events} events for {self._data_type} from {cache.file} to tensor cache",
+                       'INFO')
+            reader = NTupleReader([cache.file], self._branches, cuts=self.cut,
+                                  step_size=self.specific_batch_size, index=self._index, pool=self._pool,
+                                  bitmaps=self._bitmaps)
+            cache.allocate(min(num_events, reader.num_entries()))
+            position = 0
+            for file, entry_start, entry_stop in reader.steps():
+                batch, entries = reader.read(file, entry_start, entry_stop, return_entries=True)
+                features, weights, labels = self._layout.unpack(self._pack_batch(batch))
+                position = cache.write(position, features, labels, weights, entries)
+            cache.finalise(position)
+
+    def _materialize_variables(self, cache):
+        """
+        Reads the branches of the variables missing from a shard of the tensor cache and adds them to it. The jet weights
+        are made again if the pT re-weighting has changed since the shard was made
+        :param cache: A TensorCache shard which exists but is missing some variables
+        """
+        missing = cache.missing_variables()
+        variables = {var_type: [self._variable_handler.get(var_type)[i] for i in indices]
+                     for var_type, indices in missing.items() if var_type != "weights"}
+        branches = [variable.name for var_variables in variables.values() for variable in var_variables]
+        if "weights" in missing:
+            branches.append("TauJets.ptJetSeed")
+        logger.log(f"Materializing {branches} for {self._data_type} from {cache.file} to tensor cache", 'INFO')
+        stored_entries = cache.entries() if cache.open() > 0 else np.empty(0, dtype=np.int64)
+        sort_branches = [sort_items_dict[var_type] for var_type in variables if var_type in sort_items_dict]
+        reader = NTupleReader([cache.file], branches + sort_branches, cuts=self.cut,
+                              step_size=self.specific_batch_size, index=self._index, pool=self._pool,
+                              bitmaps=self._bitmaps)
+        cache.allocate(len(stored_entries), missing=missing)
+        position = 0
+        for file, entry_start, entry_stop in reader.steps():
+            batch, entries = reader.read(file, entry_start, entry_stop, return_entries=True)
+            if not np.array_equal(entries, stored_entries[position: position + len(entries)]):
+                raise ValueError(f"Entries read from {file} do not match those in the tensor cache at {cache.path}")
+            features = {}
+            for var_type, var_variables in variables.items():
+                if var_type in max_items_dict:
+                    features[var_type] = self.pad_and_reshape_nested_arrays(batch, var_type, max_items_dict[var_type],
+                                                                            variables=var_variables)
+                else:
+                    features[var_type] = self.reshape_arrays(batch, var_type, variables=var_variables)
+            if "weights" in missing:
+                features["weights"] = np.ones((len(entries), 1), dtype="float32")
+                if self.class_label == 0:
+                    jet_pt = ak.to_numpy(batch["TauJets.ptJetSeed"]).astype("float32")
+                    features["weights"][:, 0] = self._reweighter.reweight(jet_pt)
+            position = cache.write_variables(position, features)
+        cache.finalise(position)
 
     def reset_dataloader(self):
         """
-        Resets the DataLoader by restarting its index and iterator
+        Resets the DataLoader by restarting its index and iterator. The files stay open in the pool
         :return:
         """
         self._current_index = 0
-        self._batches_generator = uproot.iterate(self.files, filter_name=self._variable_handler.list(), cut=self.cut,
-                                                 library='ak', step_size=self.specific_batch_size)        
-        gc.collect()
+        self._batches_generator = iter(self._reader)
+        if self._sampler is not None:
+            self._sampler.epoch += 1
 
     def _set_generator_to_single_file(self, file, cut=None):
         """
@@ -238,8 +571,11 @@ class DataLoader:
         :param file (str): file path to an NTuple
         :param cut (str: optional - default=None): A string defining cuts
         """
-        self._batches_generator = uproot.iterate(file, filter_name=self._variable_handler.list(), cut=cut,
-                                                 library='ak', step_size=self.specific_batch_size)
+        self._batches_generator = iter(NTupleReader([file], self._branches, cuts=cut,
+                                                    step_size=self.specific_batch_size, index=self._index,
+                                                    pool=self._pool,
+                                                    sampler=self._sampler if self._sample_reads else None,
+                                                    bitmaps=self._bitmaps))
 
     def num_events(self):
         return self._num_events
@@ -250,6 +586,13 @@ class DataLoader:
     def number_of_batches(self):
         return self._num_real_batches
 
+    def sampled_fraction(self):
+        """
+        :return: The expected fraction of the events served once the jets have been importance sampled - 1 if they are
+        not sampled
+        """
+        return self._sampled_fraction
+
     def predict(self, model, model_config, model_weights, file=None, save_predictions=False):
         """
         Function to generate arrays of y_pred, y_true and weights given a network weight file
@@ -283,7 +626,8 @@ class DataLoader:
         # Iterate through the DataLoader
         position = 0
         for i in range(0, self._num_real_batches):
-            batch, truth_labels, batch_weights = self.get_batch()
+            batch, batch_weights, truth_labels = self._layout.unpack(self.get_batch())
+            truth_labels = one_hot(truth_labels, self._nclasses)
             nevents += len(truth_labels)
 
             logger.log(f"{len(batch[0]):=} ")
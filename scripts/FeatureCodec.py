@@ -0,0 +1,89 @@
+"""
+Feature Codecs
+________________________________________________________________________________________________________________________
+Encodings used to store the padded features in the tensor cache in less space than float32, and the block compressors
+that can be layered on top. Each variable chooses its storage dtype (see Variable.storage in config/variables.py):
+    - float32: stored as is
+    - float16: IEEE half precision - for bounded variables such as scores and fractions
+    - bfloat16: the top 16 bits of a float32 (stored as uint16) - same range as float32 with ~3 significant figures
+    - uint8: small non-negative integers such as hit counts. Stored with an offset of one so that the padding value of
+      -1 is kept - values are rounded and clipped to [-1, 254]
+Everything is decoded back to float32 on read, except for the int8 labels and int64 entry numbers which are stored as
+they are. The compressors are optional dependencies - lz4 needs the lz4 package and zstd needs the zstandard package
+"""
+
+import numpy as np
+
+# numpy dtype used to hold each storage dtype
+storage_dtypes = {"float32": np.dtype("float32"),
+                  "float16": np.dtype("float16"),
+                  "bfloat16": np.dtype("uint16"),
+                  "uint8": np.dtype("uint8"),
+                  "int8": np.dtype("int8"),
+                  "int64": np.dtype("int64"),
+                  }
+
+
+def encode(arr, storage):
+    """
+    Encode a float32 array in a storage dtype
+    :param arr: A float32 array
+    :param storage: A key of storage_dtypes
+    :return: The encoded array
+    """
+    if storage in ("float32", "int8", "int64"):
+        return np.asarray(arr, dtype=storage)
+    if storage == "float16":
+        return arr.astype("float16")
+    if storage == "bfloat16":
+        # Round to nearest even on the 16 bits that are thrown away
+        bits = np.ascontiguousarray(arr, dtype="float32").view(np.uint32)
+        return ((bits + (0x7FFF + ((bits >> 16) & 1))) >> 16).astype(np.uint16)
+    if storage == "uint8":
+        return (np.clip(np.rint(np.nan_to_num(arr, nan=-1)), -1, 254) + 1).astype(np.uint8)
+    raise ValueError(f"Unknown storage dtype {storage} - choose from {list(storage_dtypes.keys())}")
+
+
+def decode(arr, storage):
+    """
+    Decode an array stored in a storage dtype back to float32
+    :param arr: An array encoded by encode()
+    :param storage: A key of storage_dtypes
+    :return: A float32 array. For float32 (and integer) storage this is arr itself (no copy is made)
+    """
+    if storage in ("float32", "int8", "int64"):
+        return np.asarray(arr)
+    if storage == "bfloat16":
+        return (arr.astype(np.uint32) << 16).view(np.float32)
+    if storage == "uint8":
+        return arr.astype("float32") - 1
+    return arr.astype("float32")
+
+
+def get_compressor(name, level=None):
+    """
+    Get the functions to compress and decompress blocks of bytes
+    :param name: Either "lz4" or "zstd"
+    :param level (optional, default=None): Compression level - None for the library's default
+    :return: compress, decompress - functions mapping bytes to bytes
+    """
+    if name == "lz4":
+        try:
+            import lz4.frame
+        except ImportError as error:
+            raise ImportError("lz4 compression needs the lz4 package: pip install lz4") from error
+        kwargs = {} if level is None else {"compression_level": level}
+        return lambda data: lz4.frame.compress(data, **kwargs), lz4.frame.decompress
+    if name == "zstd":
+        try:
+            import zstandard
+        except ImportError as error:
+            raise ImportError("zstd compression needs the zstandard package: pip install zstandard") from error
+        compressor = zstandard.ZstdCompressor(**({} if level is None else {"level": level}))
+        decompressor = zstandard.ZstdDecompressor()
+        return compressor.compress, decompressor.decompress
+    raise ValueError(f"Unknown compression {name} - choose from {compressions}")
+
+
+# Block compressors that can be used for the tensor cache
+compressions = ("lz4", "zstd")
@@ -0,0 +1,98 @@
+"""
+ImportanceSampler Class Definition
+________________________________________________________________________________________________________________________
+Importance sampling of the jets. The jets far outnumber the taus but the pT re-weighting (see Reweighter in
+scripts/preprocessing.py) gives most of them, at low pT, a tiny weight - yet every one of them is read, padded and back-
+propagated. The ImportanceSampler keeps each jet with a probability proportional to its weight,
+    p = clip(weight / reference_weight, floor, cap)
+and divides the weight of the jets it keeps by p, so that the weighted sums (and so the expected loss and its gradient)
+are unchanged. The reference weight is that of a tau, so a jet carrying at least as much weight as a tau is always kept
+(for cap=1) and the jets kept are roughly as many as the taus. The floor keeps a few of the lightest jets, which bounds
+the compensated weights at weight / floor.
+Each event's draw depends only on the seed, the epoch and where the event is in the NTuples (or the cache), so a step
+read twice in the same epoch is sampled the same way while every epoch sees a new sample
+"""
+
+import zlib
+import hashlib
+import numpy as np
+
+
+class ImportanceSampler:
+
+    # Branch that the jet weights are computed from
+    pt_branch = "TauJets.ptJetSeed"
+
+    # Weight kept with probability one (for cap=1) - the weight of a tau
+    reference_weight = 1.0
+
+    def __init__(self, reweighter, floor=0.05, cap=1.0, seed=None):
+        """
+        Constructor for the ImportanceSampler
+        :param reweighter: The Reweighter giving the weights of the jets
+        :param floor (optional, default=0.05): Smallest probability of keeping a jet
+        :param cap (optional, default=1.0): Largest probability of keeping a jet
+        :param seed (optional, default=None): Seed for the draws. If None a seed is drawn at random, so the draws are
+        only repeatable within a run
+        """
+        if not 0 < floor <= cap <= 1:
+            raise ValueError(f"Importance sampling needs 0 < floor <= cap <= 1 - got floor = {floor}, cap = {cap}")
+        self._reweighter = reweighter
+        self.floor = floor
+        self.cap = cap
+        self.seed = seed if seed is not None else np.random.randint(0, 2 ** 31)
+        self.epoch = 0
+        self.branches = [self.pt_branch]
+
+    def fingerprint(self):
+        """
+        :return: A hash of everything the probability of keeping a jet depends on - the re-weighting, floor and cap
+        """
+        key = f"{self._reweighter.fingerprint()}_{self.reference_weight}_{self.floor}_{self.cap}"
+        return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    def weights(self, jet_pt):
+        """
+        :param jet_pt: Array of TauJets.ptJetSeed
+        :return: The re-weighting weights of the jets (before compensation)
+        """
+        return self._reweighter.reweight(np.asarray(jet_pt).astype("float32"))
+
+    def probability(self, weights):
+        """
+        :param weights: Array of the weights of the jets
+        :return: Array of the probability of keeping each jet
+        """
+        return np.clip(np.asarray(weights, dtype=np.float32) / self.reference_weight, self.floor, self.cap)
+
+    def keep(self, weights, *key):
+        """
+        Draw which jets to keep
+        :param weights: Array of the weights of the jets
+        :param key: Where the jets come from, e.g. a file name and entry number - the draws are repeatable for the same
+        key in the same epoch
+        :return: A boolean array, True for the jets kept
+        """
+        parts = [self.seed, self.epoch] + [zlib.crc32(part.encode()) if isinstance(part, str) else int(part)
+                                           for part in key]
+        rng = np.random.RandomState([part % 2 ** 32 for part in parts])
+        return rng.random_sample(len(weights)) < self.probability(weights)
+
+    def compensate(self, weights):
+        """
+        Divide the weights of the jets kept by their probability of being kept, in place
+        :param weights: Array of the weights of the jets kept
+        :return: The compensated weights
+        """
+        weights /= self.probability(weights)
+        return weights
+
+    def __call__(self, arrays, file, entry_start):
+        """
+        Draw which jets of a step to keep - used by NTupleReader before the heavy branches are read
+        :param arrays: A dict of numpy arrays holding at least pt_branch for every entry of the step
+        :param file: File path of the step
+        :param entry_start: First entry of the step
+        :return: A boolean array, True for the jets kept
+        """
+        return self.keep(self.weights(arrays[self.pt_branch]), file, entry_start)
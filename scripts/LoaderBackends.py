@@ -0,0 +1,238 @@
+"""
+DataLoader Backends
+________________________________________________________________________________________________________________________
+Backends that run the DataLoaders for a DataGenerator. Each backend starts DataLoaders and calls their methods
+asynchronously, returning futures that are gathered with get(). Calls to a single DataLoader always run in the order
+they were submitted, just like calls to a ray actor
+    - RayBackend: each DataLoader is a ray actor (the original behaviour)
+    - ThreadBackend: each DataLoader runs in its own thread in this process. Batches are handed over without any copies.
+      Works well as uproot decompression and the numba kernels release the GIL
+    - ProcessBackend: each DataLoader runs in its own process from concurrent.futures. Batches are returned through
+      shared memory rather than being pickled through a pipe, and handed to the DataGenerator as views of it
+The thread and process backends avoid ray's actor start up, object serialization and ray.get round trips which
+dominate on a laptop or a single batch node
+"""
+
+import os
+import ray
+import threading
+import numpy as np
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from scripts.DataLoader import DataLoader
+
+
+class RayBackend:
+
+    def __init__(self):
+        if not ray.is_initialized():
+            ray.init()
+        self._actor_class = ray.remote(DataLoader)
+
+    def start(self, *args, **kwargs):
+        """
+        Start a DataLoader
+        :param args: Args passed to DataLoader.__init__
+        :param kwargs: Keyword args passed to DataLoader.__init__
+        :return: A handle to the DataLoader to pass to submit() and stop()
+        """
+        return self._actor_class.remote(*args, **kwargs)
+
+    def submit(self, loader, method, *args, **kwargs):
+        """
+        Call a method of a DataLoader
+        :param loader: A handle returned by start()
+        :param method: Name of the method to call
+        :return: A future
+        """
+        return getattr(loader, method).remote(*args, **kwargs)
+
+    def get(self, futures):
+        """
+        Wait for a list of futures
+        :param futures: A list of futures returned by submit()
+        :return: A list of results
+        """
+        return ray.get(futures)
+
+    def ready(self, futures):
+        """
+        :param futures: A list of futures returned by submit()
+        :return: The futures that have already finished - does not wait
+        """
+        ready, _ = ray.wait(futures, num_returns=len(futures), timeout=0)
+        return ready
+
+    def store(self, array):
+        """
+        Hold on to a large array for the lifetime of the DataGenerator
+        :param array: A numpy array
+        :return: A read-only zero-copy view of the array in ray's object store - the original can then be freed
+        """
+        return ray.get(ray.put(array))
+
+    def release(self, futures):
+        """
+        Throw away futures that will never be passed to get()
+        :param futures: A list of futures returned by submit()
+        """
+        pass
+
+    def stop(self, loader):
+        ray.kill(loader)
+
+    def num_cpus(self):
+        return int(ray.cluster_resources().get("CPU", 1))
+
+
+class ThreadBackend:
+
+    class _Loader:
+        """
+        A DataLoader and the single worker thread that all calls to it are run on
+        """
+        def __init__(self, args, kwargs):
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="DataLoader")
+            self.loader = self.executor.submit(DataLoader, *args, **kwargs)
+
+        def call(self, method, args, kwargs):
+            return getattr(self.loader.result(), method)(*args, **kwargs)
+
+    def start(self, *args, **kwargs):
+        return self._Loader(args, kwargs)
+
+    def submit(self, loader, method, *args, **kwargs):
+        return loader.executor.submit(loader.call, method, args, kwargs)
+
+    def get(self, futures):
+        return [future.result() for future in futures]
+
+    def ready(self, futures):
+        return [future for future in futures if future.done()]
+
+    def store(self, array):
+        return array
+
+    def release(self, futures):
+        pass
+
+    def stop(self, loader):
+        loader.executor.shutdown(wait=False, cancel_futures=True)
+
+    def num_cpus(self):
+        return os.cpu_count()
+
+
+# Name and size of a batch that a ProcessBackend worker has written to shared memory
+SharedBuffer = namedtuple("SharedBuffer", ["name", "nbytes"])
+
+# The DataLoader owned by a ProcessBackend worker process
+_process_loader = None
+
+
+def _start_process_loader(args, kwargs):
+    global _process_loader
+    _process_loader = DataLoader(*args, **kwargs)
+
+
+def _call_process_loader(method, args, kwargs, share):
+    """
+    Call a method of this worker's DataLoader. If share is True the result (a packed batch) is copied into a new shared
+    memory block and only its name is sent back. The block is unlinked by ProcessBackend.get()
+    """
+    result = getattr(_process_loader, method)(*args, **kwargs)
+    if not share:
+        return result
+    shared_memory = SharedMemory(create=True, size=max(result.nbytes, 1))
+    np.ndarray(result.shape, dtype=result.dtype, buffer=shared_memory.buf)[:] = result
+    shared_memory.close()
+    return SharedBuffer(shared_memory.name, result.nbytes)
+
+
+def _unlink_shared_buffer(future):
+    if not future.cancelled() and future.exception() is None and isinstance(future.result(), SharedBuffer):
+        shared_memory = SharedMemory(name=future.result().name)
+        shared_memory.close()
+        shared_memory.unlink()
+
+
+class ProcessBackend:
+
+    # Methods which return a packed batch - these are returned through shared memory
+    shared_methods = ("get_batch", "get_batch_at")
+
+    def __init__(self):
+        # Start the resource tracker before any workers so that they share it - otherwise each worker would start its
+        # own and complain about "leaked" shared memory that has been unlinked here
+        resource_tracker.ensure_running()
+        # Spawn rather than fork - forking a process running TensorFlow is not safe
+        self._context = multiprocessing.get_context("spawn")
+        # Shared memory blocks of the batches returned by get() that are still mapped - see _free_consumed()
+        self._blocks = []
+        self._blocks_lock = threading.Lock()
+
+    def start(self, *args, **kwargs):
+        return ProcessPoolExecutor(max_workers=1, mp_context=self._context, initializer=_start_process_loader,
+                                   initargs=(args, kwargs))
+
+    def submit(self, loader, method, *args, **kwargs):
+        return loader.submit(_call_process_loader, method, args, kwargs, method in self.shared_methods)
+
+    def _free_consumed(self):
+        """
+        Unmap the shared memory blocks of the batches that have been consumed. A block cannot be closed while a view of
+        it is alive, so each block is freed once the DataGenerator has copied its batch out and dropped it
+        """
+        with self._blocks_lock:
+            blocks = []
+            for shared_memory in self._blocks:
+                try:
+                    shared_memory.close()
+                except BufferError:
+                    blocks.append(shared_memory)
+            self._blocks = blocks
+
+    def get(self, futures):
+        """
+        Wait for a list of futures. Packed batches are returned as read-only views of the shared memory they were written
+        to, like the zero-copy views ray.get returns from its object store. The blocks are unlinked straight away and
+        stay mapped until every view of them has been dropped
+        """
+        self._free_consumed()
+        results = []
+        for future in futures:
+            result = future.result()
+            if isinstance(result, SharedBuffer):
+                shared_memory = SharedMemory(name=result.name)
+                shared_memory.unlink()
+                result = np.frombuffer(shared_memory.buf, dtype=np.uint8, count=result.nbytes)
+                result.flags.writeable = False
+                with self._blocks_lock:
+                    self._blocks.append(shared_memory)
+            results.append(result)
+        return results
+
+    def ready(self, futures):
+        return [future for future in futures if future.done()]
+
+    def store(self, array):
+        return array
+
+    def release(self, futures):
+        for future in futures:
+            future.add_done_callback(_unlink_shared_buffer)
+
+    def stop(self, loader):
+        loader.shutdown(wait=False, cancel_futures=True)
+
+    def num_cpus(self):
+        return os.cpu_count()
+
+
+backends_dict = {"ray": RayBackend,
+                 "thread": ThreadBackend,
+                 "process": ProcessBackend,
+                 }
@@ -0,0 +1,159 @@
+"""
+MultiplicityProfiler Class Definition
+________________________________________________________________________________________________________________________
+Streams through the NTuples and histograms the number of objects (tracks, PFOs etc...) per event for each object type,
+broken down by class and by prong. From these it works out what fraction of events keep all of their objects for a given
+max_items (the coverage) and recommends the smallest max_items reaching a coverage target in every class. Only the
+branches needed to count the objects are read
+"""
+
+import numpy as np
+import awkward as ak
+from scripts.utils import logger
+from scripts.NTupleIndex import NTupleIndex
+from scripts.NTupleReader import NTupleReader
+
+# Class names in the order of the sparse labels computed by DataLoader (prong=None)
+class_names = ("jets", "1p0n", "1p1n", "1pxn", "3p0n", "3pxn")
+
+# Prong of each class
+class_prongs = {"jets": "jets", "1p0n": "1-prong", "1p1n": "1-prong", "1pxn": "1-prong", "3p0n": "3-prong",
+                "3pxn": "3-prong"}
+
+
+class MultiplicityProfiler:
+
+    # Branch holding the truth decay mode of the taus - used to split them into classes
+    decay_mode_branch = "TauJets.truthDecayMode"
+
+    def __init__(self, variable_handler, object_types, index=None):
+        """
+        Constructor for the MultiplicityProfiler
+        :param variable_handler: A VariableHandler object - the objects of each type are counted with its first variable
+        :param object_types: A list of the nested object types to profile e.g. ["TauTracks", "NeutralPFO", ...]
+        :param index (optional, default=None): An NTupleIndex to get the file layouts from
+        """
+        self.object_types = list(object_types)
+        self._count_branches = {var_type: variable_handler.get(var_type)[0].name for var_type in self.object_types}
+        self._index = index if index is not None else NTupleIndex()
+        # Histograms of the number of objects per event - self._histograms[var_type][class_name][n] = number of events
+        self._histograms = {var_type: {} for var_type in self.object_types}
+
+    def _fill(self, var_type, class_name, counts):
+        histogram = np.bincount(counts)
+        old = self._histograms[var_type].get(class_name, np.zeros(0, dtype=np.int64))
+        if len(old) < len(histogram):
+            old = np.pad(old, (0, len(histogram) - len(old)))
+        old[:len(histogram)] += histogram
+        self._histograms[var_type][class_name] = old
+
+    def add(self, batch, labels):
+        """
+        Add the multiplicities of a batch of events to the histograms
+        :param batch: An awkward array with a field for each count branch
+        :param labels: Array of the sparse class labels of the events (see class_names)
+        """
+        for var_type, branch in self._count_branches.items():
+            counts = ak.to_numpy(ak.num(batch[branch], axis=1)).astype(np.int64)
+            for label in np.unique(labels):
+                self._fill(var_type, class_names[label], counts[labels == label])
+
+    def profile(self, file_handlers, cuts=None, step_size=100000):
+        """
+        Stream through the NTuples of a set of samples and fill the histograms
+        :param file_handlers: A list of FileHandler objects
+        :param cuts (optional, default=None): A dict mapping data types to cut strings e.g. config.config.get_cuts()
+        :param step_size (optional, default=100000): Number of entries to read at a time
+        """
+        cuts = cuts if cuts is not None else {}
+        for file_handler in file_handlers:
+            branches = list(self._count_branches.values())
+            if file_handler.class_label != 0:
+                branches.append(self.decay_mode_branch)
+            reader = NTupleReader(file_handler.file_list, branches, cuts=cuts.get(file_handler.label),
+                                  step_size=step_size, index=self._index)
+            nevents = 0
+            for batch in reader:
+                if file_handler.class_label == 0:
+                    labels = np.zeros(len(batch), dtype=np.int64)
+                else:
+                    labels = ak.to_numpy(batch[self.decay_mode_branch]).astype(np.int64) + 1
+                self.add(batch, labels)
+                nevents += len(batch)
+            reader.close()
+            logger.log(f"Profiled the multiplicities of {nevents} events for {file_handler.label}", 'INFO')
+
+    def histogram(self, var_type, group=None):
+        """
+        :param var_type: One of object_types
+        :param group (optional, default=None): A class name, a prong ("1-prong", "3-prong" or "jets") or None for every
+        event
+        :return: Array of the number of events with n objects
+        """
+        histograms = [histogram for class_name, histogram in self._histograms[var_type].items()
+                      if group is None or group in (class_name, class_prongs[class_name])]
+        total = np.zeros(max([len(histogram) for histogram in histograms], default=1), dtype=np.int64)
+        for histogram in histograms:
+            total[:len(histogram)] += histogram
+        return total
+
+    def coverage(self, var_type, max_items, group=None):
+        """
+        :param var_type: One of object_types
+        :param max_items: Number of objects kept per event
+        :param group (optional, default=None): See histogram()
+        :return: event coverage, object coverage - the fraction of events which keep all of their objects and the
+        fraction of all objects which are kept
+        """
+        histogram = self.histogram(var_type, group)
+        nobjects = np.arange(len(histogram))
+        nevents = max(histogram.sum(), 1)
+        total_objects = max((histogram * nobjects).sum(), 1)
+        kept_objects = (histogram * np.minimum(nobjects, max_items)).sum()
+        return histogram[:max_items + 1].sum() / nevents, kept_objects / total_objects
+
+    def groups(self):
+        """
+        :return: The classes and prongs that have events in the histograms
+        """
+        present = [class_name for class_name in class_names
+                   if any(class_name in histograms for histograms in self._histograms.values())]
+        return present + list(dict.fromkeys(class_prongs[class_name] for class_name in present
+                                            if class_prongs[class_name] not in present))
+
+    def recommend(self, coverage=0.99):
+        """
+        Recommend max_items for each object type
+        :param coverage (optional, default=0.99): Fraction of events that should keep all of their objects
+        :return: A dict mapping object types to the smallest max_items reaching the coverage in every class
+        """
+        recommended = {}
+        for var_type in self.object_types:
+            recommended[var_type] = 0
+            for class_name in self._histograms[var_type]:
+                histogram = self.histogram(var_type, class_name)
+                cumulative = np.cumsum(histogram) / max(histogram.sum(), 1)
+                recommended[var_type] = max(recommended[var_type], int(np.searchsorted(cumulative, coverage)))
+        return recommended
+
+    def report(self, max_items, coverage=0.99):
+        """
+        Log the coverage of the current max_items and the recommended max_items for every object type and group
+        :param max_items: A dict of the current maximum number of objects per object type
+        :param coverage (optional, default=0.99): Coverage target - see recommend()
+        :return: The recommended max_items - see recommend()
+        """
+        recommended = self.recommend(coverage)
+        for var_type in self.object_types:
+            logger.log(f"{var_type}: max_items = {max_items[var_type]}   recommended = {recommended[var_type]} "
+                       f"for {coverage:.1%} of events in every class", 'INFO')
+            for group in self.groups():
+                histogram = self.histogram(var_type, group)
+                nobjects = np.arange(len(histogram))
+                mean = (histogram * nobjects).sum() / max(histogram.sum(), 1)
+                current_events, current_objects = self.coverage(var_type, max_items[var_type], group)
+                new_events, new_objects = self.coverage(var_type, recommended[var_type], group)
+                logger.log(f"    {group:<8} mean = {mean:.2f}   max = {len(histogram) - 1:<3} "
+                           f"coverage now = {current_events:.2%} of events ({current_objects:.2%} of objects)   "
+                           f"recommended = {new_events:.2%} of events ({new_objects:.2%} of objects)", 'INFO')
+        return recommended
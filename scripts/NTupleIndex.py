@@ -0,0 +1,249 @@
+"""
+NTupleIndex Class Definition
+________________________________________________________________________________________________________________________
+A persistent index of per-file metadata for the NTuples. For each file the number of entries is stored along with, for
+each cut string that has been applied to it, the number of entries passing the cuts and the number of passing entries
+in each truth decay mode (and the fraction of them the jet importance sampling keeps). The cluster layout of each tree (the entries at which the baskets of every branch start) is
+also stored so that batches can be aligned to clusters, along with zone maps (the range of values in each cluster) of
+the branches that are cut on so that clusters can be skipped without reading them. Records are keyed on the file path
+and modification time so they are rebuilt automatically if a file is replaced. This lets the DataLoaders and
+DataGenerators work out how many events and batches they have in milliseconds rather than scanning every file on start
+up
+"""
+
+import os
+import json
+import bisect
+import hashlib
+import threading
+import numpy as np
+import uproot
+from scripts.utils import logger
+from config.config import index_dir
+
+
+def get_tree_name(file):
+    """
+    Get the name of the TTree in an NTuple. The NTuples are expected to contain a single TTree
+    :param file: File path to an NTuple
+    :return: The name of the TTree (without cycle number)
+    """
+    with uproot.open(file) as ntuple:
+        return ntuple.keys(filter_classname="TTree", cycle=False)[0]
+
+
+class NTupleIndex:
+
+    # A flat branch that is cheap to read and is needed to count the number of events in each class
+    count_branch = "TauJets.truthDecayMode"
+
+    def __init__(self, directory=index_dir, bitmaps=None):
+        """
+        Constructor for the NTupleIndex
+        :param directory (optional, default=config.config.index_dir): Directory to persist the index records to
+        :param bitmaps (optional, default=None): A BitmapIndex to count new selections with. Selections the bitmaps
+        cannot resolve are counted by reading the cut branches
+        """
+        self.directory = directory
+        self._bitmaps = bitmaps
+        self._records = {}
+
+    def _record_file(self, file):
+        key = hashlib.sha1(os.path.abspath(file).encode()).hexdigest()
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _save(self, record):
+        """
+        Write a record to disk. The record is written to a temporary file and then moved into place so that two
+        DataLoaders indexing the same file at the same time can never leave a half written record behind. The temporary
+        file is named after the process and thread, as DataLoaders may run as threads of one process
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        record_file = self._record_file(record["path"])
+        tmp_file = f"{record_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'w') as file:
+            json.dump(record, file)
+        os.replace(tmp_file, record_file)
+
+    def record(self, file):
+        """
+        Get the index record of a file. If there is no record on disk, or the file has been modified since the record
+        was made, then a new one is made
+        :param file: File path to an NTuple
+        :return: A dict containing the record
+        """
+        mtime = os.path.getmtime(file)
+        record = self._records.get(file)
+        if record is None and os.path.isfile(self._record_file(file)):
+            with open(self._record_file(file), 'r') as record_file:
+                record = json.load(record_file)
+        if record is None or record["mtime"] != mtime or record["path"] != os.path.abspath(file) \
+                or "clusters" not in record:
+            logger.log(f"Indexing {file}", 'DEBUG')
+            with uproot.open(file) as ntuple:
+                tree_name = ntuple.keys(filter_classname="TTree", cycle=False)[0]
+                num_entries = ntuple[tree_name].num_entries
+                clusters = [int(entry) for entry in ntuple[tree_name].common_entry_offsets()]
+            record = {"path": os.path.abspath(file), "mtime": mtime, "tree": tree_name, "num_entries": num_entries,
+                      "clusters": clusters, "selections": {}}
+            self._save(record)
+        self._records[file] = record
+        return record
+
+    def selection(self, file, cuts=None):
+        """
+        Get the number of entries passing a set of cuts, and the number of passing entries in each decay mode. Only
+        the cut branches and a single flat branch are read the first time a selection is seen - or nothing, if the
+        bitmaps resolve the cuts
+        :param file: File path to an NTuple
+        :param cuts (optional, default=None): A cut string that can be parsed by uproot
+        :return: A dict of the form {"num_passing": int, "decay_mode_counts": {"0": int, "1": int ...}}
+        """
+        record = self.record(file)
+        key = str(cuts)
+        if key not in record["selections"]:
+            selection = None if self._bitmaps is None else self._bitmaps.selection(file, cuts)
+            if selection is None:
+                with uproot.open(file) as ntuple:
+                    data = ntuple[record["tree"]].arrays(filter_name=self.count_branch, cut=cuts,
+                                                         library='np')[self.count_branch]
+                decay_modes, counts = np.unique(data, return_counts=True)
+                selection = {"num_passing": int(len(data)),
+                             "decay_mode_counts": {str(int(dm)): int(n) for dm, n in zip(decay_modes, counts)}}
+            record["selections"][key] = selection
+            self._save(record)
+        return record["selections"][key]
+
+    def sampled_fraction(self, file, sampler, cuts=None):
+        """
+        Get the mean probability that an ImportanceSampler keeps an entry passing a set of cuts. Like the decay mode
+        counts this is stored with the selection, for each re-weighting, floor and cap, so the pT branch and the cut
+        branches are only read the first time
+        :param file: File path to an NTuple
+        :param sampler: An ImportanceSampler
+        :param cuts (optional, default=None): A cut string that can be parsed by uproot
+        :return: The mean probability of keeping a passing entry - 1 if no entries pass the cuts
+        """
+        record = self.record(file)
+        fractions = self.selection(file, cuts).setdefault("sampled_fractions", {})
+        key = sampler.fingerprint()
+        if key not in fractions:
+            with uproot.open(file) as ntuple:
+                jet_pt = ntuple[record["tree"]].arrays(filter_name=sampler.pt_branch, cut=cuts,
+                                                       library='np')[sampler.pt_branch]
+            probabilities = sampler.probability(sampler.weights(jet_pt))
+            fractions[key] = float(np.mean(probabilities)) if len(probabilities) > 0 else 1.0
+            self._save(record)
+        return fractions[key]
+
+    def zones(self, file, branches):
+        """
+        Get the zone maps of some branches of a file - the smallest and largest value of each branch in every cluster
+        (see record()) and whether the cluster holds a NaN. A branch's zone map is made, reading only that branch, the
+        first time it is asked for
+        :param file: File path to an NTuple
+        :param branches: A list of branch names
+        :return: A dict mapping each branch to a dict of the form {"min": [...], "max": [...], "nan": [...]}, with one
+        value per cluster, or to None if the branch is not a flat numerical branch. min and max are NaN for a cluster
+        holding only NaN
+        """
+        record = self.record(file)
+        zones = record.setdefault("zones", {})
+        missing = [branch for branch in branches if branch not in zones]
+        if missing:
+            logger.log(f"Building zone maps of {missing} for {file}", 'DEBUG')
+            starts = np.array(record["clusters"][:-1], dtype=np.int64)
+            with uproot.open(file) as ntuple:
+                tree = ntuple[record["tree"]]
+                for branch in missing:
+                    data = tree[branch].array(library='np') if branch in tree.keys() else None
+                    if data is None or data.dtype == object or len(starts) == 0:
+                        zones[branch] = None
+                        continue
+                    data = data.astype(np.float64)
+                    zones[branch] = {"min": np.fmin.reduceat(data, starts).tolist(),
+                                     "max": np.fmax.reduceat(data, starts).tolist(),
+                                     "nan": np.logical_or.reduceat(np.isnan(data), starts).tolist()}
+            self._save(record)
+        return {branch: zones[branch] for branch in branches}
+
+    def num_entries(self, files):
+        """
+        :param files: A list of file paths to NTuples
+        :return: The total number of entries (before cuts) in the files
+        """
+        return sum(self.record(file)["num_entries"] for file in files)
+
+    def num_events(self, files, cuts=None):
+        """
+        :param files: A list of file paths to NTuples
+        :param cuts (optional, default=None): A cut string that can be parsed by uproot
+        :return: The total number of entries passing cuts in the files
+        """
+        return sum(self.selection(file, cuts)["num_passing"] for file in files)
+
+    def decay_mode_counts(self, files, cuts=None):
+        """
+        :param files: A list of file paths to NTuples
+        :param cuts (optional, default=None): A cut string that can be parsed by uproot
+        :return: A dict mapping truth decay mode (int) to the number of passing entries in that decay mode
+        """
+        counts = {}
+        for file in files:
+            for decay_mode, count in self.selection(file, cuts)["decay_mode_counts"].items():
+                counts[int(decay_mode)] = counts.get(int(decay_mode), 0) + count
+        return counts
+
+    @staticmethod
+    def _nearest_cluster(clusters, entry_start, step_size):
+        """
+        Find the end of a step starting at entry_start that lies on a cluster boundary
+        :param clusters: A sorted list of the entries at which clusters start (ending with the number of entries)
+        :param entry_start: First entry of the step
+        :param step_size: Requested number of entries in the step
+        :return: The cluster boundary nearest to entry_start + step_size, or None if there is no boundary within a
+        factor of two of step_size
+        """
+        target = entry_start + step_size
+        lower = bisect.bisect_left(clusters, entry_start + max(step_size // 2, 1))
+        upper = bisect.bisect_right(clusters, entry_start + 2 * step_size)
+        candidates = clusters[lower: upper]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda entry: abs(entry - target))
+
+    def batch_layout(self, files, step_size, align=True):
+        """
+        Work out the entry ranges to read for a given step size. A batch is never split across two files so each file
+        is split up separately. By default the steps are aligned to the cluster boundaries of the trees, so that no
+        basket is split between two steps (and decompressed twice), using the boundary closest to step_size entries
+        after the start of each step
+        :param files: A list of file paths to NTuples
+        :param step_size: Number of entries per step
+        :param align (optional, default=True): If True align steps to cluster boundaries
+        :return: A list of tuples of the form (file, entry_start, entry_stop)
+        """
+        layout = []
+        for file in files:
+            record = self.record(file)
+            num_entries = record["num_entries"]
+            entry_start = 0
+            while entry_start < num_entries:
+                entry_stop = None
+                if align:
+                    entry_stop = self._nearest_cluster(record["clusters"], entry_start, step_size)
+                if entry_stop is None:
+                    entry_stop = entry_start + step_size
+                entry_stop = min(entry_stop, num_entries)
+                layout.append((file, entry_start, entry_stop))
+                entry_start = entry_stop
+        return layout
+
+    def num_batches(self, files, step_size, align=True):
+        """
+        :param files: A list of file paths to NTuples
+        :param step_size: Number of entries per step
+        :param align (optional, default=True): If True align steps to cluster boundaries
+        :return: The number of batches that the files are split into for a given step size
+        """
+        return len(self.batch_layout(files, step_size, align=align))
@@ -0,0 +1,474 @@
+"""
+NTupleReader Class Definition
+________________________________________________________________________________________________________________________
+Reads batches from the NTuples in two phases. Given a cut string, uproot.iterate reads every requested branch for every
+entry in a step and only then applies the cut. Here the (cheap, flat) branches that the cut depends on are read first,
+the cut is evaluated on them, and the (expensive, nested) track and PFO branches are then only read for the ranges of
+entries that pass. Tight selections such as the prong or decay mode specific cuts read a fraction of the bytes
+Before either phase the cut is evaluated on the zone maps of the cut branches - the range of their values in every
+cluster (see NTupleIndex.zones). Clusters which cannot pass the cut are not read at all, and the cut is not evaluated for
+clusters which pass entirely. The pT sliced jet samples in particular have whole clusters outside of the pT cuts
+A sampler (see ImportanceSampler) can drop events in the first phase too, so that events it does not keep are not read
+Steps are aligned to the cluster boundaries of the trees so that no basket is decompressed twice. With align=False the
+batches yielded are the same as uproot.iterate(files, filter_name=branches, cut=cuts, step_size=step_size)
+Files are opened through a FilePool which keeps the file, tree and branch objects alive between readers and epochs so
+that the headers and streamers of a file are only read once
+The steps can be read in a different random order on every pass (block shuffling) - each step is still a large
+contiguous range of entries so the reads stay sequential. See ShuffleBuffer for mixing the events of different steps
+"""
+
+import re
+import operator
+import numpy as np
+import awkward as ak
+import uproot
+import weakref
+from collections import OrderedDict
+from scripts.utils import logger
+from scripts.NTupleIndex import NTupleIndex
+
+
+class Predicate:
+
+    # Matches branch names of the form <object>.<variable> e.g. TauJets.ptJetSeed
+    branch_pattern = re.compile(r"\b[A-Za-z_]\w*(?:\.\w+)+\b")
+
+    # Dotted names in a cut string which are not branches
+    namespaces = ("np.", "numpy.")
+
+    def __init__(self, cuts):
+        """
+        Compiles a cut string, in the format understood by uproot, into a function of numpy arrays. Branch names are
+        not valid python identifiers so they are swapped for aliases before the expression is compiled
+        :param cuts: A cut string e.g. "(TauJets.ptJetSeed > 15000.0) & (TauJets.truthProng == 1)"
+        """
+        self.cuts = cuts
+        self.branches = []
+        for name in self.branch_pattern.findall(cuts):
+            if not name.startswith(self.namespaces) and name not in self.branches:
+                self.branches.append(name)
+        self._aliases = {name: f"_branch{i}" for i, name in enumerate(self.branches)}
+        expression = self.branch_pattern.sub(lambda match: self._aliases.get(match.group(0), match.group(0)), cuts)
+        self._code = compile(expression, "<cuts>", "eval")
+
+    def evaluate(self, columns):
+        """
+        Evaluate the cut expression on any objects standing in for the branches, e.g. the bitmaps of a BitmapIndex
+        :param columns: A dict containing (at least) every branch in self.branches
+        :return: The result of the expression
+        """
+        namespace = {alias: columns[name] for name, alias in self._aliases.items()}
+        return eval(self._code, {"np": np, "numpy": np}, namespace)
+
+    def __call__(self, arrays):
+        """
+        Evaluate the cut
+        :param arrays: A dict of numpy arrays containing (at least) every branch in self.branches
+        :return: A boolean numpy array, True for entries passing the cut
+        """
+        return np.asarray(self.evaluate(arrays), dtype=bool)
+
+
+class PartialMask:
+
+    def __init__(self, sure, maybe):
+        """
+        The result of evaluating (part of) a cut on a summary of the data rather than the data itself, e.g. on the
+        bitmaps of a BitmapIndex or the zone maps of an NTupleIndex. The summary cannot always tell whether an entry
+        passes, so two boolean arrays are kept - the entries which surely pass and those which might pass. The logical
+        operators combine them so that both stay true bounds on the result of the whole cut
+        :param sure: A boolean array, True for entries which surely pass
+        :param maybe: A boolean array, True for entries which might pass - a superset of sure
+        """
+        self.sure = sure
+        self.maybe = maybe
+
+    def exact(self):
+        """
+        :return: True if every entry is known to pass or fail
+        """
+        return np.array_equal(self.sure, self.maybe)
+
+    def __and__(self, other):
+        if not isinstance(other, PartialMask):
+            return NotImplemented
+        return PartialMask(self.sure & other.sure, self.maybe & other.maybe)
+
+    def __or__(self, other):
+        if not isinstance(other, PartialMask):
+            return NotImplemented
+        return PartialMask(self.sure | other.sure, self.maybe | other.maybe)
+
+    def __invert__(self):
+        return PartialMask(~self.maybe, ~self.sure)
+
+
+class ZoneColumn:
+
+    # For each comparison, whether every value and whether any value in [low, high] compares true with the threshold
+    rules = {operator.lt: lambda low, high, value: (high < value, low < value),
+             operator.le: lambda low, high, value: (high <= value, low <= value),
+             operator.gt: lambda low, high, value: (low > value, high > value),
+             operator.ge: lambda low, high, value: (low >= value, high >= value),
+             operator.eq: lambda low, high, value: ((low == value) & (high == value), (low <= value) & (value <= high)),
+             operator.ne: lambda low, high, value: ((value < low) | (value > high), (low != value) | (high != value))}
+
+    def __init__(self, zone, first, last):
+        """
+        The zone map of one branch (see NTupleIndex.zones) over a range of clusters. Comparing it with a number gives
+        a PartialMask with one element per cluster
+        :param zone: The zone map of the branch
+        :param first: First cluster
+        :param last: One past the last cluster
+        """
+        self._low = np.array(zone["min"][first: last], dtype=np.float64)
+        self._high = np.array(zone["max"][first: last], dtype=np.float64)
+        self._nan = np.array(zone["nan"][first: last], dtype=bool)
+
+    def _compare(self, op, value):
+        # Returning NotImplemented would make == and != fall back to an identity check giving a plain bool
+        if isinstance(value, (ZoneColumn, PartialMask)):
+            raise TypeError("Zone maps can only compare a branch with a number")
+        every, some = self.rules[op](self._low, self._high, float(value))
+        # NaN fails every comparison but != - a cluster holding only NaN has a NaN range
+        if op is operator.ne:
+            return PartialMask(every | np.isnan(self._low), some | self._nan)
+        return PartialMask(every & ~self._nan, some)
+
+    def __lt__(self, value):
+        return self._compare(operator.lt, value)
+
+    def __le__(self, value):
+        return self._compare(operator.le, value)
+
+    def __gt__(self, value):
+        return self._compare(operator.gt, value)
+
+    def __ge__(self, value):
+        return self._compare(operator.ge, value)
+
+    def __eq__(self, value):
+        return self._compare(operator.eq, value)
+
+    def __ne__(self, value):
+        return self._compare(operator.ne, value)
+
+    __hash__ = None
+
+
+def passing_ranges(mask, max_gap=0):
+    """
+    Find the ranges of entries that pass a cut
+    :param mask: A boolean array, True for entries passing the cut
+    :param max_gap (optional, default=0): Runs of failing entries this short or shorter do not split a range - they are
+    read and thrown away instead
+    :return: A list of (start, stop) tuples of indices into mask
+    """
+    passing = np.flatnonzero(mask)
+    if len(passing) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(passing) > max_gap + 1)
+    starts = np.concatenate(([passing[0]], passing[breaks + 1]))
+    stops = np.concatenate((passing[breaks], [passing[-1]])) + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+class FilePool:
+
+    def __init__(self, max_open=16, decompression_workers=1, interpretation_workers=1, index=None):
+        """
+        A pool of open NTuples. Opening a file with uproot reads its header, streamers and the TTree metadata, which for
+        the NTuples takes a significant fraction of the time taken to read a step. The pool keeps the most recently used
+        files open, along with the TTree and TBranch objects looked up in them, so that they are reused by every
+        NTupleReader sharing the pool
+        :param max_open (optional, default=16): Maximum number of files to keep open at once - the least recently used
+        file is closed when another is opened
+        :param decompression_workers (optional, default=1): Number of threads used to decompress baskets. With more
+        than one a read decompresses several baskets at once (the compression libraries release the GIL)
+        :param interpretation_workers (optional, default=1): Number of threads used to interpret the decompressed
+        baskets as arrays
+        :param index (optional, default=None): An NTupleIndex to look up the tree names from
+        """
+        self.max_open = max(1, max_open)
+        self._index = index if index is not None else NTupleIndex()
+        self._decompression_executor = uproot.ThreadPoolExecutor(decompression_workers) \
+            if decompression_workers > 1 else None
+        self._interpretation_executor = uproot.ThreadPoolExecutor(interpretation_workers) \
+            if interpretation_workers > 1 else None
+        # Stop the executor threads once the pool is garbage collected, e.g. when a DataLoader is retired
+        self._finalizer = weakref.finalize(self, self._shutdown_executors, self._decompression_executor,
+                                           self._interpretation_executor)
+        self._files = OrderedDict()
+        self.files_opened = 0
+
+    def _entry(self, file):
+        if file in self._files:
+            self._files.move_to_end(file)
+            return self._files[file]
+        while len(self._files) >= self.max_open:
+            _, (ntuple, _, _) = self._files.popitem(last=False)
+            ntuple.close()
+        # The array cache is turned off - the reads never overlap so it would only hold on to memory
+        ntuple = uproot.open(file, array_cache=None, decompression_executor=self._decompression_executor,
+                             interpretation_executor=self._interpretation_executor)
+        self._files[file] = (ntuple, ntuple[self._index.record(file)["tree"]], {})
+        self.files_opened += 1
+        return self._files[file]
+
+    def tree(self, file):
+        """
+        :param file: File path to an NTuple
+        :return: The TTree in the file
+        """
+        return self._entry(file)[1]
+
+    def branches(self, file, names):
+        """
+        Look up branches of the tree in a file. Branches are read one at a time with TBranch.array rather than with
+        TTree.arrays, which re-matches the branch names against the whole tree on every call and for the NTuples takes
+        longer than the read itself
+        :param file: File path to an NTuple
+        :param names: A list of branch names
+        :return: A dict mapping branch names to TBranch objects
+        """
+        _, tree, branch_objects = self._entry(file)
+        for name in names:
+            if name not in branch_objects:
+                branch_objects[name] = tree[name]
+        return branch_objects
+
+    def close(self):
+        """
+        Close every open file. The pool can still be used afterwards - files are reopened when next needed
+        """
+        for ntuple, _, _ in self._files.values():
+            ntuple.close()
+        self._files.clear()
+
+    @staticmethod
+    def _shutdown_executors(*executors):
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown()
+
+    def shutdown(self):
+        """
+        Close every open file and stop the executors
+        """
+        self.close()
+        self._finalizer()
+
+
+class NTupleReader:
+
+    def __init__(self, files, branches, cuts=None, step_size=100000, max_gap=1000, index=None, shard=None, align=True,
+                 pool=None, shuffle=False, seed=None, sampler=None, bitmaps=None, zone_maps=True):
+        """
+        Constructor for the NTupleReader
+        :param files: A list of file paths to NTuples
+        :param branches: A list of branch names to read
+        :param cuts (optional, default=None): A cut string that can be parsed by uproot
+        :param step_size (optional, default=100000): Number of entries (before cuts) per batch. Like uproot.iterate a
+        batch is never split across two files
+        :param max_gap (optional, default=1000): Gaps in the passing entries shorter than this do not split up the reads
+        of the heavy branches. Splitting a read in the middle of a basket means the basket is decompressed twice
+        :param index (optional, default=None): An NTupleIndex to get the file layouts from
+        :param shard (optional, default=None): A tuple of the form (<shard index>, <number of shards>). If given only every
+        <number of shards>th step, starting from <shard index>, is read
+        :param align (optional, default=True): Align the steps to the cluster boundaries of the trees so that no basket
+        is decompressed twice. The steps are then only roughly step_size entries long (see NTupleIndex.batch_layout)
+        :param pool (optional, default=None): A FilePool to open the files through. Pass the same pool to several
+        readers to share the open files between them. If not given the reader makes its own
+        :param shuffle (optional, default=False): If True every pass over the reader reads the steps in a new random
+        order
+        :param seed (optional, default=None): Seed for the order of the steps. With a seed the sequence of orders is the
+        same on every run
+        :param sampler (optional, default=None): A callable with a list of the branches it needs as its branches attribute.
+        It is called as sampler(arrays, file, entry_start), with a dict of numpy arrays of its branches for every entry of
+        a step, and returns a boolean array of the entries to keep. The heavy branches are only read for the entries
+        which are kept and pass the cuts
+        :param bitmaps (optional, default=None): A BitmapIndex to resolve the cuts with. Where the bitmaps resolve the
+        cuts of a file the cut branches are not read at all - only the branches asked for, for the passing entries
+        :param zone_maps (optional, default=True): Use the zone maps of the cut branches (see NTupleIndex.zones) to skip
+        the clusters which cannot pass the cuts. The cut is not evaluated for the clusters which pass entirely
+        """
+        self.files = files
+        self.branches = list(dict.fromkeys(branches))
+        self.step_size = step_size
+        self.max_gap = max_gap
+        self._index = index if index is not None else NTupleIndex()
+        self._shard = shard
+        self._align = align
+        self._pool = pool if pool is not None else FilePool(index=self._index)
+        self._shuffle = shuffle
+        self._rng = np.random.RandomState(seed)
+        self._predicate = Predicate(cuts) if cuts else None
+        self._sampler = sampler
+        self._bitmaps = bitmaps
+        self._zone_maps = zone_maps
+        self._sampler_branches = [] if sampler is None else list(sampler.branches)
+        self._cut_branches = [] if self._predicate is None else self._predicate.branches
+        if sampler is not None:
+            self._cut_branches = list(dict.fromkeys(self._cut_branches + sampler.branches))
+        self.entries_scanned = 0
+        self.entries_read = 0
+
+    def steps(self):
+        """
+        :return: A list of (file, entry_start, entry_stop) tuples, one per batch
+        """
+        steps = self._index.batch_layout(self.files, self.step_size, align=self._align)
+        if self._shard is not None:
+            shard_index, nshards = self._shard
+            steps = steps[shard_index::nshards]
+        return steps
+
+    def num_entries(self):
+        """
+        :return: The number of entries (before cuts) covered by the steps
+        """
+        return sum(entry_stop - entry_start for _, entry_start, entry_stop in self.steps())
+
+    def decompressed_bytes(self):
+        """
+        Work out how many bytes reading every step would decompress, counting each basket once for every step that
+        overlaps it. Ignores the cuts - i.e. assumes that every entry passes
+        :return: Number of uncompressed bytes, number of entries
+        """
+        nbytes = 0
+        steps = self.steps()
+        for file in dict.fromkeys(file for file, _, _ in steps):
+            file_steps = [(entry_start, entry_stop) for step_file, entry_start, entry_stop in steps
+                          if step_file == file]
+            for branch in self._pool.branches(file, self.branches).values():
+                basket_starts = branch.entry_offsets[:-1]
+                basket_stops = branch.entry_offsets[1:]
+                for entry_start, entry_stop in file_steps:
+                    for i in range(0, branch.num_baskets):
+                        if basket_starts[i] < entry_stop and basket_stops[i] > entry_start:
+                            nbytes += branch.basket_uncompressed_bytes(i)
+        return nbytes, sum(entry_stop - entry_start for _, entry_start, entry_stop in steps)
+
+    def __iter__(self):
+        steps = self.steps()
+        if self._shuffle:
+            steps = [steps[i] for i in self._rng.permutation(len(steps))]
+        for file, entry_start, entry_stop in steps:
+            yield self.read(file, entry_start, entry_stop)
+        logger.log(f"Read heavy branches for {self.entries_read}/{self.entries_scanned} entries", 'DEBUG')
+
+    def close(self):
+        """
+        Close the files held open by this reader's pool
+        """
+        self._pool.close()
+
+    @staticmethod
+    def _arrays(branch_objects, names, entry_start, entry_stop, library='ak'):
+        return {name: branch_objects[name].array(entry_start=entry_start, entry_stop=entry_stop, library=library)
+                for name in names}
+
+    def _read_ranges(self, branch_objects, names, entry_start, entry_stop, ranges):
+        """
+        Read flat branches for some ranges of the entries in [entry_start, entry_stop). Entries outside of the ranges
+        are left as zero
+        :param ranges: A list of (start, stop) tuples of entries relative to entry_start
+        :return: A dict of numpy arrays with an element for every entry in [entry_start, entry_stop)
+        """
+        if ranges == [(0, entry_stop - entry_start)]:
+            return self._arrays(branch_objects, names, entry_start, entry_stop, library='np')
+        arrays = {}
+        for name in names:
+            array = branch_objects[name].array(entry_start=entry_start, entry_stop=entry_start, library='np')
+            array = np.zeros(entry_stop - entry_start, dtype=array.dtype)
+            for start, stop in ranges:
+                array[start: stop] = branch_objects[name].array(entry_start=entry_start + start,
+                                                                entry_stop=entry_start + stop, library='np')
+            arrays[name] = array
+        return arrays
+
+    def _zone_bounds(self, file, entry_start, entry_stop):
+        """
+        Evaluate the cut on the zone maps of the clusters overlapping [entry_start, entry_stop)
+        :return: A PartialMask with an element for every entry, or None if a cut branch has no zone map
+        """
+        zones = self._index.zones(file, self._predicate.branches)
+        if any(zone is None for zone in zones.values()):
+            return None
+        clusters = np.array(self._index.record(file)["clusters"], dtype=np.int64)
+        first = int(np.searchsorted(clusters, entry_start, side='right')) - 1
+        last = int(np.searchsorted(clusters, entry_stop, side='left'))
+        try:
+            bounds = self._predicate.evaluate({branch: ZoneColumn(zone, first, last) for branch, zone in zones.items()})
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(bounds, PartialMask):
+            return None
+        lengths = np.minimum(clusters[first + 1: last + 1], entry_stop) - np.maximum(clusters[first: last], entry_start)
+        return PartialMask(np.repeat(bounds.sure, lengths), np.repeat(bounds.maybe, lengths))
+
+    def read(self, file, entry_start, entry_stop, return_entries=False):
+        """
+        Read the entries in [entry_start, entry_stop) of a file that pass the cuts
+        :param file: File path to an NTuple
+        :param entry_start: First entry to read
+        :param entry_stop: One past the last entry to read
+        :param return_entries (optional, default=False): If True also return the entry number of each event read
+        :return: An awkward array with a field for each branch (and an int64 array of entry numbers if return_entries)
+        """
+        branch_objects = self._pool.branches(file, self.branches + self._cut_branches)
+        self.entries_scanned += entry_stop - entry_start
+        if self._predicate is None and self._sampler is None:
+            self.entries_read += entry_stop - entry_start
+            batch = ak.Array(self._arrays(branch_objects, self.branches, entry_start, entry_stop))
+            if return_entries:
+                return batch, np.arange(entry_start, entry_stop, dtype=np.int64)
+            return batch
+
+        # Phase one - work out which entries pass the cut. The bitmaps may resolve it without reading anything and the
+        # zone maps may rule whole clusters in or out. The cut branches are only read for the clusters that might pass
+        # and the cut only evaluated for those not known to pass entirely
+        bounds = None
+        if self._predicate is not None and self._bitmaps is not None:
+            mask = self._bitmaps.mask(file, self._predicate, entry_start, entry_stop)
+            bounds = None if mask is None else PartialMask(mask, mask)
+        if self._predicate is not None and bounds is None and self._zone_maps:
+            bounds = self._zone_bounds(file, entry_start, entry_stop)
+        if bounds is None:
+            light_branches = self._cut_branches
+            cut_arrays = self._arrays(branch_objects, light_branches, entry_start, entry_stop, library='np')
+            mask = np.ones(entry_stop - entry_start, dtype=bool) if self._predicate is None else \
+                self._predicate(cut_arrays)
+        else:
+            undecided = bounds.maybe & ~bounds.sure
+            light_branches = self._cut_branches if undecided.any() else self._sampler_branches
+            cut_arrays = self._read_ranges(branch_objects, light_branches, entry_start, entry_stop,
+                                           passing_ranges(bounds.maybe, self.max_gap))
+            mask = bounds.sure.copy()
+            if undecided.any():
+                mask[undecided] = self._predicate({branch: array[undecided] for branch, array in cut_arrays.items()})
+        heavy_branches = [branch for branch in self.branches if branch not in light_branches]
+        if self._sampler is not None:
+            mask &= self._sampler(cut_arrays, file, entry_start)
+
+        # Phase two - read the remaining branches for the ranges of entries passing the cut
+        heavy_arrays = {}
+        if heavy_branches:
+            chunks = []
+            for start, stop in passing_ranges(mask, self.max_gap):
+                chunk = ak.Array(self._arrays(branch_objects, heavy_branches, entry_start + start, entry_start + stop))
+                chunks.append(chunk[mask[start: stop]])
+                self.entries_read += stop - start
+            if not chunks:
+                chunks.append(ak.Array(self._arrays(branch_objects, heavy_branches, entry_start, entry_start)))
+            heavy_arrays = chunks[0] if len(chunks) == 1 else ak.concatenate(chunks)
+
+        fields = {}
+        for branch in self.branches:
+            if branch in cut_arrays:
+                fields[branch] = cut_arrays[branch][mask]
+            else:
+                fields[branch] = heavy_arrays[branch]
+        if return_entries:
+            return ak.Array(fields), entry_start + np.flatnonzero(mask).astype(np.int64)
+        return ak.Array(fields)
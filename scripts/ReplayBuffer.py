@@ -0,0 +1,135 @@
+"""
+ReplayBuffer Class Definition
+________________________________________________________________________________________________________________________
+Keeps the whole training set in memory so that it only has to be streamed from the NTuples once. During the first epoch
+the (standardised) super-batches served by the DataGenerator are recorded. At the end of the epoch they are copied into
+a single contiguous packed buffer (see BatchLayout) and later epochs are replayed from it, shuffling the events every
+epoch. If the recorded data grows past the memory budget recording stops and the DataGenerator carries on streaming
+Without shuffling the events are replayed in the order they were recorded - used to pin the validation set so that
+validating after every epoch is a pure forward pass. The buffer can also be written to a memory-mapped file rather than
+held in memory
+"""
+
+import os
+import math
+import tempfile
+import numpy as np
+from numpy.lib.format import open_memmap
+from scripts.utils import logger
+
+
+class ReplayBuffer:
+
+    def __init__(self, layout, budget_bytes, label="ReplayBuffer", shuffle=True, directory=None):
+        """
+        Constructor for the ReplayBuffer
+        :param layout: The BatchLayout of the super-batches being recorded
+        :param budget_bytes: Maximum number of bytes to hold in memory
+        :param label (optional, default="ReplayBuffer"): A label for the log messages
+        :param shuffle (optional, default=True): If True shuffle the events every epoch, otherwise replay them in the
+        order they were recorded
+        :param directory (optional, default=None): If given the recorded data is written to a memory-mapped .npy file
+        in this directory instead of being held in memory. The budget then only limits the memory used while recording
+        """
+        self._layout = layout
+        self.budget_bytes = budget_bytes
+        self.label = label
+        self._shuffle = shuffle
+        self._directory = directory
+        self.recording = True
+        self._batches = []
+        self._nbytes = 0
+        self._buffer = None
+        self._order = None
+        self._position = 0
+        self._num_events = 0
+        self._batch_nevents = 0
+
+    def record(self, buffer):
+        """
+        Record a super-batch. The buffer is kept as is so it must not be modified afterwards
+        :param buffer: A packed batch
+        :return: True if the super-batch was recorded, False if recording has stopped
+        """
+        if not self.recording:
+            return False
+        self._nbytes += buffer.nbytes
+        if self._nbytes > self.budget_bytes:
+            logger.log(f"{self.label} - Replay buffer has gone over its budget of {self.budget_bytes / 1e6:.0f} MB - "
+                       f"streaming from the NTuples instead", 'WARNING')
+            self.recording = False
+            self._batches = []
+            return False
+        self._batches.append(buffer)
+        return True
+
+    def finalise(self, store=None):
+        """
+        Stop recording and copy the recorded super-batches into one contiguous buffer ready to be replayed
+        :param store (optional, default=None): A function taking the contiguous buffer and returning the array to hold
+        on to - e.g. to move the buffer into ray's object store. Not used if the buffer is written to a file
+        :return: True if there is data to replay
+        """
+        self.recording = False
+        if not self._batches:
+            return False
+        buffer = self._layout.concatenate(self._batches)
+        self._batch_nevents = math.ceil(self._layout.num_events(buffer) / len(self._batches))
+        self._batches = []
+        if self._directory is not None:
+            self._buffer = self._write(buffer)
+        else:
+            self._buffer = store(buffer) if store is not None else buffer
+        self._num_events = self._layout.num_events(self._buffer)
+        self.shuffle()
+        location = "memory" if self._directory is None else f"a memory-mapped file in {self._directory}"
+        logger.log(f"{self.label} - Replaying {self._num_events} events ({self._buffer.nbytes / 1e6:.0f} MB) from "
+                   f"{location}", 'INFO')
+        return True
+
+    def _write(self, buffer):
+        """
+        Write a buffer to a .npy file and memory-map it for reading. Every buffer gets a new uniquely named file, so
+        that runs sharing the directory (at the same time, or with other cuts or variables) never write over each other.
+        The file is unlinked as soon as it is mapped - the mapping keeps the data until it is released, and nothing is
+        left behind in the directory
+        :param buffer: A packed batch
+        :return: A read-only memory-mapped view of the file
+        """
+        os.makedirs(self._directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix=".npy", prefix=f"{self.label.replace(' ', '_')}_replay_",
+                                    dir=self._directory)
+        os.close(fd)
+        try:
+            memmap = open_memmap(path, mode='w+', dtype=buffer.dtype, shape=buffer.shape)
+            memmap[:] = buffer
+            memmap.flush()
+            del memmap
+            return np.load(path, mmap_mode='r')
+        finally:
+            os.remove(path)
+
+    def is_ready(self):
+        """
+        :return: True if the data has been recorded and can be replayed
+        """
+        return self._buffer is not None
+
+    def shuffle(self):
+        """
+        Start a new epoch - draws a new random order for the events if shuffling
+        """
+        self._order = np.random.permutation(self._num_events) if self._shuffle else np.arange(self._num_events)
+        self._position = 0
+
+    def next(self):
+        """
+        Gather the next super-batch, the same size on average as the recorded super-batches. Wraps around to a new epoch
+        when every event has been served
+        :return: A packed batch
+        """
+        if self._position >= self._num_events:
+            self.shuffle()
+        indices = self._order[self._position: self._position + self._batch_nevents]
+        self._position += self._batch_nevents
+        return self._layout.take(self._buffer, indices)
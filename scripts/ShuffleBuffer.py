@@ -0,0 +1,81 @@
+"""
+ShuffleBuffer Class Definition
+________________________________________________________________________________________________________________________
+A memory-bounded reservoir of events used to mix the events read from the NTuples. The NTuples are read in large
+contiguous blocks (in a shuffled order - see NTupleReader) so that the reads stay sequential. Each block is added to the
+buffer and a batch of the same size is drawn from the buffer at random, so that every batch is a mix of the blocks
+that have passed through it. Events are held as a packed batch (see BatchLayout)
+"""
+
+import numpy as np
+
+
+class ShuffleBuffer:
+
+    def __init__(self, layout, capacity, seed=None):
+        """
+        Constructor for the ShuffleBuffer
+        :param layout: The BatchLayout of the batches passing through the buffer
+        :param capacity: Number of events to keep in the buffer between draws. The memory used is roughly
+        layout.nbytes(capacity + <largest block>)
+        :param seed (optional, default=None): Seed for the random draws
+        """
+        self._layout = layout
+        self.capacity = capacity
+        self._rng = np.random.RandomState(seed)
+        self._pool = layout.allocate(0)
+        self._allocated = 0
+        self._num_events = 0
+
+    def __len__(self):
+        return self._num_events
+
+    def _reserve(self, nevents):
+        """
+        Make sure the pool can hold nevents events, copying the events it holds into a larger buffer if not
+        :param nevents: Number of events the pool needs to hold
+        """
+        if nevents <= self._allocated:
+            return
+        pool = self._layout.allocate(max(nevents, 2 * self._allocated))
+        old_features, old_weights, old_labels = self._layout.unpack(self._pool)
+        new_features, new_weights, new_labels = self._layout.unpack(pool)
+        for old_arr, new_arr in zip(old_features + (old_weights, old_labels), new_features + (new_weights, new_labels)):
+            new_arr[:self._num_events] = old_arr[:self._num_events]
+        self._pool = pool
+        self._allocated = self._layout.num_events(pool)
+
+    def add(self, buffer):
+        """
+        Copy the events of a batch into the buffer
+        :param buffer: A packed batch
+        """
+        nevents = self._layout.num_events(buffer)
+        self._reserve(self._num_events + nevents)
+        features, weights, labels = self._layout.unpack(buffer)
+        pool_features, pool_weights, pool_labels = self._layout.unpack(self._pool)
+        for arr, pool_arr in zip(features + (weights, labels), pool_features + (pool_weights, pool_labels)):
+            pool_arr[self._num_events: self._num_events + nevents] = arr
+        self._num_events += nevents
+
+    def draw(self, nevents):
+        """
+        Take events out of the buffer at random. The holes they leave are filled with events from the end of the buffer
+        so the cost only depends on the number of events drawn
+        :param nevents: Number of events to draw - at most len(self)
+        :return: A packed batch
+        """
+        nevents = min(nevents, self._num_events)
+        indices = self._rng.choice(self._num_events, nevents, replace=False)
+        batch = self._layout.take(self._pool, indices)
+
+        remaining = self._num_events - nevents
+        drawn = np.zeros(nevents, dtype=bool)
+        drawn[indices[indices >= remaining] - remaining] = True
+        holes = indices[indices < remaining]
+        survivors = remaining + np.flatnonzero(~drawn)
+        pool_features, pool_weights, pool_labels = self._layout.unpack(self._pool)
+        for pool_arr in pool_features + (pool_weights, pool_labels):
+            pool_arr[holes] = pool_arr[survivors]
+        self._num_events = remaining
+        return batch
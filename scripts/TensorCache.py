@@ -0,0 +1,596 @@
+"""
+TensorCache Class Definition
+________________________________________________________________________________________________________________________
+A memory-mapped on-disk cache of the padded tensors, labels and weights produced by a DataLoader. The NTuples are read,
+padded and labelled once (materialized) and written to .npy files. On later epochs the files are memory-mapped so that
+batches can be copied straight out of them rather than re-reading and re-decompressing the NTuples with uproot
+The cache is split into one shard per NTuple. Each shard is content-addressed - its name is a hash of a fingerprint of
+the file (see config.config.cache_fingerprint) and of the cuts, prong and storage options - so when a file is added to
+or replaced in a production only that file is materialized again. A DataLoader reads its shards through a CachedSample,
+which also lets DataLoaders reading different steps of the same files share the shards
+Within a shard every variable is stored in its own column, named by a fingerprint of the variable's name, type, padded
+length (and the variable the objects are sorted by) and storage dtype. When a variable is added or changed only its
+column is materialized - only its branch is read from the NTuple. The columns hold the raw padded values - the
+standardisation (min_val, max_val, lognorm and norm) is applied to each batch as it is served by the DataGenerator, so
+changing it does not touch the cache at all. The weights column of a jet sample is likewise named by a fingerprint of the
+pT re-weighting, whose histograms are made from every file of the production, so adding or replacing any file
+materializes the jet weights again
+With reduced precision each column is stored in the dtype given by Variable.storage and decoded back to float32 on read.
+Columns can also be block compressed with lz4 or zstd - the events are then stored in compressed blocks of block_events
+which are decompressed as they are read (see scripts/FeatureCodec.py)
+"""
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+import contextlib
+import numpy as np
+from numpy.lib.format import open_memmap
+from scripts.utils import logger
+from scripts.FeatureCodec import storage_dtypes, encode, decode, get_compressor
+from config.config import cache_fingerprint
+
+
+def file_fingerprint(file, mode=cache_fingerprint, memo_dir=None):
+    """
+    Fingerprint an NTuple
+    :param file: File path to an NTuple
+    :param mode (optional, default=config.config.cache_fingerprint): Either "mtime" for the absolute path, size and
+    modification time of the file or "content" for a SHA-1 hash of its contents
+    :param memo_dir (optional, default=None): Directory to remember content hashes in. A file is only hashed again if
+    its size or modification time has changed
+    :return: A JSON serialisable fingerprint
+    """
+    stat = os.stat(file)
+    if mode == "mtime":
+        return {"path": os.path.abspath(file), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if mode != "content":
+        raise ValueError(f"Unknown fingerprint mode {mode} - choose from ['mtime', 'content']")
+
+    memo_file = None if memo_dir is None else os.path.join(memo_dir, "fingerprints.json")
+    memo = {}
+    if memo_file is not None and os.path.isfile(memo_file):
+        with open(memo_file, 'r') as f:
+            memo = json.load(f)
+    record = memo.get(os.path.abspath(file))
+    if record is not None and record["size"] == stat.st_size and record["mtime"] == stat.st_mtime_ns:
+        return {"sha1": record["sha1"]}
+
+    logger.log(f"Hashing {file}", 'DEBUG')
+    sha1 = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 24), b""):
+            sha1.update(chunk)
+    if memo_file is not None:
+        # Written to a temporary file and moved into place - see NTupleIndex._save
+        memo[os.path.abspath(file)] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha1": sha1.hexdigest()}
+        os.makedirs(memo_dir, exist_ok=True)
+        tmp_file = f"{memo_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(memo, f)
+        os.replace(tmp_file, memo_file)
+    return {"sha1": sha1.hexdigest()}
+
+
+class _MemmapColumn:
+    """
+    A column of the cache held in a memory-mapped .npy file
+    """
+
+    def __init__(self, path, shape, storage):
+        self.path = f"{path}.npy"
+        self.shape = shape
+        self.storage = storage
+        self._arr = None
+
+    def allocate(self, num_events):
+        self._arr = open_memmap(self.path, mode='w+', dtype=storage_dtypes[self.storage],
+                                shape=(num_events,) + self.shape)
+
+    def write(self, position, arr):
+        self._arr[position: position + len(arr)] = encode(arr, self.storage)
+
+    def finalise(self):
+        self._arr.flush()
+        self._arr = None
+
+    def open(self):
+        self._arr = np.load(self.path, mmap_mode='r')
+
+    def get(self, start, stop):
+        return decode(self._arr[start: stop], self.storage)
+
+    def paths(self):
+        return [self.path]
+
+    def nbytes(self):
+        return os.path.getsize(self.path)
+
+
+class _BlockColumn:
+    """
+    A column of the cache stored as compressed blocks of block_events events, one after the other in a single file,
+    along with the offset of each block in the file. Batches must be written in order
+    """
+
+    def __init__(self, path, shape, storage, compression, block_events):
+        self.path = f"{path}.blocks"
+        self._offsets_path = f"{path}.offsets.npy"
+        self.shape = shape
+        self.storage = storage
+        self.block_events = block_events
+        self._compress, self._decompress = get_compressor(compression)
+        self._file = None
+        self._pending = []
+        self._num_pending = 0
+        self._offsets = None
+        self._data = None
+        self._block_cache = (None, None)
+
+    def allocate(self, num_events):
+        self._file = open(self.path, 'wb')
+        self._pending = []
+        self._num_pending = 0
+        self._offsets = [0]
+
+    def _flush(self, nevents):
+        block = np.concatenate(self._pending)
+        self._pending = [block[nevents:]]
+        self._num_pending -= nevents
+        data = self._compress(np.ascontiguousarray(block[:nevents]).tobytes())
+        self._file.write(data)
+        self._offsets.append(self._offsets[-1] + len(data))
+
+    def write(self, position, arr):
+        self._pending.append(encode(arr, self.storage))
+        self._num_pending += len(arr)
+        while self._num_pending >= self.block_events:
+            self._flush(self.block_events)
+
+    def finalise(self):
+        if self._num_pending > 0:
+            self._flush(self._num_pending)
+        self._file.close()
+        self._file = None
+        np.save(self._offsets_path, np.array(self._offsets, dtype=np.int64))
+
+    def open(self):
+        self._offsets = np.load(self._offsets_path)
+        self._data = np.memmap(self.path, dtype=np.uint8, mode='r') if self._offsets[-1] > 0 else np.empty(0, np.uint8)
+        self._block_cache = (None, None)
+
+    def _block(self, index):
+        # Batches rarely line up with the blocks so the last block read is kept for the next batch
+        if self._block_cache[0] != index:
+            data = self._decompress(self._data[self._offsets[index]: self._offsets[index + 1]].tobytes())
+            block = np.frombuffer(data, dtype=storage_dtypes[self.storage]).reshape((-1,) + self.shape)
+            self._block_cache = (index, block)
+        return self._block_cache[1]
+
+    def get(self, start, stop):
+        if stop <= start:
+            return decode(np.empty((0,) + self.shape, dtype=storage_dtypes[self.storage]), self.storage)
+        first, last = start // self.block_events, (stop - 1) // self.block_events
+        blocks = [self._block(index) for index in range(first, last + 1)]
+        arr = blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+        offset = first * self.block_events
+        return decode(arr[start - offset: stop - offset], self.storage)
+
+    def paths(self):
+        return [self.path, self._offsets_path]
+
+    def nbytes(self):
+        return os.path.getsize(self.path) + os.path.getsize(self._offsets_path)
+
+
+class TensorCache:
+
+    # Bump this whenever the layout of the cached arrays changes so that old caches are not read
+    version = 4
+
+    # Precision modes - full stores every variable as float32, reduced stores each variable in Variable.storage
+    precisions = ("full", "reduced")
+
+    # Arrays making up the features of a batch - in the order that DataLoader.get_batch returns them
+    feature_names = ("TauTracks", "NeutralPFO", "ShotPFO", "ConvTrack", "TauJets")
+
+    # Suffix of the directories that shards and columns are written to before they are complete
+    partial_suffix = ".partial"
+
+    def __init__(self, cache_dir, data_type, file, variable_handler, max_items, cuts=None, prong=None,
+                 precision="full", compression=None, block_events=4096, fingerprint=cache_fingerprint, sort_items=None,
+                 reweighter=None):
+        """
+        Constructor for the TensorCache - the shard of the cache holding the events of a single NTuple. The shard is
+        stored in <cache_dir>/<data_type>_<hash of the settings>/<hash of the settings and file fingerprint> so that a
+        stale shard is never read by mistake
+        :param cache_dir: Directory to store the cached tensors in
+        :param data_type: A string labelling the data type e.g. Gammatautau, JZ1 etc..
+        :param file: File path to the NTuple being cached
+        :param variable_handler: A VariableHandler object holding the input variables
+        :param max_items: A dictionary of the maximum number of objects per variable type e.g. {"TauTracks": 3, ...}
+        :param cuts (optional, default=None): The cut string applied to the NTuples
+        :param prong (optional, default=None): Number of prongs - changes the labels
+        :param precision (optional, default="full"): Either "full" to store the features as float32 or "reduced" to
+        store each variable in its storage dtype (see Variable.storage)
+        :param compression (optional, default=None): Either None, "lz4" or "zstd" to block compress every column
+        :param block_events (optional, default=4096): Number of events per compressed block
+        :param fingerprint (optional, default=config.config.cache_fingerprint): How to fingerprint the file - see
+        file_fingerprint()
+        :param sort_items (optional, default=None): A dictionary of the variable the objects of each type are sorted by
+        before they are clipped to max_items e.g. {"TauTracks": "TauTracks.pt", ...}
+        :param reweighter (optional, default=None): The Reweighter giving the weights of the jets. Its histograms are
+        made from every file of the production, so the weights column is named by its fingerprint and is materialized
+        again whenever they change. None for samples whose weights are all one
+        """
+        if precision not in self.precisions:
+            raise ValueError(f"Unknown precision {precision} - choose from {self.precisions}")
+        self.data_type = data_type
+        self.file = file
+        self._variable_handler = variable_handler
+        self._max_items = max_items
+        self.precision = precision
+        self.compression = compression
+        self.block_events = block_events
+
+        key = {"version": self.version, "cuts": cuts, "prong": prong}
+        if precision != "full" or compression is not None:
+            key["storage"] = {"precision": precision, "compression": compression, "block_events": block_events}
+        settings_digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+        self.directory = os.path.join(cache_dir, f"{data_type}_{settings_digest}")
+        key["file"] = file_fingerprint(file, mode=fingerprint, memo_dir=cache_dir)
+        self.name = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+        self.path = os.path.join(self.directory, self.name)
+
+        # Columns of each array - (column name, shape of an event, storage dtype) in the order of the variables
+        self._specs = {}
+        for name in self.feature_names:
+            shape = self.shape(name)[1:]
+            self._specs[name] = []
+            for variable in variable_handler.get(name):
+                storage = "float32" if precision == "full" else variable.storage
+                column_key = {"name": variable.name, "type": name, "shape": shape, "storage": storage}
+                if sort_items and name in sort_items:
+                    column_key["sort"] = sort_items[name]
+                digest = hashlib.sha1(json.dumps(column_key, sort_keys=True).encode()).hexdigest()[:8]
+                self._specs[name].append((f"{variable.name}.{digest}", shape, storage))
+        # Entry number of each event in the NTuple - lets a DataLoader pick out the events of its steps
+        weights = "weights" if reweighter is None else f"weights.{reweighter.fingerprint()[:8]}"
+        self._specs.update(labels=[("labels", (), "int8")], weights=[(weights, (), "float32")],
+                           entries=[("entries", (), "int64")])
+        self._columns = self._make_columns(self.path)
+        self._writing = None
+        self._num_events = 0
+
+    def _make_columns(self, path, names=None):
+        """
+        Make the objects reading and writing the columns
+        :param path: Directory the columns are stored in
+        :param names (optional, default=None): Names of the columns to make - all of them if None
+        :return: A dict mapping column names to column objects
+        """
+        columns = {}
+        for specs in self._specs.values():
+            for name, shape, storage in specs:
+                if names is not None and name not in names:
+                    continue
+                if self.compression is None or name == "entries":
+                    columns[name] = _MemmapColumn(os.path.join(path, name), shape, storage)
+                else:
+                    columns[name] = _BlockColumn(os.path.join(path, name), shape, storage, self.compression,
+                                                 self.block_events)
+        return columns
+
+    def _meta_file(self):
+        return os.path.join(self.path, "meta.json")
+
+    def _read_meta(self):
+        with open(self._meta_file(), 'r') as file:
+            return json.load(file)
+
+    def _write_meta(self, path, meta):
+        # Written to a temporary file and moved into place - see NTupleIndex._save
+        tmp_file = os.path.join(path, f"meta.json.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_file, 'w') as file:
+            json.dump(meta, file)
+        os.replace(tmp_file, os.path.join(path, "meta.json"))
+
+    @contextlib.contextmanager
+    def _meta_lock(self):
+        """
+        Hold an exclusive lock on the metadata of the shard while it is read, updated and replaced, so that DataLoaders
+        adding different columns to the same shard at the same time do not lose each other's columns
+        """
+        with open(os.path.join(self.path, "meta.lock"), 'a') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            yield
+
+    def exists(self):
+        """
+        A shard is only moved into place once every batch has been materialized so an interrupted write is never
+        mistaken for a usable cache
+        :return: True if the shard has been made - some of the columns might still be missing
+        """
+        return os.path.isfile(self._meta_file())
+
+    def missing_variables(self):
+        """
+        :return: A dict mapping feature names to the indices of the variables whose columns are not in the shard, and
+        "weights" to [0] if the weights were made with a different re-weighting. Only features with missing columns are
+        included. Every variable is missing if the shard has not been made
+        """
+        present = set(self._read_meta()["columns"]) if self.exists() else set()
+        missing = {}
+        for name in self.feature_names + ("weights",):
+            indices = [i for i, (column, _, _) in enumerate(self._specs[name]) if column not in present]
+            if indices:
+                missing[name] = indices
+        return missing
+
+    def is_complete(self):
+        """
+        :return: True if the cache can be read from
+        """
+        return self.exists() and not self.missing_variables()
+
+    def shape(self, name):
+        """
+        Shape of a single event in one of the cached arrays
+        :param name: One of feature_names
+        :return: A tuple e.g. (nvars, max_items) for nested variables or (nvars,) for TauJets
+        """
+        nvars = len(self._variable_handler.get(name))
+        if name in self._max_items:
+            return nvars, self._max_items[name]
+        return (nvars,)
+
+    def allocate(self, num_events, missing=None):
+        """
+        Creates the files ready to be filled by write(). They are written to a temporary directory - next to the shard
+        for a new shard or inside it when adding columns to an existing shard
+        :param num_events: Number of events that will be written (upper bound - see finalise()). When adding columns
+        this must be the number of events in the shard
+        :param missing (optional, default=None): The dict returned by missing_variables() to only add those columns to
+        an existing shard. If None a new shard is made
+        """
+        names = None
+        directory = self.directory
+        if missing is not None:
+            names = [self._specs[name][i][0] for name, indices in missing.items() for i in indices]
+            directory = self.path
+        os.makedirs(directory, exist_ok=True)
+        partial_path = tempfile.mkdtemp(prefix=f"{self.name}.", suffix=self.partial_suffix, dir=directory)
+        self._writing = (partial_path, missing, self._make_columns(partial_path, names))
+        for column in self._writing[2].values():
+            column.allocate(num_events)
+        logger.log(f"Allocated {len(self._writing[2])} tensor cache columns for {self.file} with {num_events} events "
+                   f"at {partial_path}", 'DEBUG')
+
+    def _write(self, position, arrays):
+        _, _, columns = self._writing
+        for name, arr in arrays.items():
+            columns[name].write(position, arr)
+        return position + len(next(iter(arrays.values())))
+
+    def write(self, position, features, labels, weights, entries):
+        """
+        Write a batch into a new shard
+        :param position: Index of the first event of the batch
+        :param features: A tuple of feature arrays in the order of feature_names
+        :param labels: Array of sparse class labels
+        :param weights: Array of weights
+        :param entries: Array of the entry number of each event in the NTuple
+        :return: Position of the next event to be written
+        """
+        arrays = {"labels": labels, self._specs["weights"][0][0]: weights, "entries": entries}
+        for name, arr in zip(self.feature_names, features):
+            for i, (column, _, _) in enumerate(self._specs[name]):
+                arrays[column] = arr[:, i]
+        return self._write(position, arrays)
+
+    def write_variables(self, position, features):
+        """
+        Write a batch of the missing columns into an existing shard
+        :param position: Index of the first event of the batch
+        :param features: A dict mapping the names in missing to arrays holding only the missing variables, in the order
+        of their indices along axis 1 - the weights are an array of shape (num events, 1)
+        :return: Position of the next event to be written
+        """
+        _, missing, _ = self._writing
+        return self._write(position, {self._specs[name][index][0]: arr[:, i] for name, arr in features.items()
+                                      for i, index in enumerate(missing[name])})
+
+    def finalise(self, num_events):
+        """
+        Flush the arrays to disk, write the metadata file and move the shard (or new columns) into place. If another
+        DataLoader finished the same shard first its copy is kept and this one thrown away
+        :param num_events: Number of events actually written
+        """
+        partial_path, missing, columns = self._writing
+        nbytes = 0
+        for column in columns.values():
+            column.finalise()
+            nbytes += column.nbytes()
+
+        if missing is None:
+            self._write_meta(partial_path, {"data_type": self.data_type, "file": os.path.abspath(self.file),
+                                            "num_events": num_events, "columns": list(columns.keys())})
+            try:
+                os.rename(partial_path, self.path)
+            except OSError:
+                if not self.exists():
+                    raise
+                shutil.rmtree(partial_path)
+        else:
+            for file in os.listdir(partial_path):
+                os.replace(os.path.join(partial_path, file), os.path.join(self.path, file))
+            os.rmdir(partial_path)
+            with self._meta_lock():
+                meta = self._read_meta()
+                meta["columns"] = list(dict.fromkeys(meta["columns"] + list(columns.keys())))
+                self._write_meta(self.path, meta)
+
+        self._writing = None
+        self._columns = self._make_columns(self.path)
+        logger.log(f"Materialized {len(columns)} columns of {num_events} events from {self.file} to {self.path} "
+                   f"({nbytes / 1e6:.1f} MB)", 'INFO')
+
+    def prune(self):
+        """
+        Delete the columns of variables which are no longer used, along with any columns left behind by an interrupted
+        write. Do not run this while the shard is being written to
+        :return: Number of files deleted
+        """
+        keep = {"meta.json", "meta.lock"}
+        for column in self._columns.values():
+            keep.update(os.path.basename(path) for path in column.paths())
+        pruned = 0
+        for file in os.listdir(self.path):
+            if file not in keep:
+                path = os.path.join(self.path, file)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                pruned += 1
+        with self._meta_lock():
+            meta = self._read_meta()
+            meta["columns"] = [column for column in meta["columns"] if column in self._columns]
+            self._write_meta(self.path, meta)
+        return pruned
+
+    def open(self):
+        """
+        Memory-map the cached arrays for reading. Missing columns (see missing_variables()) are not opened
+        :return: Number of events in the cache
+        """
+        meta = self._read_meta()
+        self._num_events = meta["num_events"]
+        for name in meta["columns"]:
+            if name in self._columns:
+                self._columns[name].open()
+        return self._num_events
+
+    def nbytes(self):
+        """
+        :return: Size of the columns in use on disk in bytes
+        """
+        return sum(column.nbytes() for column in self._columns.values())
+
+    def empty(self, num_events):
+        """
+        :param num_events: Number of events
+        :return: features, labels, weights - uninitialised arrays to get() a slice of the cache into
+        """
+        features = tuple(np.empty((num_events,) + self.shape(name), dtype="float32") for name in self.feature_names)
+        return features, np.empty(num_events, dtype="int8"), np.empty(num_events, dtype="float32")
+
+    def _get_array(self, name, start, stop, out):
+        specs = self._specs[name]
+        if len(specs) == 1 and name not in self.feature_names:
+            out[:] = self._columns[specs[0][0]].get(start, stop)
+        else:
+            for i, (column, _, _) in enumerate(specs):
+                out[:, i] = self._columns[column].get(start, stop)
+        return out
+
+    def get(self, start, stop, out=None):
+        """
+        Get a slice of the cache, decoded to float32
+        :param start: Index of the first event
+        :param stop: Index one past the last event
+        :param out (optional, default=None): A tuple of features, labels, weights arrays of length stop - start (after
+        clipping stop to the number of events) to write the slice into. If None new arrays are made
+        :return: features, labels, weights - features is a tuple of arrays in the order of feature_names
+        """
+        stop = max(min(stop, self._num_events), start)
+        features, labels, weights = out if out is not None else self.empty(stop - start)
+        for name, arr in zip(self.feature_names, features):
+            self._get_array(name, start, stop, arr)
+        labels = self._get_array("labels", start, stop, labels)
+        return features, labels, self._get_array("weights", start, stop, weights)
+
+    def entries(self):
+        """
+        :return: The entry number in the NTuple of every event in the cache (in increasing order)
+        """
+        return np.asarray(self._columns["entries"].get(0, self._num_events))
+
+    def num_events(self):
+        return self._num_events
+
+
+class CachedSample:
+
+    def __init__(self, caches, steps):
+        """
+        The events of a DataLoader served out of the shards of the tensor cache. Each step maps onto a contiguous range
+        of events in the shard of its file, so the sample is the concatenation of these ranges
+        :param caches: A list of TensorCache shards - one for every file in steps
+        :param steps: A list of the (file, entry_start, entry_stop) steps read by the DataLoader
+        """
+        self.caches = caches
+        self._steps = steps
+        self._segments = []
+        self._offsets = np.zeros(1, dtype=np.int64)
+
+    def missing(self):
+        """
+        :return: A list of the shards which have not been materialized yet or are missing columns
+        """
+        return [cache for cache in self.caches if not cache.is_complete()]
+
+    def open(self):
+        """
+        Memory-map every shard and work out which of their events belong to the steps
+        :return: Number of events in the sample
+        """
+        caches = {cache.file: cache for cache in self.caches}
+        entries = {}
+        for cache in self.caches:
+            cache.open()
+            entries[cache.file] = cache.entries()
+        self._segments = []
+        for file, entry_start, entry_stop in self._steps:
+            start, stop = np.searchsorted(entries[file], [entry_start, entry_stop])
+            if stop > start:
+                self._segments.append((caches[file], int(start), int(stop)))
+        self._offsets = np.cumsum([0] + [stop - start for _, start, stop in self._segments])
+        return self.num_events()
+
+    def num_events(self):
+        return int(self._offsets[-1])
+
+    def nbytes(self):
+        """
+        :return: Size of the shards on disk in bytes
+        """
+        return sum(cache.nbytes() for cache in self.caches)
+
+    def get(self, start, stop, out=None):
+        """
+        Get a slice of the sample, which may span several steps
+        :param start: Index of the first event
+        :param stop: Index one past the last event
+        :param out (optional, default=None): A tuple of features, labels, weights arrays of length stop - start (after
+        clipping stop to the number of events) to write the slice into. If None new arrays are made
+        :return: features, labels, weights - features is a tuple of arrays in the order of TensorCache.feature_names
+        """
+        stop = max(min(stop, self.num_events()), start)
+        features, labels, weights = out if out is not None else self.caches[0].empty(stop - start)
+        first = max(int(np.searchsorted(self._offsets, start, side='right')) - 1, 0)
+        position = start
+        for i in range(first, len(self._segments)):
+            if position >= stop:
+                break
+            cache, seg_start, _ = self._segments[i]
+            piece_stop = min(stop, self._offsets[i + 1])
+            piece = slice(position - start, piece_stop - start)
+            cache.get(seg_start + position - self._offsets[i], seg_start + piece_stop - self._offsets[i],
+                      out=(tuple(arr[piece] for arr in features), labels[piece], weights[piece]))
+            position = piece_stop
+        return features, labels, weights
@@ -0,0 +1,61 @@
+"""
+Test configuration
+________________________________________________________________________________________________________________________
+Shared set up for the tests of the data pipeline in scripts/test_*.py. Run them from the top of the repository with
+python -m pytest scripts
+"""
+
+import os
+import numpy as np
+import awkward as ak
+import pytest
+import uproot
+
+# scripts.utils opens a log file in logs/ as soon as it is imported
+os.makedirs("logs", exist_ok=True)
+
+# Entries per cluster of the test NTuple and number of clusters
+CLUSTER_SIZE = 250
+NUM_CLUSTERS = 8
+
+
+def make_ntuple(path, seed=0):
+    """
+    Write a small NTuple with the branches the cuts of config.config use. Each chunk is written with its own extend()
+    call, so the tree has NUM_CLUSTERS clusters. ptJetSeed rises through the file (like a pT sliced jet sample) so that
+    whole clusters lie outside of the pT cuts, includes values lying exactly on the cut thresholds and a cluster with NaN
+    """
+    rng = np.random.default_rng(seed)
+    num_entries = CLUSTER_SIZE * NUM_CLUSTERS
+    pt = np.sort(rng.uniform(5000, 60000, num_entries))
+    pt[[100, 700, 1200]] = 15000.0
+    pt[[900, 1500]] = 20000.0
+    pt[1600: 1610] = np.nan
+    eta = rng.uniform(-3, 3, num_entries)
+    eta[[3, 40, 600]] = 2.5
+    eta[[50, 1300]] = -2.47
+    decay_mode = rng.integers(0, 5, num_entries).astype(np.int32)
+    prong = np.where(decay_mode < 3, 1, 3).astype(np.int32)
+    cent_frac = rng.uniform(0, 1, num_entries).astype(np.float32)
+    counts = rng.integers(0, 6, num_entries)
+    track_pt = ak.unflatten(rng.exponential(5000, counts.sum()).astype(np.float32), counts)
+
+    with uproot.recreate(path) as ntuple:
+        ntuple.mktree("tree", {"TauJets.ptJetSeed": np.float64, "TauJets.etaJetSeed": np.float64,
+                               "TauJets.truthDecayMode": np.int32, "TauJets.truthProng": np.int32,
+                               "TauJets.centFrac": np.float32, "TauTracks.pt": "var * float32"},
+                      counter_name=lambda counted: "n_" + counted.replace(".", "_"))
+        for start in range(0, num_entries, CLUSTER_SIZE):
+            chunk = slice(start, start + CLUSTER_SIZE)
+            ntuple["tree"].extend({"TauJets.ptJetSeed": pt[chunk], "TauJets.etaJetSeed": eta[chunk],
+                                   "TauJets.truthDecayMode": decay_mode[chunk], "TauJets.truthProng": prong[chunk],
+                                   "TauJets.centFrac": cent_frac[chunk], "TauTracks.pt": track_pt[chunk]})
+    return path
+
+
+@pytest.fixture(scope="session")
+def ntuple(tmp_path_factory):
+    """
+    File path to a small test NTuple (see make_ntuple)
+    """
+    return str(make_ntuple(tmp_path_factory.mktemp("ntuples") / "ntuple.root"))
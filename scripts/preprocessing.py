@@ -5,6 +5,7 @@ This is where the data pre-processing will go
 """
 
 import os
+import hashlib
 import uproot
 import numpy as np
 import glob
@@ -59,6 +60,14 @@ class Reweighter:
         self.coeff = np.where(jet_hist > 0, tau_hist / (jet_hist + 1e-12), 1)
         self.bin_edges = bin_edges
 
+    def fingerprint(self):
+        """
+        A hash of the re-weighting coefficients and the binning. The histograms are made from every file in ntuple_dir
+        so this changes whenever a file is added or replaced
+        :return: A hex digest
+        """
+        return hashlib.sha1(np.asarray(self.coeff).tobytes() + np.asarray(self.bin_edges).tobytes()).hexdigest()[:16]
+
     def reweight(self, jet_pt, strides=None):
         """
         Get an array of weights from an array of jet pTs. One weight is asigned per jet. For plotting re-weighted
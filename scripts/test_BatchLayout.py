@@ -0,0 +1,91 @@
+"""
+Tests of packing and unpacking batches with scripts/BatchLayout.py
+"""
+
+import numpy as np
+import pytest
+from config.variables import Variable, VariableHandler
+from scripts.BatchLayout import BatchLayout, one_hot
+
+MAX_ITEMS = {"TauTracks": 3, "NeutralPFO": 4, "ShotPFO": 2, "ConvTrack": 1}
+NVARS = {"TauTracks": 2, "NeutralPFO": 3, "ShotPFO": 1, "ConvTrack": 2, "TauJets": 5}
+
+
+@pytest.fixture
+def layout():
+    variables = [Variable(var_type, f"{var_type}.var{i}") for var_type, n in NVARS.items() for i in range(n)]
+    return BatchLayout(VariableHandler(variables), MAX_ITEMS)
+
+
+def random_batch(nevents, seed=0):
+    rng = np.random.default_rng(seed)
+    features = []
+    for name in BatchLayout.feature_names:
+        shape = (nevents, NVARS[name], MAX_ITEMS[name]) if name in MAX_ITEMS else (nevents, NVARS[name])
+        features.append(rng.normal(size=shape).astype(np.float32))
+    weights = rng.uniform(size=nevents).astype(np.float32)
+    labels = rng.integers(0, 6, nevents).astype(np.int8)
+    return tuple(features), weights, labels
+
+
+def assert_batches_equal(unpacked, expected):
+    features, weights, labels = unpacked
+    expected_features, expected_weights, expected_labels = expected
+    assert len(features) == len(expected_features)
+    for arr, expected_arr in zip(features, expected_features):
+        assert arr.dtype == np.float32
+        np.testing.assert_array_equal(arr, expected_arr)
+    np.testing.assert_array_equal(weights, expected_weights)
+    np.testing.assert_array_equal(labels, expected_labels)
+
+
+@pytest.mark.parametrize("nevents", [0, 1, 7, 100])
+def test_pack_unpack_round_trip(layout, nevents):
+    batch = random_batch(nevents)
+    buffer = layout.pack(*batch)
+
+    assert buffer.dtype == np.uint8 and len(buffer) == layout.nbytes(nevents)
+    assert BatchLayout.num_events(buffer) == nevents
+    assert_batches_equal(layout.unpack(buffer), batch)
+
+
+def test_unpack_makes_aligned_views(layout):
+    buffer = layout.pack(*random_batch(13))
+    features, weights, labels = layout.unpack(buffer)
+    for arr in features + (weights, labels):
+        assert arr.base is not None and np.shares_memory(arr, buffer)
+        assert (arr.ctypes.data - buffer.ctypes.data) % BatchLayout.alignment == 0
+
+
+def test_unpack_read_only_buffer(layout):
+    batch = random_batch(5)
+    buffer = layout.pack(*batch)
+    buffer.flags.writeable = False
+    assert_batches_equal(layout.unpack(buffer), batch)
+
+
+def test_concatenate(layout):
+    batches = [random_batch(n, seed=n) for n in (3, 0, 11)]
+    buffer = layout.concatenate([layout.pack(*batch) for batch in batches])
+
+    expected = (tuple(np.concatenate([batch[0][i] for batch in batches]) for i in range(len(NVARS))),
+                np.concatenate([batch[1] for batch in batches]),
+                np.concatenate([batch[2] for batch in batches]))
+    assert BatchLayout.num_events(buffer) == 14
+    assert_batches_equal(layout.unpack(buffer), expected)
+
+
+def test_take(layout):
+    batch = random_batch(20)
+    indices = np.array([19, 0, 5, 5, 12])
+    buffer = layout.take(layout.pack(*batch), indices)
+
+    expected = (tuple(arr[indices] for arr in batch[0]), batch[1][indices], batch[2][indices])
+    assert_batches_equal(layout.unpack(buffer), expected)
+
+
+def test_one_hot():
+    labels = np.array([0, 2, 1, 2], dtype=np.int8)
+    expected = np.array([[1, 0, 0], [0, 0, 1], [0, 1, 0], [0, 0, 1]])
+    np.testing.assert_array_equal(one_hot(labels, 3), expected)
+    assert one_hot(labels, 3, dtype="float32").dtype == np.float32
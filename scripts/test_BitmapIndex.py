@@ -0,0 +1,115 @@
+"""
+Tests of resolving cuts with the bitmaps of scripts/BitmapIndex.py against a direct uproot read with cut=
+"""
+
+import os
+import numpy as np
+import pytest
+import uproot
+from scripts.BitmapIndex import BitmapIndex
+from scripts.NTupleIndex import NTupleIndex
+from scripts.NTupleReader import NTupleReader
+from scripts.conftest import make_ntuple
+from scripts.test_NTupleReader import BRANCHES, assert_arrays_equal, uproot_read
+
+# Cuts with every threshold on a bin edge
+RESOLVED_CUTS = [None,
+                 "TauJets.ptJetSeed > 15000.0",
+                 "(TauJets.ptJetSeed > 15000.0) & (TauJets.ptJetSeed < 10000000.0)",
+                 "(TauJets.ptJetSeed >= 20000.0) & (TauJets.truthProng == 3)",
+                 "TauJets.ptJetSeed != 20000.0",
+                 "~(TauJets.ptJetSeed <= 20000.0) | (TauJets.truthDecayMode == 1)",
+                 "(TauJets.etaJetSeed < 2.5) & (TauJets.etaJetSeed > -2.47) & (TauJets.truthDecayMode != 0)",
+                 "TauJets.truthDecayMode > 2.5"]
+
+# Cuts with a threshold inside a bin, a branch which is not indexed, a function or a comparison of two branches
+UNRESOLVED_CUTS = ["TauJets.ptJetSeed > 17000.0",
+                   "(TauJets.ptJetSeed > 15000.0) & (TauJets.centFrac > 0.5)",
+                   "abs(TauJets.etaJetSeed) < 2.5",
+                   "TauJets.ptJetSeed > TauJets.etaJetSeed",
+                   "TauJets.truthProng == TauJets.truthDecayMode"]
+
+
+@pytest.fixture
+def index(tmp_path):
+    return NTupleIndex(directory=str(tmp_path / "index"))
+
+
+@pytest.fixture
+def bitmaps(tmp_path, index):
+    return BitmapIndex(directory=str(tmp_path / "index" / "bitmaps"), index=index)
+
+
+def read_branch(file, branch, cuts=None):
+    with uproot.open(file) as ntuple:
+        return ntuple["tree"].arrays(filter_name=branch, cut=cuts, library='np')[branch]
+
+
+@pytest.mark.parametrize("cuts", RESOLVED_CUTS)
+def test_mask_matches_uproot_cut(ntuple, bitmaps, cuts):
+    mask = bitmaps.mask(ntuple, cuts)
+
+    # etaJetSeed is different for nearly every entry so the sequence of its values picks out the passing entries
+    assert mask is not None
+    np.testing.assert_array_equal(read_branch(ntuple, "TauJets.etaJetSeed")[mask],
+                                  read_branch(ntuple, "TauJets.etaJetSeed", cuts))
+    np.testing.assert_array_equal(bitmaps.entries(ntuple, cuts), np.flatnonzero(mask))
+
+
+@pytest.mark.parametrize("entry_start, entry_stop", [(0, 8), (3, 1005), (1001, 1002), (1999, 2000)])
+def test_mask_of_entry_range(ntuple, bitmaps, entry_start, entry_stop):
+    cuts = RESOLVED_CUTS[3]
+    np.testing.assert_array_equal(bitmaps.mask(ntuple, cuts, entry_start, entry_stop),
+                                  bitmaps.mask(ntuple, cuts)[entry_start: entry_stop])
+
+
+@pytest.mark.parametrize("cuts", RESOLVED_CUTS)
+def test_selection_matches_uproot_cut(ntuple, bitmaps, cuts):
+    decay_modes = read_branch(ntuple, "TauJets.truthDecayMode", cuts)
+
+    selection = bitmaps.selection(ntuple, cuts)
+
+    assert selection["num_passing"] == len(decay_modes)
+    assert selection["decay_mode_counts"] == {str(dm): int(np.count_nonzero(decay_modes == dm))
+                                              for dm in np.unique(decay_modes)}
+
+
+@pytest.mark.parametrize("cuts", UNRESOLVED_CUTS)
+def test_unresolved_cuts(ntuple, bitmaps, cuts):
+    assert bitmaps.mask(ntuple, cuts) is None
+    assert bitmaps.selection(ntuple, cuts) is None
+
+    # The entries are still found, by reading the cut branches
+    np.testing.assert_array_equal(read_branch(ntuple, "TauJets.etaJetSeed")[bitmaps.entries(ntuple, cuts)],
+                                  read_branch(ntuple, "TauJets.etaJetSeed", cuts))
+
+
+@pytest.mark.parametrize("cuts", RESOLVED_CUTS[1:] + UNRESOLVED_CUTS)
+def test_index_selection_with_bitmaps(ntuple, tmp_path, bitmaps, cuts):
+    index = NTupleIndex(directory=str(tmp_path / "bitmap_index"), bitmaps=bitmaps)
+    assert index.selection(ntuple, cuts) == NTupleIndex(directory=str(tmp_path / "index")).selection(ntuple, cuts)
+
+
+@pytest.mark.parametrize("cuts", RESOLVED_CUTS[1:] + UNRESOLVED_CUTS)
+def test_reader_with_bitmaps(ntuple, index, bitmaps, cuts):
+    reader = NTupleReader([ntuple], BRANCHES, cuts=cuts, step_size=300, index=index, bitmaps=bitmaps,
+                          zone_maps=False)
+    batch, entries = reader.read(ntuple, 0, 2000, return_entries=True)
+    assert_arrays_equal(batch, uproot_read(ntuple, BRANCHES, cuts), BRANCHES)
+    np.testing.assert_array_equal(entries, bitmaps.entries(ntuple, cuts))
+
+
+def test_bitmaps_rebuilt_when_file_changes(tmp_path, bitmaps):
+    file = str(make_ntuple(tmp_path / "ntuple.root", seed=1))
+    cuts = RESOLVED_CUTS[3]
+    before = bitmaps.selection(file, cuts)
+    assert os.listdir(bitmaps.directory)
+
+    make_ntuple(file, seed=2)
+    stat = os.stat(file)
+    os.utime(file, (stat.st_atime, stat.st_mtime + 10))
+
+    index = NTupleIndex(directory=str(tmp_path / "index"))
+    after = BitmapIndex(directory=bitmaps.directory, index=index).selection(file, cuts)
+    assert after != before
+    assert after["num_passing"] == len(read_branch(file, "TauJets.truthDecayMode", cuts))
@@ -0,0 +1,71 @@
+"""
+Tests of the padding kernels in scripts/DataLoader.py against the awkward array chain they replaced
+"""
+
+import numpy as np
+import awkward as ak
+import pytest
+from config.variables import Variable
+from scripts.DataLoader import pad_ragged_array, pad_nested_arrays
+
+
+def reference_padding(array, max_items, dummy_val=-1):
+    """
+    The ak.pad_none -> abs -> fill_none -> to_numpy -> nan_to_num chain used before pad_ragged_array
+    """
+    padded = ak.fill_none(ak.pad_none(abs(array), max_items, clip=True), dummy_val)
+    return np.nan_to_num(ak.to_numpy(padded), nan=0, posinf=0, neginf=0).astype(np.float32)
+
+
+def ragged_array(seed, nevents=200, max_count=7):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(0, max_count, nevents)
+    content = rng.normal(0, 100, counts.sum()).astype(np.float32)
+    special = rng.choice(len(content), size=min(len(content), 20), replace=False)
+    content[special] = rng.choice([np.nan, np.inf, -np.inf], size=len(special))
+    return ak.unflatten(content, counts)
+
+
+@pytest.mark.parametrize("max_items", [1, 3, 10])
+@pytest.mark.parametrize("dummy_val", [-1, 0])
+def test_pad_ragged_array_matches_awkward(max_items, dummy_val):
+    array = ragged_array(seed=max_items)
+    counts = ak.to_numpy(ak.num(array, axis=1)).astype(np.int64)
+    content = ak.to_numpy(ak.flatten(array))
+    out = np.full((len(counts), 2, max_items), np.nan, dtype=np.float32)
+
+    pad_ragged_array(counts, content, out, 1, dummy_val)
+
+    np.testing.assert_array_equal(out[:, 1], reference_padding(array, max_items, dummy_val))
+    assert np.isnan(out[:, 0]).all()
+
+
+def test_pad_ragged_array_empty_events():
+    counts = np.zeros(4, dtype=np.int64)
+    out = np.empty((4, 1, 3), dtype=np.float32)
+    pad_ragged_array(counts, np.zeros(0, dtype=np.float32), out, 0)
+    np.testing.assert_array_equal(out, -1)
+
+
+def test_pad_nested_arrays_matches_awkward():
+    batch = {"TauTracks.pt": ragged_array(seed=1), "TauTracks.eta": ragged_array(seed=1) * 0.01}
+    variables = [Variable("TauTracks", "TauTracks.pt"), Variable("TauTracks", "TauTracks.eta")]
+
+    out = pad_nested_arrays(batch, variables, 3)
+
+    assert out.shape == (len(batch["TauTracks.pt"]), 2, 3) and out.dtype == np.float32
+    for i, variable in enumerate(variables):
+        np.testing.assert_array_equal(out[:, i], reference_padding(batch[variable.name], 3))
+
+
+def test_pad_nested_arrays_sorted():
+    pt = ragged_array(seed=2)
+    pt = ak.where(np.isnan(pt), 0, pt)
+    batch = {"TauTracks.pt": pt, "TauTracks.index": ak.values_astype(ak.local_index(pt), np.float32)}
+    variables = [Variable("TauTracks", "TauTracks.index")]
+
+    out = pad_nested_arrays(batch, variables, 3, sort_by="TauTracks.pt")
+
+    # The objects with the largest pT are kept, largest first, ties keeping the order of the NTuple
+    order = ak.argsort(-pt, axis=1, stable=True)
+    np.testing.assert_array_equal(out[:, 0], reference_padding(batch["TauTracks.index"][order], 3))
@@ -0,0 +1,78 @@
+"""
+Tests of the storage encodings and block compressors of scripts/FeatureCodec.py
+"""
+
+import numpy as np
+import pytest
+from scripts.FeatureCodec import encode, decode, get_compressor, storage_dtypes
+
+
+def round_trip(arr, storage):
+    encoded = encode(arr, storage)
+    assert encoded.dtype == storage_dtypes[storage]
+    decoded = decode(encoded, storage)
+    assert decoded.shape == arr.shape
+    return decoded
+
+
+@pytest.fixture
+def features():
+    rng = np.random.default_rng(0)
+    arr = rng.lognormal(0, 3, (50, 3, 4)).astype(np.float32) * rng.choice([-1, 1], (50, 3, 4))
+    arr[:, :, 3] = -1
+    return arr
+
+
+@pytest.mark.parametrize("storage", ["float32", "int8", "int64"])
+def test_lossless_storage_is_not_copied(storage):
+    arr = np.arange(-5, 5, dtype=storage_dtypes[storage])
+    assert decode(encode(arr, storage), storage) is arr
+
+
+def test_float16(features):
+    features = np.clip(features, -60000, 60000)
+    decoded = round_trip(features, "float16")
+    assert decoded.dtype == np.float32
+    np.testing.assert_allclose(decoded, features, rtol=2 ** -11, atol=2 ** -24)
+    np.testing.assert_array_equal(decoded[:, :, 3], -1)
+
+
+def test_bfloat16(features):
+    features[0, 0, :3] = [np.nan, np.inf, -np.inf]
+    decoded = round_trip(features, "bfloat16")
+    assert decoded.dtype == np.float32
+    np.testing.assert_allclose(decoded[1:], features[1:], rtol=2 ** -8)
+    np.testing.assert_array_equal(decoded[:, :, 3], -1)
+    assert np.isnan(decoded[0, 0, 0]) and decoded[0, 0, 1] == np.inf and decoded[0, 0, 2] == -np.inf
+
+
+def test_bfloat16_rounds_to_nearest_even():
+    ulp = 2.0 ** -7
+    arr = np.array([1 + ulp / 2, 1 + 3 * ulp / 2, 1 + ulp / 2 + 2 ** -20, -1 - ulp / 4], dtype=np.float32)
+    expected = np.array([1, 1 + 2 * ulp, 1 + ulp, -1], dtype=np.float32)
+    np.testing.assert_array_equal(round_trip(arr, "bfloat16"), expected)
+
+
+def test_uint8():
+    arr = np.array([-1, 0, 1, 7, 254, 2.4, 2.6, 300, -5, np.nan], dtype=np.float32)
+    expected = np.array([-1, 0, 1, 7, 254, 2, 3, 254, -1, -1], dtype=np.float32)
+    np.testing.assert_array_equal(round_trip(arr, "uint8"), expected)
+
+
+def test_unknown_storage():
+    with pytest.raises(ValueError):
+        encode(np.zeros(3, dtype=np.float32), "float8")
+
+
+@pytest.mark.parametrize("name, package", [("lz4", "lz4"), ("zstd", "zstandard")])
+@pytest.mark.parametrize("level", [None, 1])
+def test_compressor_round_trip(features, name, package, level):
+    pytest.importorskip(package)
+    compress, decompress = get_compressor(name, level)
+    data = encode(features, "bfloat16").tobytes()
+    assert decompress(compress(data)) == data
+
+
+def test_unknown_compressor():
+    with pytest.raises(ValueError):
+        get_compressor("gzip")
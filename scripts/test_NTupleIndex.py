@@ -0,0 +1,122 @@
+"""
+Tests of the file records, selections and batch layouts of scripts/NTupleIndex.py
+"""
+
+import os
+import numpy as np
+import pytest
+import uproot
+from scripts.NTupleIndex import NTupleIndex
+from scripts.ImportanceSampler import ImportanceSampler
+from scripts.conftest import CLUSTER_SIZE, NUM_CLUSTERS, make_ntuple
+
+
+@pytest.fixture
+def index(tmp_path):
+    return NTupleIndex(directory=str(tmp_path / "index"))
+
+
+@pytest.mark.parametrize("entry_start, step_size, expected", [
+    (0, 100, 100),
+    (0, 120, 100),
+    (0, 160, 200),
+    (0, 150, 100),
+    (100, 100, 200),
+    (0, 40, None),
+    (0, 1000, 1000),
+    (0, 10000, None),
+    (950, 100, 1000),
+])
+def test_nearest_cluster(entry_start, step_size, expected):
+    clusters = [0, 100, 200, 300, 1000]
+    assert NTupleIndex._nearest_cluster(clusters, entry_start, step_size) == expected
+
+
+def test_record(ntuple, index):
+    record = index.record(ntuple)
+    assert record["num_entries"] == CLUSTER_SIZE * NUM_CLUSTERS
+    assert record["clusters"] == list(range(0, CLUSTER_SIZE * NUM_CLUSTERS + 1, CLUSTER_SIZE))
+    assert record["tree"] == "tree"
+
+    # A second index reads the record back from disk
+    assert NTupleIndex(directory=index.directory).record(ntuple) == record
+
+
+def test_record_rebuilt_when_file_changes(tmp_path, index):
+    file = str(make_ntuple(tmp_path / "ntuple.root"))
+    index.selection(file, "TauJets.truthProng == 1")
+    stat = os.stat(file)
+    os.utime(file, (stat.st_atime, stat.st_mtime + 10))
+
+    record = NTupleIndex(directory=index.directory).record(file)
+
+    assert record["mtime"] == stat.st_mtime + 10
+    assert record["selections"] == {}
+
+
+@pytest.mark.parametrize("step_size", [100, 250, 300, 600, 5000])
+def test_batch_layout_aligned(ntuple, index, step_size):
+    layout = index.batch_layout([ntuple, ntuple], step_size)
+    clusters = index.record(ntuple)["clusters"]
+
+    for file in (0, 1):
+        steps = [(start, stop) for _, start, stop in layout[file * len(layout) // 2: (file + 1) * len(layout) // 2]]
+        # The steps cover every entry of the file once, in order
+        assert steps[0][0] == 0 and steps[-1][1] == clusters[-1]
+        assert all(stop == next_start for (_, stop), (next_start, _) in zip(steps[:-1], steps[1:]))
+        # Steps are split at cluster boundaries when there is one within a factor of two of step_size
+        if step_size >= CLUSTER_SIZE // 2:
+            assert all(stop in clusters for _, stop in steps)
+            assert all(step_size // 2 <= stop - start <= 2 * step_size for start, stop in steps[:-1])
+
+
+def test_batch_layout_unaligned(ntuple, index):
+    layout = index.batch_layout([ntuple], 300, align=False)
+    num_entries = CLUSTER_SIZE * NUM_CLUSTERS
+    expected = [(ntuple, start, min(start + 300, num_entries)) for start in range(0, num_entries, 300)]
+    assert layout == expected
+    assert index.num_batches([ntuple], 300, align=False) == len(expected)
+
+
+@pytest.mark.parametrize("cuts", [None, "TauJets.ptJetSeed > 15000.0",
+                                  "(TauJets.ptJetSeed > 20000.0) & (TauJets.truthProng == 3)"])
+def test_selection_matches_uproot(ntuple, index, cuts):
+    with uproot.open(ntuple) as file:
+        decay_modes = file["tree"].arrays(filter_name="TauJets.truthDecayMode", cut=cuts,
+                                          library='np')["TauJets.truthDecayMode"]
+
+    selection = index.selection(ntuple, cuts)
+
+    assert selection["num_passing"] == len(decay_modes)
+    assert selection["decay_mode_counts"] == {str(dm): int(np.count_nonzero(decay_modes == dm))
+                                              for dm in np.unique(decay_modes)}
+    assert index.num_events([ntuple, ntuple], cuts) == 2 * len(decay_modes)
+
+
+class FakeReweighter:
+
+    def __init__(self, scale):
+        self.scale = scale
+
+    def reweight(self, jet_pt):
+        return jet_pt / self.scale
+
+    def fingerprint(self):
+        return f"{self.scale:016}"
+
+
+def test_sampled_fraction(ntuple, index):
+    cuts = "TauJets.ptJetSeed > 15000.0"
+    sampler = ImportanceSampler(FakeReweighter(40000), floor=0.1)
+    with uproot.open(ntuple) as file:
+        jet_pt = file["tree"].arrays(filter_name="TauJets.ptJetSeed", cut=cuts, library='np')["TauJets.ptJetSeed"]
+    expected = np.mean(np.clip(jet_pt / 40000, 0.1, 1))
+
+    assert index.sampled_fraction(ntuple, sampler, cuts) == pytest.approx(expected, rel=1e-6)
+
+    # The fraction is stored with the selection, for each re-weighting
+    stored = NTupleIndex(directory=index.directory).selection(ntuple, cuts)["sampled_fractions"]
+    assert stored == {sampler.fingerprint(): pytest.approx(expected, rel=1e-6)}
+    other = ImportanceSampler(FakeReweighter(20000), floor=0.1)
+    assert index.sampled_fraction(ntuple, other, cuts) > index.sampled_fraction(ntuple, sampler, cuts)
+    assert index.sampled_fraction(ntuple, sampler, "TauJets.ptJetSeed > 1e9") == 1.0
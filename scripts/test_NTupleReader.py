@@ -0,0 +1,179 @@
+"""
+Tests of the two-phase reads of scripts/NTupleReader.py, and of skipping clusters with the zone maps, against a direct
+uproot read with cut=
+"""
+
+import operator
+import numpy as np
+import awkward as ak
+import pytest
+import uproot
+from scripts.NTupleIndex import NTupleIndex
+from scripts.NTupleReader import NTupleReader, Predicate, PartialMask, ZoneColumn, passing_ranges
+from scripts.conftest import CLUSTER_SIZE
+
+BRANCHES = ["TauJets.ptJetSeed", "TauJets.centFrac", "TauTracks.pt"]
+
+CUTS = ["TauJets.ptJetSeed > 15000.0",
+        "(TauJets.ptJetSeed > 15000.0) & (TauJets.truthProng == 1)",
+        "(TauJets.ptJetSeed >= 20000.0) & (TauJets.ptJetSeed < 40000.0) & (TauJets.truthDecayMode == 2)",
+        "(TauJets.truthDecayMode == 4) | (abs(TauJets.etaJetSeed) < 1.37)",
+        "TauJets.ptJetSeed != 20000.0",
+        "TauJets.centFrac > 0.5",
+        "TauJets.ptJetSeed > 1e9"]
+
+# Cuts the zone maps cannot be evaluated on
+BRANCH_CUTS = ["TauJets.ptJetSeed > TauJets.centFrac * 40000",
+               "(TauJets.ptJetSeed > 15000.0) & (TauJets.truthProng == TauJets.truthDecayMode)"]
+
+
+def uproot_read(file, branches, cuts):
+    with uproot.open(file) as ntuple:
+        return ntuple["tree"].arrays(filter_name=branches, cut=cuts)
+
+
+def assert_arrays_equal(batch, expected, branches):
+    assert len(batch) == len(expected)
+    for branch in branches:
+        if batch[branch].ndim > 1:
+            np.testing.assert_array_equal(ak.num(batch[branch], axis=1), ak.num(expected[branch], axis=1))
+        np.testing.assert_array_equal(ak.to_numpy(ak.flatten(batch[branch], axis=None)),
+                                      ak.to_numpy(ak.flatten(expected[branch], axis=None)))
+
+
+@pytest.fixture
+def index(tmp_path):
+    return NTupleIndex(directory=str(tmp_path / "index"))
+
+
+def test_predicate_branches():
+    predicate = Predicate("(TauJets.ptJetSeed > 15000.0) & (np.abs(TauJets.etaJetSeed) < 2.5) "
+                          "& (TauJets.ptJetSeed < 1e6)")
+    assert predicate.branches == ["TauJets.ptJetSeed", "TauJets.etaJetSeed"]
+
+
+def test_predicate_evaluates_like_numpy():
+    rng = np.random.default_rng(0)
+    arrays = {"TauJets.ptJetSeed": rng.uniform(0, 50000, 100), "TauJets.truthProng": rng.choice([1, 3], 100)}
+    predicate = Predicate("(TauJets.ptJetSeed > 15000.0) & (TauJets.truthProng == 1)")
+    expected = (arrays["TauJets.ptJetSeed"] > 15000.0) & (arrays["TauJets.truthProng"] == 1)
+    np.testing.assert_array_equal(predicate(arrays), expected)
+
+
+@pytest.mark.parametrize("mask, max_gap, expected", [
+    ([], 0, []),
+    ([0, 0, 0], 0, []),
+    ([1, 1, 1], 0, [(0, 3)]),
+    ([0, 1, 1, 0, 1, 0], 0, [(1, 3), (4, 5)]),
+    ([0, 1, 1, 0, 1, 0], 1, [(1, 5)]),
+    ([1, 0, 0, 1, 0, 0, 0, 1], 2, [(0, 4), (7, 8)]),
+    ([1, 0, 0, 1, 0, 0, 0, 1], 3, [(0, 8)]),
+])
+def test_passing_ranges(mask, max_gap, expected):
+    assert passing_ranges(np.array(mask, dtype=bool), max_gap) == expected
+
+
+@pytest.mark.parametrize("max_gap", [0, 1000])
+@pytest.mark.parametrize("cuts", CUTS)
+def test_read_matches_uproot_cut(ntuple, index, cuts, max_gap):
+    reader = NTupleReader([ntuple], BRANCHES, cuts=cuts, max_gap=max_gap, index=index, zone_maps=False)
+    num_entries = index.record(ntuple)["num_entries"]
+
+    batch, entries = reader.read(ntuple, 0, num_entries, return_entries=True)
+
+    assert_arrays_equal(batch, uproot_read(ntuple, BRANCHES, cuts), BRANCHES)
+    with uproot.open(ntuple) as file:
+        arrays = file["tree"].arrays(filter_name=Predicate(cuts).branches, library='np')
+    np.testing.assert_array_equal(entries, np.flatnonzero(Predicate(cuts)(arrays)))
+
+
+@pytest.mark.parametrize("cuts", [None, CUTS[1]])
+def test_steps_match_uproot_iterate(ntuple, index, cuts):
+    reader = NTupleReader([ntuple], BRANCHES, cuts=cuts, step_size=300, index=index, align=False, zone_maps=False)
+    with uproot.open(ntuple) as file:
+        expected = list(file["tree"].iterate(filter_name=BRANCHES, cut=cuts, step_size=300))
+
+    batches = list(reader)
+
+    assert len(batches) == len(expected)
+    for batch, expected_batch in zip(batches, expected):
+        assert_arrays_equal(batch, expected_batch, BRANCHES)
+
+
+def random_partial_mask(rng, size=1000):
+    """
+    :return: A PartialMask and a boolean array lying between its bounds
+    """
+    sure = rng.random(size) < 0.3
+    maybe = sure | (rng.random(size) < 0.3)
+    truth = sure | (maybe & (rng.random(size) < 0.5))
+    return PartialMask(sure, maybe), truth
+
+
+def assert_bounds(partial_mask, truth):
+    assert not (partial_mask.sure & ~truth).any()
+    assert not (truth & ~partial_mask.maybe).any()
+
+
+def test_partial_mask_operators():
+    rng = np.random.default_rng(0)
+    (a, truth_a), (b, truth_b) = random_partial_mask(rng), random_partial_mask(rng)
+    assert_bounds(a & b, truth_a & truth_b)
+    assert_bounds(a | b, truth_a | truth_b)
+    assert_bounds(~a, ~truth_a)
+    assert_bounds(~(a & ~b) | b, ~(truth_a & ~truth_b) | truth_b)
+    assert PartialMask(truth_a, truth_a).exact() and not a.exact()
+    with pytest.raises(TypeError):
+        a & truth_b
+
+
+@pytest.mark.parametrize("op", [operator.lt, operator.le, operator.gt, operator.ge, operator.eq, operator.ne])
+def test_zone_column(op):
+    rng = np.random.default_rng(0)
+    clusters = [np.array([1.0, 2.0, 3.0]), np.array([3.0, 3.0]), np.array([np.nan, np.nan]),
+                np.array([2.0, np.nan, 5.0]), rng.integers(0, 6, 10).astype(np.float64)]
+    zone = {"min": [float(np.nanmin(c)) if not np.isnan(c).all() else np.nan for c in clusters],
+            "max": [float(np.nanmax(c)) if not np.isnan(c).all() else np.nan for c in clusters],
+            "nan": [bool(np.isnan(c).any()) for c in clusters]}
+
+    for value in (0, 1, 1.5, 2, 3, 4, 5, 6):
+        with np.errstate(invalid='ignore'):
+            bounds = op(ZoneColumn(zone, 1, len(clusters)), value)
+        for i, cluster in enumerate(clusters[1:]):
+            passing = op(cluster, value)
+            assert not bounds.sure[i] or passing.all()
+            assert bounds.maybe[i] or not passing.any()
+
+
+def test_zone_column_compares_with_numbers_only():
+    zone = {"min": [0.0], "max": [1.0], "nan": [False]}
+    with pytest.raises(TypeError):
+        ZoneColumn(zone, 0, 1) > ZoneColumn(zone, 0, 1)
+    with pytest.raises(TypeError):
+        ZoneColumn(zone, 0, 1) == ZoneColumn(zone, 0, 1)
+
+
+def test_zone_maps_skip_clusters(ntuple, index):
+    reader = NTupleReader([ntuple], BRANCHES, cuts="TauJets.ptJetSeed > 40000.0", index=index)
+
+    bounds = reader._zone_bounds(ntuple, 100, 2000)
+
+    # ptJetSeed rises through the file so the first clusters cannot pass and the last surely passes
+    assert len(bounds.maybe) == 1900
+    assert not bounds.maybe[:2 * CLUSTER_SIZE - 100].any()
+    assert bounds.sure[-CLUSTER_SIZE:].all()
+    assert NTupleReader([ntuple], BRANCHES, cuts=BRANCH_CUTS[0], index=index)._zone_bounds(ntuple, 0, 2000) is None
+
+
+@pytest.mark.parametrize("cuts", CUTS + BRANCH_CUTS)
+def test_read_with_zone_maps_matches_uproot_cut(ntuple, index, cuts):
+    reader = NTupleReader([ntuple], BRANCHES, cuts=cuts, step_size=300, max_gap=10, index=index)
+    with uproot.open(ntuple) as file:
+        expected = list(file["tree"].iterate(filter_name=BRANCHES, cut=cuts, step_size=300))
+    unaligned = NTupleReader([ntuple], BRANCHES, cuts=cuts, step_size=300, max_gap=10, index=index, align=False)
+
+    assert_arrays_equal(ak.concatenate(list(reader)), uproot_read(ntuple, BRANCHES, cuts), BRANCHES)
+    batches = list(unaligned)
+    assert len(batches) == len(expected)
+    for batch, expected_batch in zip(batches, expected):
+        assert_arrays_equal(batch, expected_batch, BRANCHES)
@@ -0,0 +1,250 @@
+"""
+Tests of the shards of scripts/TensorCache.py - writing and reading them back, making new shards when the NTuple or the
+settings change and adding columns when the variables change
+"""
+
+import os
+import threading
+import numpy as np
+import pytest
+from config.variables import Variable, VariableHandler
+from scripts.TensorCache import TensorCache, file_fingerprint
+
+MAX_ITEMS = {"TauTracks": 3, "NeutralPFO": 2, "ShotPFO": 2, "ConvTrack": 2}
+
+
+def make_handler(storage="float32", extra=()):
+    variables = [Variable(var_type, f"{var_type}.{name}", storage=storage) for var_type in TensorCache.feature_names
+                 for name in ("a", "b")]
+    return VariableHandler(variables + [Variable("TauJets", name) for name in extra])
+
+
+def random_batch(cache, num_events, seed=0):
+    rng = np.random.default_rng(seed)
+    features, labels, weights = cache.empty(num_events)
+    for arr in features:
+        arr[:] = rng.integers(-1, 50, arr.shape)
+    labels[:] = rng.integers(0, 6, num_events)
+    weights[:] = rng.uniform(0, 1, num_events)
+    return features, labels, weights
+
+
+def fill(cache, num_events, seed=0):
+    """
+    Materialize a new shard of num_events events
+    :return: features, labels, weights written to the shard
+    """
+    features, labels, weights = random_batch(cache, num_events, seed)
+    cache.allocate(num_events + 10)
+    position = cache.write(0, tuple(arr[:5] for arr in features), labels[:5], weights[:5], np.arange(5))
+    cache.write(position, tuple(arr[5:] for arr in features), labels[5:], weights[5:], np.arange(5, num_events))
+    cache.finalise(num_events)
+    return features, labels, weights
+
+
+@pytest.fixture
+def file(tmp_path):
+    path = tmp_path / "ntuple.root"
+    path.write_bytes(b"ntuple contents")
+    return str(path)
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return str(tmp_path / "cache")
+
+
+@pytest.mark.parametrize("precision, compression", [("full", None), ("reduced", None), ("reduced", "zstd")])
+def test_round_trip(file, cache_dir, precision, compression):
+    if compression is not None:
+        pytest.importorskip("zstandard")
+    cache = TensorCache(cache_dir, "JZ1", file, make_handler(storage="uint8"), MAX_ITEMS, precision=precision,
+                        compression=compression, block_events=4)
+    missing = {name: [0, 1] for name in TensorCache.feature_names}
+    missing["weights"] = [0]
+    assert not cache.exists() and cache.missing_variables() == missing
+    features, labels, weights = fill(cache, 23)
+
+    cache = TensorCache(cache_dir, "JZ1", file, make_handler(storage="uint8"), MAX_ITEMS, precision=precision,
+                        compression=compression, block_events=4)
+    assert cache.is_complete()
+    assert cache.open() == 23
+    np.testing.assert_array_equal(cache.entries(), np.arange(23))
+    out_features, out_labels, out_weights = cache.get(3, 30)
+    for arr, out_arr in zip(features, out_features):
+        np.testing.assert_array_equal(out_arr, arr[3:])
+    np.testing.assert_array_equal(out_labels, labels[3:])
+    np.testing.assert_array_equal(out_weights, weights[3:])
+    assert os.listdir(cache.directory) == [cache.name]
+
+
+def test_new_shard_when_file_modified(file, cache_dir):
+    cache = TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS, fingerprint="mtime")
+    fill(cache, 10)
+    stat = os.stat(file)
+    os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    modified = TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS, fingerprint="mtime")
+
+    assert modified.name != cache.name and modified.directory == cache.directory
+    assert not modified.exists() and cache.exists()
+
+
+def test_content_fingerprint(file, cache_dir):
+    cache = TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS, fingerprint="content")
+    fill(cache, 10)
+
+    # Touching the file keeps the shard, changing its contents does not
+    stat = os.stat(file)
+    os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    touched = TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS, fingerprint="content")
+    assert touched.name == cache.name and touched.is_complete()
+
+    with open(file, 'wb') as f:
+        f.write(b"new ntuple contents")
+    replaced = TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS, fingerprint="content")
+    assert replaced.name != cache.name and not replaced.exists()
+
+
+def test_content_fingerprint_memo(file, tmp_path):
+    memo_dir = str(tmp_path / "memo")
+    fingerprint = file_fingerprint(file, mode="content", memo_dir=memo_dir)
+    assert os.path.isfile(os.path.join(memo_dir, "fingerprints.json"))
+    assert file_fingerprint(file, mode="content", memo_dir=memo_dir) == fingerprint
+    with pytest.raises(ValueError):
+        file_fingerprint(file, mode="size")
+
+
+@pytest.mark.parametrize("settings", [{"cuts": "TauJets.ptJetSeed > 15000.0"}, {"prong": 1},
+                                      {"precision": "reduced"}])
+def test_new_shard_when_settings_change(file, cache_dir, settings):
+    cache = TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS)
+    fill(cache, 10)
+
+    changed = TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS, **settings)
+
+    assert changed.directory != cache.directory and not changed.exists()
+
+
+def test_first_finished_shard_is_kept(file, cache_dir):
+    first = TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS)
+    second = TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS)
+    features, _, _ = random_batch(first, 10, seed=1)
+    second.allocate(10)
+    fill(first, 10, seed=1)
+    second.write(0, *random_batch(second, 10, seed=2), np.arange(10))
+
+    second.finalise(10)
+
+    assert second.open() == 10
+    np.testing.assert_array_equal(second.get(0, 10)[0][0], features[0])
+    assert os.listdir(first.directory) == [first.name]
+
+
+class FakeReweighter:
+
+    def __init__(self, fingerprint):
+        self._fingerprint = fingerprint
+
+    def fingerprint(self):
+        return self._fingerprint
+
+
+def add_columns(cache, num_events, seed=0):
+    """
+    Materialize the missing columns of an existing shard
+    :return: The dict of arrays written
+    """
+    rng = np.random.default_rng(seed)
+    missing = cache.missing_variables()
+    cache.allocate(num_events, missing=missing)
+    features = {}
+    for name, indices in missing.items():
+        shape = (num_events, len(indices)) + (cache.shape(name)[1:] if name in TensorCache.feature_names else ())
+        features[name] = rng.integers(-1, 50, shape).astype(np.float32)
+    cache.write_variables(0, features)
+    cache.finalise(num_events)
+    return features
+
+
+@pytest.mark.parametrize("changed, expected", [
+    (make_handler(extra=["TauJets.new"]), {"TauJets": [2]}),
+    (VariableHandler([Variable("TauTracks", "TauTracks.a", storage="uint8")] + make_handler().variables[1:]),
+     {"TauTracks": [0]}),
+    (VariableHandler([Variable("TauJets", "TauJets.a", max_val=10, lognorm=True)] + make_handler().variables), {}),
+])
+def test_changed_variables_are_missing(file, cache_dir, changed, expected):
+    fill(TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS, precision="reduced"), 10)
+
+    cache = TensorCache(cache_dir, "JZ1", file, changed, MAX_ITEMS, precision="reduced")
+
+    assert cache.exists() and cache.missing_variables() == expected
+
+
+def test_changed_sorting_is_missing(file, cache_dir):
+    fill(TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS), 10)
+    cache = TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS, sort_items={"NeutralPFO": "NeutralPFO.a"})
+    assert cache.missing_variables() == {"NeutralPFO": [0, 1]}
+
+
+def test_add_columns(file, cache_dir):
+    features, _, _ = fill(TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS), 10)
+    cache = TensorCache(cache_dir, "JZ1", file, make_handler(extra=["TauJets.new"]), MAX_ITEMS)
+
+    added = add_columns(cache, 10)
+
+    assert cache.is_complete() and cache.open() == 10
+    out_features, _, _ = cache.get(0, 10)
+    np.testing.assert_array_equal(out_features[4][:, :2], features[4])
+    np.testing.assert_array_equal(out_features[4][:, 2], added["TauJets"][:, 0])
+    # The shard still serves the variables it was made with
+    assert TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS).is_complete()
+
+
+def test_columns_added_at_the_same_time_are_kept(file, cache_dir):
+    fill(TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS), 10)
+    caches = [TensorCache(cache_dir, "JZ1", file, make_handler(extra=[f"TauJets.new{i}"]), MAX_ITEMS)
+              for i in range(8)]
+    barrier = threading.Barrier(len(caches))
+
+    def add(cache):
+        missing = cache.missing_variables()
+        cache.allocate(10, missing=missing)
+        cache.write_variables(0, {"TauJets": np.zeros((10, 1), dtype=np.float32)})
+        barrier.wait()
+        cache.finalise(10)
+
+    threads = [threading.Thread(target=add, args=(cache,)) for cache in caches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(cache.is_complete() for cache in caches)
+
+
+def test_weights_follow_reweighter(file, cache_dir):
+    features, labels, weights = fill(TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS,
+                                                 reweighter=FakeReweighter("a" * 16)), 10)
+
+    cache = TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS, reweighter=FakeReweighter("b" * 16))
+    assert cache.missing_variables() == {"weights": [0]}
+    added = add_columns(cache, 10)
+    cache.open()
+    np.testing.assert_array_equal(cache.get(0, 10)[2], added["weights"][:, 0])
+
+    cache = TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS, reweighter=FakeReweighter("a" * 16))
+    assert cache.is_complete()
+    cache.open()
+    np.testing.assert_array_equal(cache.get(0, 10)[2], weights)
+
+
+def test_prune(file, cache_dir):
+    fill(TensorCache(cache_dir, "JZ1", file, make_handler(extra=["TauJets.old"]), MAX_ITEMS), 10)
+    cache = TensorCache(cache_dir, "JZ1", file, make_handler(), MAX_ITEMS)
+    nbytes = cache.nbytes()
+
+    assert cache.prune() == 1
+    assert cache.nbytes() == nbytes and cache.is_complete()
+    pruned = TensorCache(cache_dir, "JZ1", file, make_handler(extra=["TauJets.old"]), MAX_ITEMS)
+    assert pruned.missing_variables() == {"TauJets": [2]}
@@ -9,7 +9,6 @@ FileHandler: A class to make the handling of file list easier
 """
 
 import time
-import uproot
 from tqdm import tqdm
 from pathlib import Path
 from datetime import datetime, timedelta
@@ -274,20 +273,23 @@ def get_best_weights(search_dir="network_weights"):
 def get_number_of_events(fh_list):
     """
     Given a list of FileHandler Objects computes the number of events belonging to each class
+    Counts are read from the NTuple index so files only need to be scanned the first time they are seen
     """
+    # Imported here since NTupleIndex itself imports the logger from this file
+    from scripts.NTupleIndex import NTupleIndex
+    index = NTupleIndex()
     njets = n1p0n = n1p1n = n1pXn = n3p0n = n3p1n = 0
 
     for fh in tqdm(fh_list):
-        data = uproot.concatenate(fh.file_list, filter_name="TauJets.truthDecayMode", library='np')
-        data = data["TauJets.truthDecayMode"]
+        counts = index.decay_mode_counts(fh.file_list)
         if fh.label == "Gammatautau":
-            n1p0n += np.count_nonzero(data == 0)
-            n1p1n += np.count_nonzero(data == 1)
-            n1pXn += np.count_nonzero(data == 2)
-            n3p0n += np.count_nonzero(data == 3)
-            n3p1n += np.count_nonzero(data == 4)
+            n1p0n += counts.get(0, 0)
+            n1p1n += counts.get(1, 0)
+            n1pXn += counts.get(2, 0)
+            n3p0n += counts.get(3, 0)
+            n3p1n += counts.get(4, 0)
         else:
-            njets += len(data)
+            njets += sum(counts.values())
 
     return njets, n1p0n, n1p1n, n1pXn, n3p0n, n3p1n
 
@@ -301,6 +303,16 @@ def none_or_int(value):
         return None
     return int(value)
 
+
+def int_or_auto(value):
+    """
+    A little function that will return 'auto' if parsed 'auto' or a int. Used to parse -shards argument
+    :param value: A string that is either 'auto' or an integer
+    """
+    if value == 'auto':
+        return value
+    return int(value)
+
 def bytes_to_human(n_bytes):
     """
     Convert bytes to a human readable string
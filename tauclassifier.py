@@ -7,6 +7,9 @@ Example usages:
 python3 tauclassifier.py train
 python3 tauclassifier.py test -weights=network_weights/weights-20.h5
 python3 tauclassifier.py scan -lr_range 5e-4 1e-1 10
+python3 tauclassifier.py benchmark -benchmark=padding
+python3 tauclassifier.py cache -cache_workers=8
+python3 tauclassifier.py multiplicity -coverage=0.99
 """
 
 import os
@@ -20,7 +23,13 @@ from run.test import test
 from run.lr_scan import lr_scan
 from run.plot_previous_results import plot_previous
 from run.plot_variables import plot_variables
-from scripts.utils import logger, get_best_weights, none_or_int, run_training_on_batch_system
+from run.benchmark import benchmark, benchmarks_dict
+from run.cache import build_cache
+from run.multiplicity import profile_multiplicity
+from scripts.TensorCache import TensorCache
+from scripts.FeatureCodec import compressions
+from scripts.LoaderBackends import backends_dict
+from scripts.utils import logger, get_best_weights, none_or_int, int_or_auto, run_training_on_batch_system
 from config.config import models_dict
 # from experimental.tau_classifier_dataset.tau_classifier_dataset_test import run_test
 
@@ -35,7 +44,7 @@ def main():
     # Available options
 
     # 'train' - train model | 'evaluate' =  make npz files of predictions for test data | 'plot' - make performance plots
-    mode_list = ["train", "evaluate", "test", "rank", "scan", "plot_previous", "plot_variables", "experiment"]  
+    mode_list = ["train", "evaluate", "test", "rank", "scan", "plot_previous", "plot_variables", "benchmark", "cache", "multiplicity", "experiment"]  
 
     # Prong options: 1 - (p10n, 1p1n, 1pxn, jets) | 3 - (3p0n, 3pxn, jets) | None - (p10n, 1p1n, 1pxn, 3p0n, 3pxn, jets)
     prong_list = [1, 3, None]                                           
@@ -63,6 +72,35 @@ def main():
     parser.add_argument("-function", help="Scratch function to run")
     parser.add_argument("-condor", help='Run on ht condor batch system', type=bool, default=False)
     parser.add_argument("-load", help="Load last saved network predictions", type=bool, default=False)
+    parser.add_argument("-benchmark", help="Benchmark to run in benchmark mode", type=str, choices=list(benchmarks_dict.keys()), default="padding")
+    parser.add_argument("-pipeline", help="Input pipeline: 'sequence' uses the DataGenerator as a keras Sequence, 'tfdata' builds a tf.data.Dataset from the DataLoaders", type=str, choices=["sequence", "tfdata"], default="sequence")
+    parser.add_argument("-tfdata_cache", help="When using -pipeline=tfdata cache the standardised batches in memory after the first epoch", type=bool, default=False)
+    parser.add_argument("-prefetch_depth", help="Number of super-batches each DataGenerator requests from its DataLoaders ahead of time", type=int, default=1)
+    parser.add_argument("-prefetch_mb", help="Limit on the object store memory (in MB) taken up by prefetched super-batches", type=none_or_int, default=None)
+    parser.add_argument("-shards", help="Number of DataLoaders to split each sample between, or 'auto' to share out the CPUs between the samples", type=int_or_auto, default=1)
+    parser.add_argument("-autoscale", help="Add or retire DataLoaders at the end of each epoch depending on how long training waited for batches", type=bool, default=False)
+    parser.add_argument("-loader_backend", help="How to run the DataLoaders: 'ray' actors, a 'thread' or a 'process' per DataLoader", type=str, choices=list(backends_dict.keys()), default="ray")
+    parser.add_argument("-replay_mb", help="Memory budget (in MB) for keeping the training data in memory after the first epoch and replaying it", type=none_or_int, default=None)
+    parser.add_argument("-pin_validation", help="Keep the standardised validation set after the first validation pass in 'memory' or in a 'memmap' file, rather than re-reading it every epoch ('off'). Pinning in memory competes with the training replay buffer (-replay_mb) for RAM", type=str, choices=["memory", "memmap", "off"], default="off")
+    parser.add_argument("-pin_validation_mb", help="Memory budget (in MB) for pinning the validation set - defaults to half of the free memory", type=none_or_int, default=None)
+    parser.add_argument("-deterministic", help="Serve batches from a batch plan worked out up front so that Keras can build them in several worker threads", type=bool, default=False)
+    parser.add_argument("-keras_workers", help="Number of Keras workers building batches during training", type=int, default=2)
+    parser.add_argument("-shuffle_blocks", help="Read the NTuples in large contiguous blocks in a random order every epoch", type=bool, default=False)
+    parser.add_argument("-shuffle_buffer", help="Number of events each DataLoader keeps in a buffer to mix the events of different blocks (0 for no buffer)", type=int, default=0)
+    parser.add_argument("-seed", help="Seed for shuffling the training data", type=none_or_int, default=None)
+    parser.add_argument("-decompression_workers", help="Number of threads each DataLoader uses to decompress the NTuples", type=int, default=1)
+    parser.add_argument("-interpretation_workers", help="Number of threads each DataLoader uses to interpret decompressed data as arrays", type=int, default=1)
+    parser.add_argument("-cache", help="Materialize the padded tensors to a memory-mapped cache (see cache_dir in config/config.py) and read batches from it", type=bool, default=False)
+    parser.add_argument("-cache_precision", help="Store the cached features as float32 ('full') or in each variable's storage dtype ('reduced')", type=str, choices=list(TensorCache.precisions), default="full")
+    parser.add_argument("-cache_compression", help="Block compress the tensor cache with lz4 or zstd", type=str, choices=list(compressions), default=None)
+    parser.add_argument("-cache_workers", help="Number of files to materialize to the tensor cache at once when building it", type=int, default=4)
+    parser.add_argument("-cache_prune", help="In cache mode delete the cache shards of files that are no longer in the samples", type=bool, default=False)
+    parser.add_argument("-dynamic_padding", help="Pad each batch only to its largest number of objects, grouping events of similar multiplicity into the same batches. The model is built to take objects first inputs of any length", type=bool, default=False)
+    parser.add_argument("-importance_sampling", help="Keep each training jet with a probability proportional to its pT re-weighting weight and divide its weight by that probability", type=bool, default=False)
+    parser.add_argument("-sampling_floor", help="Smallest probability of keeping a jet when importance sampling", type=float, default=0.05)
+    parser.add_argument("-sampling_cap", help="Largest probability of keeping a jet when importance sampling", type=float, default=1.0)
+    parser.add_argument("-bitmap_index", help="Resolve the cuts from bitmap indexes of the truth decay mode, prong, pT and eta of each NTuple (built once and kept in index_dir) instead of reading the cut branches", type=bool, default=False)
+    parser.add_argument("-coverage", help="In multiplicity mode the fraction of events that should keep all of their objects", type=float, default=0.99)
     args = parser.parse_args()
 
     # Set logging level
@@ -126,6 +164,18 @@ def main():
     if args.run_mode == 'plot_variables':
         plot_variables()  
 
+    # Benchmark the data loading pipeline
+    if args.run_mode == 'benchmark':
+        benchmark(args)
+
+    # Build the tensor cache
+    if args.run_mode == 'cache':
+        build_cache(args)
+
+    # Recommend max_items from the multiplicities of the objects
+    if args.run_mode == 'multiplicity':
+        profile_multiplicity(args)
+
     # if args.run_mode == "experiment":
     #     run_test()
     